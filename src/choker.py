@@ -0,0 +1,119 @@
+"""
+Upload slot scheduler (choke/unchoke) for p2p file sharing.
+Decides which downloaders may fetch chunks from this client.
+"""
+import random
+import time
+from protocol import UPLOAD_SLOTS, RECHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_INTERVAL
+from logger import setup_logger
+
+logger = setup_logger()
+
+class UploadPeer:
+    """
+    Upload-side view of a remote peer
+    """
+    def __init__(self):
+        self.interested = False
+        self.unchoked = False
+        self.uploaded = 0  # bytes sent to the peer since the last rechoke
+        self.downloaded = 0  # bytes received from the peer since the last rechoke
+        self.upload_rate = 0.0
+        self.download_rate = 0.0
+
+class UploadChoker:
+    """
+    Tit-for-tat upload slots. Every rechoke_interval the interested peers
+    that gave us the best rate (or, once we have the whole file, that we
+    upload to fastest) get the regular slots, and one more interested peer
+    gets an optimistic unchoke that rotates every optimistic_interval.
+    Choked peers are refused straight away instead of being queued.
+    Rechoking happens lazily on the next request, so no timer is needed.
+    """
+    def __init__(self, upload_slots=UPLOAD_SLOTS, rechoke_interval=RECHOKE_INTERVAL,
+                 optimistic_interval=OPTIMISTIC_UNCHOKE_INTERVAL, seeding=lambda: False, clock=time.monotonic):
+        self.upload_slots = upload_slots
+        self.rechoke_interval = rechoke_interval
+        self.optimistic_interval = optimistic_interval
+        self.seeding = seeding
+        self.clock = clock
+        self.peers = {}  # peer key -> UploadPeer
+        self.optimistic = None
+        now = clock()
+        self._last_rechoke = now
+        self._next_optimistic = now
+
+    def _get(self, key) -> UploadPeer:
+        peer = self.peers.get(key)
+        if peer is None:
+            peer = self.peers[key] = UploadPeer()
+        return peer
+
+    def set_interested(self, key, interested: bool) -> bool:
+        """
+        Record a peer's interest, return whether it is unchoked
+        """
+        peer = self._get(key)
+        peer.interested = interested
+        if not interested:
+            peer.unchoked = False
+            if self.optimistic == key:
+                self.optimistic = None
+            return False
+        return self.allow(key)
+
+    def allow(self, key) -> bool:
+        """
+        Check whether a peer may download from us. A request implies interest,
+        and a new peer gets a free slot at once instead of waiting for the rechoke.
+        """
+        peer = self._get(key)
+        peer.interested = True
+        now = self.clock()
+        if now - self._last_rechoke >= self.rechoke_interval:
+            self.rechoke(now)
+        elif not peer.unchoked and self._regular_unchoked() < self.upload_slots:
+            peer.unchoked = True
+        return peer.unchoked
+
+    def disconnect(self, key):
+        self.peers.pop(key, None)
+        if self.optimistic == key:
+            self.optimistic = None
+
+    def record_upload(self, key, nbytes: int):
+        self._get(key).uploaded += nbytes
+
+    def record_download(self, key, nbytes: int):
+        self._get(key).downloaded += nbytes
+
+    def _regular_unchoked(self) -> int:
+        return sum(1 for key, peer in self.peers.items() if peer.unchoked and key != self.optimistic)
+
+    def rechoke(self, now=None):
+        """
+        Recompute rates over the last interval and reassign upload slots
+        """
+        now = self.clock() if now is None else now
+        elapsed = max(now - self._last_rechoke, 1e-6)
+        for peer in self.peers.values():
+            peer.upload_rate = peer.uploaded / elapsed
+            peer.download_rate = peer.downloaded / elapsed
+            peer.uploaded = peer.downloaded = 0
+        self._last_rechoke = now
+
+        seeding = self.seeding()
+        interested = [key for key, peer in self.peers.items() if peer.interested]
+        interested.sort(key=lambda key: self.peers[key].upload_rate if seeding else self.peers[key].download_rate,
+                        reverse=True)
+        regular = set(interested[:self.upload_slots])
+
+        candidates = [key for key in interested if key not in regular]
+        if now >= self._next_optimistic or self.optimistic not in candidates:
+            others = [key for key in candidates if key != self.optimistic]
+            self.optimistic = random.choice(others or candidates) if candidates else None
+            self._next_optimistic = now + self.optimistic_interval
+
+        for key, peer in self.peers.items():
+            peer.unchoked = key in regular or key == self.optimistic
+        logger.debug(f"rechoke: unchoked {sorted(regular)}, optimistic {self.optimistic}")
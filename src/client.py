@@ -3,14 +3,21 @@ Client functionality and actions for p2p file sharing.
 """
 import hashlib
 import asyncio
+import base64
 import sys
-import json
+from collections import Counter
 from socket import *
-import threading
-from protocol import PeerOperation, PeerServerOperation, ReturnCode, PayloadField, READ_SIZE
+from protocol import PeerOperation, PeerServerOperation, ReturnCode, PayloadField, ProtocolError, encode_message, encode_chunk_header, read_message, \
+    MAX_OUTSTANDING_REQUESTS, CONNECT_TIMEOUT, REQUEST_TIMEOUT, DEFAULT_NUM_WANT, ANNOUNCE_INTERVAL, unpack_compact_peers
 from chunk import *
 import file_handler as fh
-from file_chunk import ChunkBuffer, Chunk
+from file_chunk import ChunkBuffer, Chunk, unpack_bitfield
+from scheduler import DownloadScheduler
+from peer_pool import PeerConnectionPool
+from choker import UploadChoker
+from recheck import Recheck
+from tracker_session import TrackerSession
+from rate_limit import RateLimiter
 import os
 from logger import setup_logger
 
@@ -31,39 +38,17 @@ class ClientHelper:
         self.client = client
         
     async def split_chunks_between_peers(self, num_chunks: int, max_retries=3, retry_delay=1):
-        """Split torrent chunks beetween available peers"""
+        """Split torrent chunks beetween available peers and download them concurrently"""
         logger.info(f"Starting distribution of {num_chunks} chunks")
-        num_peers = len(self.client.seeder_list)
-        peer_list = list(self.client.seeder_list.values())
-        failed_chunks = set(range(num_chunks))
-        retry_count = 0
-
-        while failed_chunks and retry_count < max_retries:
-            if retry_count > 0:
-                logger.info(f"Retry attempt {retry_count} for chunks: {failed_chunks}")
-                await asyncio.sleep(retry_delay)
-
-            # Try to download each missing chunk
-            for chunk_idx in list(failed_chunks): 
-                curr_peer = chunk_idx % num_peers
-                request = self.client.create_peer_request(PeerOperation.GET_CHUNK, chunk_idx)
-                
-                try:
-                    result = await self.client.connect_to_peer(
-                        peer_list[curr_peer][PayloadField.IP_ADDRESS],
-                        peer_list[curr_peer][PayloadField.PORT],
-                        request
-                    )
-                    
-                    if result == ReturnCode.SUCCESS and self.client.chunk_buffer.has_chunk(chunk_idx):
-                        failed_chunks.remove(chunk_idx)
-                        logger.info(f"Successfully downloaded chunk {chunk_idx} from peer {curr_peer}")
-                    else:
-                        logger.error(f"Failed to download chunk {chunk_idx} from peer {curr_peer}")
-                except Exception as e:
-                    logger.error(f"Error downloading chunk {chunk_idx}: {str(e)}")
-
-            retry_count += 1
+        scheduler = DownloadScheduler(
+            self.client,
+            self.client.seeder_list,
+            partial_peers=self.client.leecher_list,
+            max_retries=max_retries,
+            retry_delay=retry_delay
+        )
+        missing = [idx for idx in range(num_chunks) if not self.client.chunk_buffer.has_chunk(idx)]
+        failed_chunks = await scheduler.run(missing)
 
         if failed_chunks:
             missing = len(failed_chunks)
@@ -75,35 +60,72 @@ class ClientHelper:
         logger.info("All chunks downloaded successfully")
         return True
 
-    async def download_file(self, num_chunks: int, filename: str):
-        if not await self.split_chunks_between_peers(num_chunks):
-            logger.error("Failed to download all chunks")
+    async def download_file(self, num_chunks: int, filename: str, file_size: int = 0, chunk_hashes=None,
+                            output_dir='output'):
+        """
+        Download a torrent straight into its output file, writing each chunk at its offset.
+        Chunks that do not match chunk_hashes are rejected and requested again.
+        Progress is kept in a resume file, so an interrupted download only
+        fetches the chunks that are missing or fail verification.
+        """
+        output_path = os.path.join(output_dir, f'{self.client.id}_{filename}')
+        output = fh.OutputFile(output_path, num_chunks, file_size)
+        try:
+            output.open()
+        except OSError as e:
+            logger.error(f"Failed to create output file {output_path}: {str(e)}")
             return False
 
-        chunks = []
-        output_path = f'output/{self.client.id}_{filename}'
-        for i in range(self.client.chunk_buffer.get_size()):
-            chunks.append(self.client.chunk_buffer.get_data(i))
-
+        resume = fh.ResumeFile(output, filename, chunk_hashes)
+        self.client.chunk_buffer.set_output(output, resume)
+        self.client.chunk_buffer.set_hashes(chunk_hashes)
+        await self.resume_download(resume, chunk_hashes)
+        success = False
         try:
-            fh.decode_file(chunks, output_path)
-            logger.info(f"File downloaded successfully: {output_path}")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to save downloaded file {filename}: {str(e)}")
-            return False
+            success = await self.split_chunks_between_peers(num_chunks)
+            if not success:
+                logger.error("Failed to download all chunks")
+                return False
+        finally:
+            if success:
+                resume.remove()
+            else:
+                await resume.save()
+            self.client.chunk_buffer.close_output()
+
+        logger.info(f"File downloaded successfully: {output_path}")
+        return True
 
-    def upload_file(self, filename: str) -> int:
+    async def resume_download(self, resume, chunk_hashes=None):
+        """
+        Pick up the chunks an interrupted run of this download left on disk.
+        With a hash manifest each saved chunk is verified again first.
+        """
+        saved = resume.load()
+        if not saved:
+            return
+        if chunk_hashes:
+            result = await Recheck(resume.output.path, resume.output.num_chunks, chunk_hashes, chunks=saved).run()
+            saved = result.have
+        resume.have = set(saved)
+        self.client.chunk_buffer.restore(saved)
+        logger.info(f"Resuming download: {len(saved)}/{resume.output.num_chunks} chunks already on disk")
+
+    async def upload_file(self, filename: str) -> int:
         """
         Prepare file for seeding by splitting into chunks
         """
         try:
             logger.info(f"uploading file as seeder {filename}")
-            chunks_size, chunks = fh.encode_file(filename)
-            self.client.chunk_buffer.set_buffer(chunks_size)
-            for idx, chunk_data in enumerate(chunks):
-                self.client.chunk_buffer.add_data(Chunk(idx, chunk_data))
-            return chunks_size
+            if self.client.zero_copy:
+                self.client.chunk_buffer.set_file(filename, os.path.getsize(filename))
+            else:
+                chunks_size, chunks = fh.encode_file(filename)
+                self.client.chunk_buffer.set_buffer(chunks_size)
+                for idx, chunk_data in enumerate(chunks):
+                    self.client.chunk_buffer.add_data(Chunk(idx, chunk_data))
+            self.client.chunk_buffer.set_hashes((await Recheck(filename).run()).hashes)
+            return self.client.chunk_buffer.get_size()
         except Exception as e:
             logger.error(f"{e} failed to read file: '{filename}'")
             return 0
@@ -171,16 +193,38 @@ class ClientHelper:
 
 class Client:
     """
-    Client is either seeder or leecher.
+    Client is either seeder or leecher. Its peer server, announcer and
+    downloads all run as tasks on the caller's event loop.
     """
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, zero_copy=True, connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT,
+                 upload_workers=0):
         self.id = self.generate_id(ip, port)
         self.ip = ip
         self.port = port
         self.state = State()
         self.helper = ClientHelper(self)
         self.seeder_list = {}
+        self.leecher_list = {}
         self.chunk_buffer = ChunkBuffer()
+        self.peer_pool = PeerConnectionPool(connect_timeout=connect_timeout, request_timeout=request_timeout)
+        self.request_timeout = request_timeout
+        self.zero_copy = zero_copy  # serve uploaded files from disk with sendfile instead of loading them
+        self.scheduler = None
+        self.seeding_server = None
+        self.announcer = None
+        self.upload_workers = upload_workers
+        self.uploaders = None
+        self.choker = UploadChoker(seeding=lambda: self.chunk_buffer.has_all_chunks)
+        self.upload_limiter = RateLimiter()
+        self.download_limiter = RateLimiter()
+        self.upload_rates = (None, None, None)  # caps for all upload processes together
+        self.torrent_list = []
+        self.torrent_list_version = None
+        self.swarm_counts = {}  # {torrentId: (seeders, leechers, completed)} from the last scrape
+        self.torrent_id = None
+        self.tracker_addr = None
+        self.tracker = None  # session for every tracker request, announces included
+        self.announce_interval = ANNOUNCE_INTERVAL
     
     @staticmethod
     def generate_id(ip: str, port: str) -> str:
@@ -192,40 +236,141 @@ class Client:
     def is_seeding(self):
         return self.state.seeding == True
     
-    async def register_to_tracker(self, ip, port):
+    async def register_to_tracker(self, ip, port) -> TrackerSession:
+        """Open the session that carries every request to the tracker"""
         if ip is None:
             ip = "127.0.0.1"
         if port is None:
             port = "8080"
+        self.tracker_addr = (ip, port)
+        self.tracker = TrackerSession(ip, port, self.peer_pool.connect_timeout, self.request_timeout)
             
         try:
-            reader, writer = await asyncio.open_connection(ip, int(port))
-            return reader, writer
-        except ConnectionError:
+            await self.tracker.open()
+            return self.tracker
+        except (ConnectionError, asyncio.TimeoutError):
             logger.error("failed to connect to tracker")
             sys.exit(-1)
 
-    async def connect_to_peer(self, ip, port, requests):
+    async def tracker_request(self, opcode: int, torrent_id=None, filename=None):
+        """
+        Send a request over the tracker session and handle the response.
+        The session sends one request at a time, so announces simply queue
+        behind the menu's requests. Returns None if the file to upload
+        could not be read, FAIL if the tracker could not be reached.
+        """
+        if opcode == PeerServerOperation.UPLOAD_FILE and await self.helper.upload_file(filename) == 0:
+            return None
+        payload = self.create_server_request(opcode, torrent_id, filename)
         try:
-            logger.info(f"connecting to seeder at {ip}:{port}")
-            reader, writer = await asyncio.open_connection(ip, int(port))
-            logger.info(f"connected as leecher: {self.ip}:{self.port}")
-        except ConnectionError:
-            logger.error("failed to connect to peer")
-            sys.exit(-1)
+            if self.tracker is None:
+                self.tracker = TrackerSession(*self.tracker_addr, self.peer_pool.connect_timeout,
+                                              self.request_timeout)
+            logger.debug(f"sending message: {self._filter_payload(payload)}")
+            return await self.handle_message(await self.tracker.request(payload))
+        except Exception as e:
+            logger.error(f"tracker request failed: {str(e)}")
+            return ReturnCode.FAIL
 
-        await self.send_message(writer, requests)
-        res = await self.receive_message(reader)
-        writer.close()
-        return res
+    async def announce(self) -> int:
+        """
+        Tell the tracker we are still here. If it already dropped us
+        (e.g. after a network outage), register again as a seeder.
+        """
+        result = await self.tracker_request(PeerServerOperation.ANNOUNCE, self.torrent_id)
+        if result == ReturnCode.NOT_FOUND and self.is_seeding() and self.torrent_id is not None:
+            logger.info("tracker dropped us, registering again")
+            result = await self.tracker_request(PeerServerOperation.START_SEED, self.torrent_id)
+        return result
+
+    async def run_announcer(self):
+        """Announce every announce_interval seconds while seeding or leeching"""
+        while True:
+            await asyncio.sleep(self.announce_interval)
+            if self.tracker_addr is None or not (self.state.seeding or self.state.leeching):
+                continue
+            await self.announce()
+
+    async def connect_to_peer(self, ip, port, requests):
+        """
+        Send a request over the pooled connection to a peer and handle the response.
+        Connection failures and timeouts return FAIL so the chunk can move to another peer.
+        """
+        try:
+            response = await self.peer_pool.request(ip, port, requests)
+        except (OSError, ProtocolError, ValueError) as e:
+            logger.error(f"request to peer {ip}:{port} failed: {str(e)}")
+            return ReturnCode.FAIL
+        logger.debug(f'Received message: {self._filter_payload(response)}')
+        result = self.handle_peer_response(response)
+        if result == ReturnCode.SUCCESS and response[PayloadField.OPERATION_CODE] == PeerOperation.GET_CHUNK:
+            await self.chunk_buffer.flush(response[PayloadField.CHUNK_IDX])
+            self.choker.record_download((ip, int(port)), len(response[PayloadField.CHUNK_DATA]))
+            # Holding back this peer's next request is what slows its data down
+            await self.download_limiter.throttle(len(response[PayloadField.CHUNK_DATA]), (ip, int(port)),
+                                                 self.torrent_id)
+        return result
     
+    async def request_bitfield(self, ip, port):
+        """
+        Ask a peer which chunks it has. Returns a set of chunk indexes, or None on failure.
+        """
+        request = self.create_peer_request(PeerOperation.BITFIELD)
+        try:
+            response = await self.peer_pool.request(ip, port, request)
+        except (OSError, ProtocolError, ValueError) as e:
+            logger.error(f"bitfield request to peer {ip}:{port} failed: {str(e)}")
+            return None
+        if response.get(PayloadField.RETURN_CODE) != ReturnCode.SUCCESS:
+            return None
+        bitfield = base64.b64decode(response[PayloadField.BITFIELD])
+        return unpack_bitfield(bitfield, self.chunk_buffer.get_size())
+
+    async def send_interested(self, ip, port) -> bool:
+        """
+        Tell a peer we want chunks from it. Returns True if it unchoked us.
+        """
+        request = self.create_peer_request(PeerOperation.STATUS_INTERESTED)
+        try:
+            response = await self.peer_pool.request(ip, port, request)
+        except (OSError, ProtocolError, ValueError) as e:
+            logger.error(f"interested message to peer {ip}:{port} failed: {str(e)}")
+            return False
+        return response.get(PayloadField.OPERATION_CODE) == PeerOperation.STATUS_UNCHOKED
+
+    def send_uninterested(self, key):
+        """
+        Give up our upload slot at a peer we no longer need anything from
+        """
+        connection = self.peer_pool.connections.get(key)
+        if connection:
+            connection.send(self.create_peer_request(PeerOperation.STATUS_UNINTERESTED))
+
+    def send_cancel(self, key, chunk_idx: int):
+        """
+        Withdraw a chunk request that another peer already answered
+        """
+        connection = self.peer_pool.connections.get(key)
+        if connection:
+            connection.send(self.create_peer_request(PeerOperation.CANCEL, chunk_idx))
+
+    def broadcast_have(self, chunk_idx: int, peers):
+        """
+        Tell peers we already have a connection to that we now hold a chunk
+        """
+        payload = self.create_peer_request(PeerOperation.HAVE, chunk_idx)
+        for key in peers:
+            connection = self.peer_pool.connections.get(key)
+            if connection:
+                connection.send(payload)
+
     def _filter_payload(self, payload):
         """
         Don't print whole chunk_data to better understand the logs.
         """
         if (type(payload) == str):
             return payload
-        filtered_payload = payload
+        filtered_payload = dict(payload)
         if PayloadField.CHUNK_DATA in filtered_payload:
             chunk_data = filtered_payload[PayloadField.CHUNK_DATA]
             filtered_payload[PayloadField.CHUNK_DATA] = f"{chunk_data[:20]}..." if chunk_data else "None"
@@ -233,49 +378,179 @@ class Client:
 
 
     async def receive_peer_request(self, reader, writer):
-        """Handle incoming peer requests and send response"""
+        """
+        Handle pipelined peer requests on one connection until the peer hangs up.
+        Requests are read ahead of the ones being served so a CANCEL can reach
+        a queued GET_CHUNK before its data is sent.
+        """
+        addr = writer.get_extra_info('peername')
+        seed_file = None
+        peer_keys = set()
+        queue = asyncio.Queue(maxsize=MAX_OUTSTANDING_REQUESTS)
+        queued = Counter()  # chunk index -> GET_CHUNK requests waiting in the queue
+        cancelled = Counter()  # chunk index -> queued requests the peer cancelled
+        read_ahead = asyncio.create_task(self._read_peer_requests(reader, addr, queue, queued, cancelled))
         try:
-            data = await reader.read(READ_SIZE)
-            peer_request = json.loads(data.decode())
-            addr = writer.get_extra_info('peername')
-
-            logger.debug(f"received from {addr}: {peer_request}")
-            response = self.handle_peer_request(peer_request)
-            payload = json.dumps(response)
-            logger.debug(f"sending response: {self._filter_payload(payload)}")
-            writer.write(payload.encode())
-            await writer.drain()
+            while True:
+                peer_request = await queue.get()
+                if peer_request is None:
+                    break
+
+                logger.debug(f"received from {addr}: {peer_request}")
+                peer_keys.add(self._peer_key(peer_request))
+                if peer_request[PayloadField.OPERATION_CODE] == PeerOperation.GET_CHUNK:
+                    chunk_idx = peer_request[PayloadField.CHUNK_IDX]
+                    queued[chunk_idx] -= 1
+                    if cancelled[chunk_idx]:
+                        cancelled[chunk_idx] -= 1
+                        writer.write(encode_message(self._cancelled_response(chunk_idx)))
+                        await writer.drain()
+                        continue
+                if self._serves_from_file(peer_request):
+                    seed_file = seed_file or open(self.chunk_buffer.path, 'rb')
+                    await self.send_chunk_from_file(writer, seed_file, peer_request[PayloadField.CHUNK_IDX],
+                                                    self._peer_key(peer_request))
+                    continue
+
+                response = self.handle_peer_request(peer_request)
+                if response is None:
+                    continue
+                if isinstance(response.get(PayloadField.CHUNK_DATA), bytes):
+                    await self.upload_limiter.throttle(len(response[PayloadField.CHUNK_DATA]),
+                                                       self._peer_key(peer_request), self.torrent_id)
+                logger.debug(f"sending response: {self._filter_payload(response)}")
+                writer.write(encode_message(response))
+                await writer.drain()
             logger.debug(f"closing connection to {addr}")
         except:
-            logger.info(f"peer {writer.get_extra_info('peername')} disconnected")
+            logger.info(f"peer {addr} disconnected")
         finally:
+            read_ahead.cancel()
+            if seed_file:
+                seed_file.close()
+            for key in peer_keys:
+                self.choker.disconnect(key)
+                self.upload_limiter.forget_peer(key)
             writer.close()
 
-    async def start_seeding(self):
-        """Start seeding server to handle peer requests"""
-        addr = (self.ip, int(self.port))
-        logger.info(f'Starting seeding server on {addr}')
-        
-        # Start server in a new thread
-        thread = threading.Thread(target=self._run_seeding_thread, args=(addr,))
-        thread.daemon = True  # Thread will exit when main program exits
-        thread.start()
-        
-    def _run_seeding_thread(self, addr):
-        """Run seeding server in a separate thread"""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
+    async def _read_peer_requests(self, reader, addr, queue, queued, cancelled):
+        """
+        Queue incoming requests for receive_peer_request. CANCEL is applied
+        here right away; None is queued when the peer hangs up.
+        """
         try:
-            server = loop.run_until_complete(
-                asyncio.start_server(self.receive_peer_request, addr[0], addr[1], loop=loop)
-            )
-            logger.info(f'Seeding started on {server.sockets[0].getsockname()}')
-            loop.run_forever()
-        except Exception as e:
-            logger.error(f"Seeding error: {str(e)}")
-        finally:
-            loop.close()
+            while True:
+                peer_request = await read_message(reader)
+                if peer_request is None:
+                    break
+                opcode = peer_request[PayloadField.OPERATION_CODE]
+                chunk_idx = peer_request.get(PayloadField.CHUNK_IDX)
+                if opcode == PeerOperation.CANCEL:
+                    # Only a request still waiting in the queue can be cancelled
+                    if queued[chunk_idx] > cancelled[chunk_idx]:
+                        cancelled[chunk_idx] += 1
+                    continue
+                if opcode == PeerOperation.GET_CHUNK:
+                    queued[chunk_idx] += 1
+                await queue.put(peer_request)
+        except (ProtocolError, asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logger.info(f"peer {addr} disconnected: {str(e)}")
+        await queue.put(None)
+
+    def _cancelled_response(self, chunk_idx: int) -> dict:
+        return {
+            PayloadField.OPERATION_CODE: PeerOperation.GET_CHUNK,
+            PayloadField.RETURN_CODE: ReturnCode.CANCELLED,
+            PayloadField.CHUNK_IDX: chunk_idx,
+            PayloadField.IP_ADDRESS: self.ip,
+            PayloadField.PORT: self.port
+        }
+
+    @staticmethod
+    def _peer_key(request) -> tuple:
+        return request[PayloadField.IP_ADDRESS], int(request[PayloadField.PORT])
+
+    def _serves_from_file(self, request) -> bool:
+        return (request[PayloadField.OPERATION_CODE] == PeerOperation.GET_CHUNK
+                and self.chunk_buffer.is_file_backed
+                and self.chunk_buffer.has_chunk(request[PayloadField.CHUNK_IDX])
+                and self.choker.allow(self._peer_key(request)))
+
+    async def send_chunk_from_file(self, writer, file, chunk_idx: int, peer_key=None):
+        """
+        Send a chunk straight from the seeded file with sendfile.
+        Only the frame header passes through Python.
+        """
+        offset, length = self.chunk_buffer.chunk_range(chunk_idx)
+        await self.upload_limiter.throttle(length, peer_key, self.torrent_id)
+        if peer_key:
+            self.choker.record_upload(peer_key, length)
+        writer.write(encode_chunk_header(PeerOperation.GET_CHUNK, ReturnCode.SUCCESS, chunk_idx, length))
+        await writer.drain()
+        await asyncio.get_running_loop().sendfile(writer.transport, file, offset, length)
+
+    async def start_seeding(self):
+        """
+        Start the peer server and the announcer on the running loop, unless
+        they are running, and the upload workers once there is a complete
+        file-backed seed
+        """
+        if self.seeding_server is None:
+            try:
+                self.seeding_server = await asyncio.start_server(self.receive_peer_request, self.ip, int(self.port),
+                                                                 reuse_port=self.upload_workers > 0)
+            except OSError as e:
+                logger.error(f"Seeding error: {str(e)}")
+                return
+            logger.info(f'Seeding started on {self.seeding_server.sockets[0].getsockname()}')
+            self.announcer = asyncio.create_task(self.run_announcer())
+        if (self.upload_workers and self.uploaders is None and self.is_seeding()
+                and self.chunk_buffer.is_file_backed and self.chunk_buffer.has_all_chunks):
+            from upload_workers import UploadWorkers
+            self.uploaders = UploadWorkers(self.upload_workers)
+            self.upload_limiter.set_rates(*self._upload_share())
+            self.uploaders.start(self.ip, self.port, self.chunk_buffer, self._upload_share(), self.torrent_id)
+
+    def stop_upload_workers(self):
+        if self.uploaders is not None:
+            self.uploaders.stop()
+            self.uploaders = None
+            self.upload_limiter.set_rates(*self._upload_share())
+
+    def set_rate_limits(self, upload=None, download=None):
+        """
+        Set the upload and/or download caps, each (total, per peer, per
+        torrent) in bytes per second with None for no cap. They apply to
+        transfers already running. While upload workers run, every upload
+        process gets an equal share of the total and per-torrent upload caps;
+        workers keep the share they started with.
+        """
+        if upload is not None:
+            self.upload_rates = tuple(upload)
+            self.upload_limiter.set_rates(*self._upload_share())
+            if self.uploaders is not None:
+                logger.info("upload workers keep their caps until they restart")
+        if download is not None:
+            self.download_limiter.set_rates(*download)
+
+    def _upload_share(self) -> tuple:
+        """This process's part of the upload caps; a peer is only ever served by one process"""
+        rate, peer_rate, torrent_rate = self.upload_rates
+        processes = 1 + (self.uploaders.count if self.uploaders is not None else 0)
+        return (rate and rate / processes), peer_rate, (torrent_rate and torrent_rate / processes)
+
+    def close(self):
+        """Stop serving peers and announcing, and close every connection"""
+        self.stop_upload_workers()
+        if self.announcer is not None:
+            self.announcer.cancel()
+            self.announcer = None
+        if self.seeding_server is not None:
+            self.seeding_server.close()
+            self.seeding_server = None
+        self.peer_pool.close_all()
+        if self.tracker is not None:
+            self.tracker.close()
 
     async def receive_message(self, reader):
         """
@@ -283,52 +558,31 @@ class Client:
         """
         try:
             logger.debug("Reading message")
-            data = await reader.read(READ_SIZE)
-            
+            payload = await asyncio.wait_for(read_message(reader), self.request_timeout)
+
             # Handle empty data
-            if not data:
+            if not payload:
                 logger.error("Received empty data")
                 return ReturnCode.FAIL
-                
-            try:
-                payload = json.loads(data.decode())
-                logger.debug(f'Received message: {self._filter_payload(payload)}')
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error: {str(e)}")
-                logger.error(f"Raw data received: {data.decode()}")
-                
-                # Retry logic for invalid responses
-                for _ in range(3): 
-                    logger.info("Retrying read...")
-                    await asyncio.sleep(0.5)
-                    data = await reader.read(READ_SIZE)
-                    if data:
-                        try:
-                            payload = json.loads(data.decode())
-                            logger.debug(f'Received message on retry: {payload}')
-                            break
-                        except json.JSONDecodeError:
-                            continue
-                else:
-                    return ReturnCode.FAIL
-                
-            opcode = payload[PayloadField.OPERATION_CODE]
-            if opcode in PeerServerOperation._value2member_map_:
-                res = await self.handle_server_response(payload)
-            else:
-                res = self.handle_peer_response(payload)
-            return res
+            return await self.handle_message(payload)
         except Exception as e:
             logger.error(f"Error in receive_message: {str(e)}")
             return ReturnCode.FAIL
 
+    async def handle_message(self, payload: dict):
+        """Route a decoded message to the server or peer response handler"""
+        logger.debug(f'Received message: {self._filter_payload(payload)}')
+        opcode = payload[PayloadField.OPERATION_CODE]
+        if opcode in PeerServerOperation._value2member_map_:
+            return await self.handle_server_response(payload)
+        return self.handle_peer_response(payload)
+
     async def send_message(self, writer, payload: dict):
         """
         Encode and send message payload
         """
-        json_payload = json.dumps(payload)
-        logger.debug(f"sending message: {json_payload}")
-        writer.write(json_payload.encode())
+        logger.debug(f"sending message: {self._filter_payload(payload)}")
+        writer.write(encode_message(payload))
         await writer.drain()
 
     async def handle_server_response(self, response) -> int:
@@ -337,6 +591,7 @@ class Client:
         """
         ret = response[PayloadField.RETURN_CODE]
         opcode = response[PayloadField.OPERATION_CODE]
+        self.announce_interval = response.get(PayloadField.INTERVAL, self.announce_interval)
 
         if ret == ReturnCode.FAIL:
             logger.error("server request failed")
@@ -346,21 +601,33 @@ class Client:
             return -1
         elif ret == ReturnCode.NO_AVAILABLE_TORRENTS:
             logger.error("no torrents available")
+            self.torrent_list, self.torrent_list_version = [], None
             return -1
         elif ret == ReturnCode.TORRENT_DOES_NOT_EXIST:
             logger.error("torrent id does not exist")
             return -1
 
         if opcode == PeerServerOperation.GET_LIST:
-            self.helper.display_torrent_list(response[PayloadField.TORRENT_LIST])
+            if ret != ReturnCode.NOT_MODIFIED:
+                self.torrent_list = await self._fetch_list_pages(response)
+                self.torrent_list_version = response.get(PayloadField.VERSION)
+            self.helper.display_torrent_list(self.torrent_list)
             return ReturnCode.SUCCESS
             
         elif opcode == PeerServerOperation.GET_TORRENT:
             torrent = response[PayloadField.TORRENT_OBJECT]
             self.state.leeching = True
-            self.seeder_list = torrent[PayloadField.SEEDER_LIST]
-            self.chunk_buffer.set_buffer(torrent[PayloadField.NUM_OF_CHUNKS])
-            result = await self.helper.download_file(torrent[PayloadField.NUM_OF_CHUNKS], torrent[PayloadField.FILE_NAME])
+            self.torrent_id = torrent[PayloadField.TORRENT_ID]
+            self.seeder_list = self._peer_list(torrent, PayloadField.SEEDER_LIST, PayloadField.COMPACT_SEEDERS)
+            self.leecher_list = self._peer_list(torrent, PayloadField.LEECHER_LIST, PayloadField.COMPACT_LEECHERS)
+            # Serve the chunks we already have while we download the rest
+            await self.start_seeding()
+            result = await self.helper.download_file(
+                torrent[PayloadField.NUM_OF_CHUNKS],
+                torrent[PayloadField.FILE_NAME],
+                torrent.get(PayloadField.FILE_SIZE, 0),
+                torrent.get(PayloadField.CHUNK_HASHES)
+            )
             if result:
                 return ReturnCode.FINISHED_DOWNLOAD
             else:
@@ -375,10 +642,50 @@ class Client:
             
         elif opcode == PeerServerOperation.STOP_SEED:
             self.state.seeding = False
+            self.stop_upload_workers()
             return ReturnCode.FINISHED_SEEDING
 
+        elif opcode == PeerServerOperation.ANNOUNCE:
+            return ret
+
+        elif opcode == PeerServerOperation.SCRAPE:
+            self.swarm_counts = {row[0]: tuple(row[1:]) for row in response[PayloadField.SWARM_COUNTS]}
+            return ReturnCode.SUCCESS
+
         return 1
 
+    def _peer_list(self, torrent: dict, field, compact_field) -> dict:
+        """
+        Peers of a GET_TORRENT response without ourselves. Compact peers
+        have no id and are keyed by their address.
+        """
+        peers = dict(torrent.get(field, {}))
+        for ip, port in unpack_compact_peers(base64.b64decode(torrent.get(compact_field, ""))):
+            peers[f"{ip}:{port}"] = {PayloadField.IP_ADDRESS: ip, PayloadField.PORT: str(port)}
+        return {peer_id: info for peer_id, info in peers.items()
+                if peer_id != self.id and (info[PayloadField.IP_ADDRESS], str(info[PayloadField.PORT])) != (self.ip, str(self.port))}
+
+    async def _fetch_list_pages(self, response) -> list:
+        """
+        Collect a whole GET_LIST: the tracker sends it in pages, so ask for
+        the next offset until TOTAL torrents are in. The version of the
+        first page is kept, so a list that changed meanwhile is fetched
+        again next time.
+        """
+        torrents = list(response[PayloadField.TORRENT_LIST])
+        offset = response.get(PayloadField.OFFSET, 0)
+        total = response.get(PayloadField.TOTAL, len(torrents))
+        while offset + len(torrents) < total:
+            request = self.create_server_request(PeerServerOperation.GET_LIST)
+            request.pop(PayloadField.VERSION, None)
+            request[PayloadField.OFFSET] = offset + len(torrents)
+            page = await self.tracker.request(request)
+            if page[PayloadField.RETURN_CODE] != ReturnCode.SUCCESS or not page[PayloadField.TORRENT_LIST]:
+                break
+            torrents += page[PayloadField.TORRENT_LIST]
+            total = page[PayloadField.TOTAL]
+        return torrents
+
     def create_server_request(self, opcode: int, torrent_id=None, filename=None) -> dict:
         payload = {
             PayloadField.OPERATION_CODE: opcode,
@@ -387,14 +694,25 @@ class Client:
             PayloadField.PEER_ID: self.id
         }
 
-        if opcode in [PeerServerOperation.GET_TORRENT, PeerServerOperation.START_SEED, PeerServerOperation.STOP_SEED]:
+        if opcode == PeerServerOperation.GET_LIST and self.torrent_list_version is not None:
+            # Only ask for the list again if it changed since we last saw it
+            payload[PayloadField.VERSION] = self.torrent_list_version
+        elif opcode in [PeerServerOperation.GET_TORRENT, PeerServerOperation.START_SEED, PeerServerOperation.STOP_SEED,
+                        PeerServerOperation.ANNOUNCE]:
             payload[PayloadField.TORRENT_ID] = torrent_id
+            if opcode == PeerServerOperation.GET_TORRENT:
+                payload[PayloadField.NUM_WANT] = DEFAULT_NUM_WANT
+                payload[PayloadField.COMPACT] = True
+        elif opcode == PeerServerOperation.SCRAPE and torrent_id is not None:
+            # A list of torrent ids, or a single one
+            payload[PayloadField.TORRENT_IDS] = list(torrent_id) if isinstance(torrent_id, (list, tuple, set)) \
+                else [torrent_id]
         elif opcode == PeerServerOperation.UPLOAD_FILE:
-            num_chunks = self.helper.upload_file(filename)
-            if num_chunks == 0:
-                return {}
+            # The file was split and hashed by ClientHelper.upload_file already
             payload[PayloadField.FILE_NAME] = self.helper.strip_filename(filename)
-            payload[PayloadField.NUM_OF_CHUNKS] = num_chunks
+            payload[PayloadField.NUM_OF_CHUNKS] = self.chunk_buffer.get_size()
+            payload[PayloadField.FILE_SIZE] = os.path.getsize(filename)
+            payload[PayloadField.CHUNK_HASHES] = self.chunk_buffer.chunk_hashes
 
         return payload
 
@@ -402,6 +720,8 @@ class Client:
         ret = response[PayloadField.RETURN_CODE]
         opcode = response[PayloadField.OPERATION_CODE]
 
+        if ret in (ReturnCode.CHOKED, ReturnCode.CANCELLED):
+            return ret
         if ret == ReturnCode.FAIL or ret != ReturnCode.SUCCESS:
             return -1
         
@@ -411,6 +731,9 @@ class Client:
             data = response[PayloadField.CHUNK_DATA]
             idx = response[PayloadField.CHUNK_IDX]
             new_chunk = Chunk(idx, data)
+            if not self.chunk_buffer.verify_chunk(new_chunk):
+                logger.error(f"chunk {idx} failed hash verification")
+                return -1
             self.chunk_buffer.add_data(new_chunk)
         
         return ReturnCode.SUCCESS
@@ -428,12 +751,33 @@ class Client:
             response[PayloadField.RETURN_CODE] = ReturnCode.SUCCESS
         elif opcode == PeerOperation.GET_CHUNK:
             chunk_idx = request[PayloadField.CHUNK_IDX]
-            if self.chunk_buffer.has_chunk(chunk_idx):
+            if not self.choker.allow(self._peer_key(request)):
+                # Cheap refusal: no data, the peer asks again once unchoked
+                response[PayloadField.OPERATION_CODE] = PeerOperation.STATUS_CHOKED
+                response[PayloadField.RETURN_CODE] = ReturnCode.CHOKED
+            elif self.chunk_buffer.has_chunk(chunk_idx):
                 response[PayloadField.CHUNK_DATA] = self.chunk_buffer.get_data(chunk_idx)
                 response[PayloadField.CHUNK_IDX] = request[PayloadField.CHUNK_IDX]
                 response[PayloadField.RETURN_CODE] = ReturnCode.SUCCESS
+                self.choker.record_upload(self._peer_key(request), len(response[PayloadField.CHUNK_DATA]))
             else:
                 response[PayloadField.RETURN_CODE] = ReturnCode.FAIL
+        elif opcode == PeerOperation.STATUS_INTERESTED:
+            unchoked = self.choker.set_interested(self._peer_key(request), True)
+            response[PayloadField.OPERATION_CODE] = PeerOperation.STATUS_UNCHOKED if unchoked else PeerOperation.STATUS_CHOKED
+            response[PayloadField.RETURN_CODE] = ReturnCode.SUCCESS
+        elif opcode == PeerOperation.STATUS_UNINTERESTED:
+            self.choker.set_interested(self._peer_key(request), False)
+            return None
+        elif opcode == PeerOperation.BITFIELD:
+            response[PayloadField.BITFIELD] = base64.b64encode(self.chunk_buffer.get_bitfield()).decode()
+            response[PayloadField.RETURN_CODE] = ReturnCode.SUCCESS
+        elif opcode == PeerOperation.HAVE:
+            # HAVE gets no response; it only feeds our own piece picker
+            if self.scheduler:
+                self.scheduler.peer_has(request[PayloadField.IP_ADDRESS], request[PayloadField.PORT],
+                                        request[PayloadField.CHUNK_IDX])
+            return None
         return response
         
     def create_peer_request(self, opcode: int, chunk_idx=None) -> dict:
@@ -442,6 +786,6 @@ class Client:
             PayloadField.IP_ADDRESS: self.ip,
             PayloadField.PORT: self.port
         }
-        if opcode == PeerOperation.GET_CHUNK:
+        if opcode in [PeerOperation.GET_CHUNK, PeerOperation.HAVE, PeerOperation.CANCEL]:
             payload[PayloadField.CHUNK_IDX] = chunk_idx
         return payload
\ No newline at end of file
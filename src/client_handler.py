@@ -12,6 +12,49 @@ from connection_limiter import ConnectionLimiter
 
 logger = setup_logger()
 
+SET_RATE_LIMITS = -2  # menu operation handled by the client itself
+
+class Console:
+    """
+    Line input from stdin that does not block the event loop, so peers
+    are served and downloads make progress while the menu waits
+    """
+    def __init__(self):
+        self.reader = None
+
+    async def open(self):
+        # Only read when stdin is readable; unlike a pipe transport this
+        # leaves the file in blocking mode, which a terminal shares with stdout
+        self.reader = asyncio.StreamReader()
+        try:
+            asyncio.get_running_loop().add_reader(sys.stdin.fileno(), self._read)
+        except (ValueError, OSError, NotImplementedError):
+            # e.g. stdin redirected from a regular file; read it on a worker thread
+            self.reader = None
+
+    def _read(self):
+        data = os.read(sys.stdin.fileno(), 4096)
+        if data:
+            self.reader.feed_data(data)
+        else:
+            asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+            self.reader.feed_eof()
+
+    async def input(self, prompt: str) -> str:
+        print(prompt, end='', flush=True)
+        if self.reader is None:
+            line = await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+        else:
+            line = (await self.reader.readline()).decode()
+        if not line:
+            raise EOFError
+        return line.rstrip('\n')
+
+    def close(self):
+        if self.reader is not None and not self.reader.at_eof():
+            asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+        self.reader = None
+
 def print_file_tree(start_path='.'):
     for root, dirs, files in os.walk(start_path):
         level = root.replace(start_path, '').count(os.sep)
@@ -21,18 +64,19 @@ def print_file_tree(start_path='.'):
         for f in files:
             print(f"{sub_indent}{f}")
 
-def display_menu():
+async def display_menu(console):
     """Display main menu options"""
     print("\np2p file sharing client")
     print("-" * 30)
     print("[1] List available torrents")
     print("[2] Download a file")
     print("[3] Share a file")
-    print("[4] Show help")
-    print("[5] Quit")
-    return input("Enter choice: ")
+    print("[4] Set rate limits")
+    print("[5] Show help")
+    print("[6] Quit")
+    return await console.input("Enter choice: ")
 
-def display_help():
+async def display_help(console):
     """Display detailed help information"""
     help_text = """
 Available Commands
@@ -46,33 +90,54 @@ Available Commands
 3. Share a file
    Make your file available to others in the network
 
-4. Show help
+4. Set rate limits
+   Cap upload and download speed in KB/s, in total, per peer and per torrent
+
+5. Show help
    Display this help message
 
-5. Quit
+6. Quit
    Exit the program
 """
     print(help_text)
-    input("Press Enter to continue...")
+    await console.input("Press Enter to continue...")
+
+def parse_rates(text: str) -> tuple:
+    """
+    Parse "total,per peer,per torrent" caps in KB/s into bytes per second.
+    Blank or 0 means no cap, e.g. "1000,,200".
+    """
+    fields = [field.strip() for field in text.split(',')]
+    if len(fields) > 3:
+        raise ValueError("too many limits")
+    fields += [''] * (3 - len(fields))
+    rates = tuple(int(float(field) * 1024) if field else 0 for field in fields)
+    if any(rate < 0 for rate in rates):
+        raise ValueError("negative limit")
+    return tuple(rate or None for rate in rates)
 
-def get_user_choice():
+async def get_user_choice(console):
     """Get and validate user menu choice"""
     while True:
         try:
-            choice = int(display_menu())
-            if choice in range(1, 6):
+            choice = int(await display_menu(console))
+            if choice in range(1, 7):
                 if choice == 1:
                     return [PeerServerOperation.GET_LIST, None, None]
                 elif choice == 2:
-                    torrent_id = int(input("Enter torrent ID: ").strip())
+                    torrent_id = int((await console.input("Enter torrent ID: ")).strip())
                     return [PeerServerOperation.GET_TORRENT, torrent_id, None]
                 elif choice == 3:
-                    filename = input("Enter filename: ").strip()
+                    filename = (await console.input("Enter filename: ")).strip()
                     return [PeerServerOperation.UPLOAD_FILE, None, filename]
                 elif choice == 4:
-                    display_help()
+                    upload = parse_rates(await console.input("Upload limits in KB/s (total,per peer,per torrent): "))
+                    download = parse_rates(await console.input("Download limits in KB/s (total,per peer,per torrent): "))
+                    return [SET_RATE_LIMITS, upload, download]
+                elif choice == 5:
+                    await display_help(console)
                     return [0, None, None]
-                else:  # choice == 5
+                else:  # choice == 6
                     return [-1, None, None]
             logger.error("invalid choice, please try again")
         except ValueError:
@@ -97,114 +162,123 @@ def parse_arguments():
     args = sys.argv[1:]
     arg_count = len(args)
     
-    if arg_count not in [2, 4]:
-        print("Usage: client_handler.py [source ip] [source port] [tracker ip] [tracker port]")
-        return None, None, None, None
+    if arg_count not in [2, 4, 5]:
+        print("Usage: client_handler.py [source ip] [source port] [tracker ip] [tracker port] [upload workers]")
+        return None, None, None, None, 0
 
     src_ip = args[0]
     src_port = args[1]
-    dest_ip = args[2] if arg_count == 4 else None
-    dest_port = args[3] if arg_count == 4 else None
+    dest_ip = args[2] if arg_count >= 4 else None
+    dest_port = args[3] if arg_count >= 4 else None
 
     if not validate_ip(src_ip):
         logger.error("invalid source IP address")
-        return None, None, None, None
+        return None, None, None, None, 0
     
     if not validate_port(src_port):
         logger.error("invalid source port number")
-        return None, None, None, None
+        return None, None, None, None, 0
 
-    if arg_count == 4:
+    if arg_count >= 4:
         if not validate_ip(dest_ip):
             logger.error("invalid tracker IP address")
-            return None, None, None, None
+            return None, None, None, None, 0
         
         if not validate_port(dest_port):
             logger.error("invalid tracker port number")
-            return None, None, None, None
+            return None, None, None, None, 0
 
-    return src_ip, src_port, dest_ip, dest_port
+    upload_workers = 0
+    if arg_count == 5:
+        if args[4].isdigit():
+            upload_workers = int(args[4])
+        else:
+            logger.error("invalid number of upload workers, uploading from this process only")
 
-async def handle_client_operation(client, reader, writer, operation):
+    return src_ip, src_port, dest_ip, dest_port, upload_workers
+
+async def handle_client_operation(client, operation):
     if not operation[0] > 0:
-        writer.close()
         return True, None
 
-    payload = client.create_server_request(
+    result = await client.tracker_request(
         opcode=operation[0],
         torrent_id=operation[1],
         filename=operation[2]
     )
-
-    if not payload:
+    if result is None:
         return True, None
-
-    await client.send_message(writer, payload)
-    logger.info("receiving request from handler")
-    result = await client.receive_message(reader)
     return False, result
 
-async def handle_seeding_completion(client, reader, writer, dest_ip, dest_port, torrent_id):
+async def handle_seeding_completion(client, torrent_id):
     """Handle the transition from downloading to seeding"""
-    writer.close()
-    reader, writer = await client.register_to_tracker(dest_ip, dest_port)
     logger.debug("Starting to seed after download completed")
-    payload = client.create_server_request(opcode=PeerServerOperation.START_SEED, torrent_id=torrent_id)
-    await client.send_message(writer, payload)
-    result = await client.receive_message(reader)
-    writer.close()
-    return result
+    return await client.tracker_request(opcode=PeerServerOperation.START_SEED, torrent_id=torrent_id)
 
-async def handle_seeding_termination(client, reader, writer, dest_ip, dest_port):
+async def handle_seeding_termination(client):
     """Handle cleanup when seeding is finished"""
-    writer.close()
-    reader, writer = await client.register_to_tracker(dest_ip, dest_port)
-    payload = client.create_server_request(opcode=PeerServerOperation.STOP_SEED, torrent_id=client.torrent_id)
-    await client.send_message(writer, payload)
-    result = await client.receive_message(reader)
-    writer.close()
-    return result
-
-async def run_client_loop(client, dest_ip, dest_port):
-    """Main client operation loop"""
-    while True:
-        reader, writer = await client.register_to_tracker(dest_ip, dest_port)
-        operation = get_user_choice()
+    return await client.tracker_request(opcode=PeerServerOperation.STOP_SEED, torrent_id=client.torrent_id)
+
+async def run_operation(client, operation):
+    """Run one menu operation, seeding once a download completes"""
+    should_continue, result = await handle_client_operation(client, operation)
+    if should_continue:
+        return
 
-        if operation[0] == -1:  # Exit
-            writer.close()
+    if result == ReturnCode.FINISHED_DOWNLOAD and not client.is_seeding():
+        result = await handle_seeding_completion(client, operation[1])
+        # Keep seeding after the download; the menu stays available
+        if result == ReturnCode.FINISHED_SEEDING:
             return
 
-        should_continue, result = await handle_client_operation(client, reader, writer, operation)
-        if should_continue:
-            continue
-
-        if result == ReturnCode.FINISHED_DOWNLOAD and not client.is_seeding():
-            result = await handle_seeding_completion(
-                client, reader, writer, dest_ip, dest_port, operation[1]
-            )
-            # Don't break after starting to seed, just continue the loop
-            if result == ReturnCode.FINISHED_SEEDING:
-                writer.close()
+    if result == ReturnCode.FINISHED_SEEDING:
+        await handle_seeding_termination(client)
+
+async def run_client_loop(client, dest_ip, dest_port, console):
+    """
+    Main client operation loop, over one tracker session. A download runs
+    as a task, so the menu can be used while it is in progress.
+    """
+    await client.register_to_tracker(dest_ip, dest_port)
+    download = None
+    try:
+        while True:
+            try:
+                operation = await get_user_choice(console)
+            except EOFError:
+                return
+
+            if operation[0] == -1:  # Exit
+                return
+
+            if operation[0] == SET_RATE_LIMITS:
+                client.set_rate_limits(upload=operation[1], download=operation[2])
                 continue
 
-        if result == ReturnCode.FINISHED_SEEDING:
-            await handle_seeding_termination(client, reader, writer, dest_ip, dest_port)
-            writer.close()
-            continue
+            if operation[0] in (PeerServerOperation.GET_TORRENT, PeerServerOperation.UPLOAD_FILE):
+                if download is not None and not download.done():
+                    logger.error("a download is in progress, wait for it to finish")
+                    continue
+                if operation[0] == PeerServerOperation.GET_TORRENT:
+                    download = asyncio.create_task(run_operation(client, operation))
+                    continue
 
-        if result != ReturnCode.SUCCESS:
-            writer.close()
+            await run_operation(client, operation)
+    finally:
+        if download is not None:
+            download.cancel()
+        client.close()
 
 async def main():
     """Main entry point"""
-    src_ip, src_port, dest_ip, dest_port = parse_arguments()
+    src_ip, src_port, dest_ip, dest_port, upload_workers = parse_arguments()
     
     if not src_ip or not src_port:
         return
 
-    client = Client(src_ip, src_port)
+    client = Client(src_ip, src_port, upload_workers=upload_workers)
     limiter = ConnectionLimiter(MAX_PEER_CONNECTIONS)
+    console = Console()
     
     # Use default tracker address if not provided
     dest_ip = dest_ip or "127.0.0.1"
@@ -214,14 +288,16 @@ async def main():
     logger.info(f"client connected: {src_ip}:{src_port}")
     
     try:
-        await limiter.limit_connections(run_client_loop)(client, dest_ip, dest_port)
+        await console.open()
+        await limiter.limit_connections(run_client_loop)(client, dest_ip, dest_port, console)
     except Exception as e:
         logger.error(f"unexpected error: {str(e)}")
     finally:
+        console.close()
         logger.info("closing connection to client")
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        logger.info("\nterminated by keyboard interrupt")
\ No newline at end of file
+        logger.info("\nterminated by keyboard interrupt")
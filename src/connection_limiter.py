@@ -1,13 +1,20 @@
 import asyncio
 import functools
+import time
 
 class ConnectionLimiter:
-    def __init__(self, max_connections: int):
+    def __init__(self, max_connections: int, observe_wait=None):
         self.semaphore = asyncio.Semaphore(max_connections)
+        self.observe_wait = observe_wait  # called with the seconds each call waited for a slot
     
     def limit_connections(self, func):
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
+            if self.observe_wait is None:
+                async with self.semaphore:
+                    return await func(*args, **kwargs)
+            start = time.perf_counter()
             async with self.semaphore:
+                self.observe_wait(time.perf_counter() - start)
                 return await func(*args, **kwargs)
         return wrapper
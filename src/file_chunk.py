@@ -1,3 +1,7 @@
+import os
+import hashlib
+from protocol import CHUNK_SIZE
+
 class Chunk:
     """
     Represents a chunk of a file with index and data
@@ -6,14 +10,39 @@ class Chunk:
         self.index = index
         self.data = data
 
+def pack_bitfield(have: list) -> bytes:
+    """
+    Pack a list of booleans into a bitfield, chunk 0 in the high bit of byte 0
+    """
+    bitfield = bytearray((len(have) + 7) // 8)
+    for idx, present in enumerate(have):
+        if present:
+            bitfield[idx >> 3] |= 0x80 >> (idx & 7)
+    return bytes(bitfield)
+
+def unpack_bitfield(bitfield: bytes, size: int) -> set:
+    """
+    Return the set of chunk indexes marked in a bitfield
+    """
+    return {idx for idx in range(min(size, len(bitfield) * 8))
+            if bitfield[idx >> 3] & (0x80 >> (idx & 7))}
+
 class ChunkBuffer:
     """
-    Manages chunks of a file during download/upload
+    Manages chunks of a file during download/upload.
+    Chunks are either held in memory or, when backed by a file, read from
+    disk at their offset on demand. While downloading into an output file
+    only chunks that are not yet written are kept in memory.
     """
     def __init__(self):
         self._buffer = []
         self._size = 0
         self._have_chunks = []
+        self._path = None
+        self._file_size = 0
+        self._output = None
+        self._resume = None
+        self._hashes = []
 
     def get_buffer(self):
         return self._buffer
@@ -25,6 +54,105 @@ class ChunkBuffer:
         self._buffer = [0] * length
         self._size = length
         self._have_chunks = [False] * length
+        self._path = None
+        self._file_size = 0
+        self._output = None
+        self._resume = None
+        self._hashes = []
+
+    def set_file(self, path: str, file_size: int):
+        """
+        Back the buffer by a file on disk holding every chunk
+        """
+        length = -(-file_size // CHUNK_SIZE)
+        self._buffer = [0] * length
+        self._size = length
+        self._have_chunks = [True] * length
+        self._path = path
+        self._file_size = file_size
+        self._output = None
+        self._resume = None
+        self._hashes = []
+
+    def set_output(self, output, resume=None):
+        """
+        Back the buffer by a download output file (see file_handler.OutputFile).
+        Chunks are written to it by flush() and then dropped from memory, and
+        recorded in the resume file (file_handler.ResumeFile) if one is given.
+        """
+        self._buffer = [0] * output.num_chunks
+        self._size = output.num_chunks
+        self._have_chunks = [False] * output.num_chunks
+        self._path = output.path
+        self._file_size = output.file_size
+        self._output = output
+        self._resume = resume
+        self._hashes = []
+
+    def set_hashes(self, hashes: list):
+        """
+        Set the per-chunk SHA-256 manifest used to verify received chunks
+        """
+        self._hashes = list(hashes or [])
+
+    @property
+    def chunk_hashes(self) -> list:
+        return self._hashes
+
+    def verify_chunk(self, chunk: Chunk) -> bool:
+        """
+        Check chunk data against the manifest. Without a manifest every chunk passes.
+        """
+        if not self._hashes:
+            return True
+        if not 0 <= chunk.index < len(self._hashes):
+            return False
+        return hashlib.sha256(chunk.data).hexdigest() == self._hashes[chunk.index]
+
+    async def flush(self, idx: int):
+        """
+        Write a received chunk to the output file and release its memory
+        """
+        if self._output is None or not 0 <= idx < self._size or self._buffer[idx] == 0:
+            return
+        await self._output.write_chunk(idx, self._buffer[idx])
+        self._file_size = self._output.file_size
+        self._buffer[idx] = 0
+        self._have_chunks[idx] = True
+        if self._resume is not None:
+            await self._resume.record(idx)
+
+    def restore(self, chunks):
+        """
+        Mark chunks already present in the output file, e.g. from an interrupted download
+        """
+        for idx in chunks:
+            if 0 <= idx < self._size:
+                self._have_chunks[idx] = True
+
+    def close_output(self):
+        """
+        Stop writing; the buffer stays backed by the finished file
+        """
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+            self._resume = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def is_file_backed(self) -> bool:
+        return self._path is not None
+
+    def chunk_range(self, idx: int) -> tuple[int, int]:
+        """
+        Return (offset, length) of chunk idx inside the backing file
+        """
+        offset = idx * CHUNK_SIZE
+        return offset, min(CHUNK_SIZE, self._file_size - offset)
 
     def add_data(self, chunk: Chunk) -> int:
         """
@@ -33,7 +161,9 @@ class ChunkBuffer:
         idx = chunk.index
         if 0 <= idx < self._size:
             self._buffer[idx] = chunk.data
-            self._have_chunks[idx] = True
+            # Chunks headed for an output file count once flush() wrote them
+            if self._output is None:
+                self._have_chunks[idx] = True
             return 1
         return -1
 
@@ -43,16 +173,35 @@ class ChunkBuffer:
         """
         if 0 <= idx < self._size and self._buffer[idx] != 0:
             return self._buffer[idx]
+        if self.is_file_backed and 0 <= idx < self._size and self._have_chunks[idx]:
+            offset, length = self.chunk_range(idx)
+            with open(self._path, 'rb') as f:
+                return os.pread(f.fileno(), length, offset)
         return -1
             
     def get_size(self) -> int:
         return self._size
 
+    def chunk_length(self, idx: int) -> int:
+        """
+        Size in bytes of a chunk we have, without reading it back from disk
+        """
+        if not 0 <= idx < self._size:
+            return 0
+        if self._buffer[idx] != 0:
+            return len(self._buffer[idx])
+        if self.is_file_backed and self._have_chunks[idx]:
+            return self.chunk_range(idx)[1]
+        return 0
+
     def get_missing_chunks(self) -> list:
         return [idx for idx, have in enumerate(self._have_chunks) if not have]
 
     def has_chunk(self, idx: int) -> bool:
-        return self._have_chunks[idx]
+        return 0 <= idx < self._size and self._have_chunks[idx]
+
+    def get_bitfield(self) -> bytes:
+        return pack_bitfield(self._have_chunks)
 
     @property
     def has_all_chunks(self) -> bool:
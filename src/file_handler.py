@@ -1,21 +1,154 @@
 import os
-import hashlib
-from protocol import CHUNK_SIZE
+import asyncio
 import base64
+import hashlib
+import json
+from protocol import CHUNK_SIZE, RESUME_BATCH_SIZE
+from file_chunk import pack_bitfield, unpack_bitfield
+from logger import setup_logger
+
+logger = setup_logger()
+
+RESUME_SUFFIX = '.resume'
 
 def encode_file(file_name:str):
     chunks = [] 
     with open(file_name, 'rb') as f:
         chunk = f.read(CHUNK_SIZE)
         while chunk:
-            chunks.append(base64.b64encode(chunk).decode('utf-8'))
+            chunks.append(chunk)
             chunk = f.read(CHUNK_SIZE)
     return len(chunks), chunks
 
 def decode_file(chunks:list, path):
     with open(path, 'wb') as f:
         for chunk in chunks:
-            f.write(base64.b64decode(chunk.encode('utf-8')))
+            f.write(chunk)
+
+class OutputFile:
+    """
+    Output file of a download. Space for the whole file is reserved up
+    front and every chunk is written at its offset as soon as it arrives,
+    in a worker thread so the event loop never blocks on disk.
+    If file_size is unknown (0) the file is sized from num_chunks and
+    trimmed when the last chunk is written.
+    """
+    def __init__(self, path: str, num_chunks: int, file_size: int = 0):
+        self.path = path
+        self.num_chunks = num_chunks
+        self.exact_size = file_size > 0
+        self.file_size = file_size if self.exact_size else num_chunks * CHUNK_SIZE
+        self._fd = None
+
+    def open(self):
+        """
+        Create the file (keeping existing data) and preallocate its size
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.posix_fallocate(self._fd, 0, self.file_size)
+        except (AttributeError, OSError):
+            # No fallocate on this platform/filesystem, fall back to a sparse file
+            os.ftruncate(self._fd, self.file_size)
+
+    async def write_chunk(self, idx: int, data: bytes):
+        offset = idx * CHUNK_SIZE
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, os.pwrite, self._fd, data, offset)
+        if idx == self.num_chunks - 1 and not self.exact_size:
+            self.file_size = offset + len(data)
+            await loop.run_in_executor(None, os.ftruncate, self._fd, self.file_size)
+            self.exact_size = True
+
+    def sync(self):
+        """Flush written chunks to stable storage"""
+        if self._fd is not None:
+            os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class ResumeFile:
+    """
+    Progress of a download, kept next to its output file: the torrent
+    metadata and a bitfield of the chunks written so far. The output file
+    is synced and the resume file replaced atomically every batch_size
+    chunks, so a crash loses at most one batch and never records a chunk
+    that is not on disk.
+    """
+    def __init__(self, output: OutputFile, file_name: str, chunk_hashes=None, batch_size=RESUME_BATCH_SIZE):
+        self.output = output
+        self.path = output.path + RESUME_SUFFIX
+        self.batch_size = batch_size
+        self.meta = {
+            'file_name': file_name,
+            'num_chunks': output.num_chunks,
+            'file_size': output.file_size if output.exact_size else 0,
+            'manifest': hashlib.sha256(''.join(chunk_hashes or []).encode()).hexdigest()
+        }
+        self.have = set()
+        self._dirty = 0
+        self._lock = asyncio.Lock()
+
+    def load(self) -> set:
+        """
+        Read the saved progress. Returns an empty set if there is none or it
+        belongs to a different torrent.
+        """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            bitfield = base64.b64decode(saved.pop('bitfield'))
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"ignoring unreadable resume file {self.path}: {str(e)}")
+            return set()
+        if saved != self.meta:
+            logger.info(f"resume file {self.path} is for another torrent, starting over")
+            return set()
+        self.have = unpack_bitfield(bitfield, self.meta['num_chunks'])
+        return set(self.have)
+
+    async def record(self, idx: int):
+        """Note a chunk written to the output file, saving once a batch is complete"""
+        self.have.add(idx)
+        self._dirty += 1
+        if self._dirty >= self.batch_size:
+            async with self._lock:
+                if self._dirty >= self.batch_size:
+                    have = set(self.have)
+                    self._dirty = 0
+                    await asyncio.get_running_loop().run_in_executor(None, self._write, have)
+
+    async def save(self):
+        """Write the current progress now, syncing off the event loop"""
+        async with self._lock:
+            self._dirty = 0
+            await asyncio.get_running_loop().run_in_executor(None, self._write, set(self.have))
+
+    def _write(self, have: set):
+        self.output.sync()
+        bitfield = pack_bitfield([idx in have for idx in range(self.meta['num_chunks'])])
+        state = dict(self.meta, bitfield=base64.b64encode(bitfield).decode())
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"failed to save resume file {self.path}: {str(e)}")
+
+    def remove(self):
+        """Drop the resume file once the download is complete"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
 class FileHandler:
     @staticmethod
@@ -0,0 +1,178 @@
+"""
+Tracker persistence for p2p file sharing.
+An append-only journal of registry events plus periodic snapshots, so a
+restarted tracker gets its torrents, peers and torrent ids back.
+"""
+import asyncio
+import json
+import os
+from protocol import SNAPSHOT_EVERY
+from logger import setup_logger
+
+logger = setup_logger()
+
+SNAPSHOT_FILE = 'snapshot.json'
+JOURNAL_PREFIX = 'journal.'
+JOURNAL_SUFFIX = '.log'
+
+class Journal:
+    """
+    Journal files are numbered by generation. A snapshot of generation g
+    holds every event of the journals before g, so recovery loads the
+    snapshot and replays journals g, g+1, ... in order.
+
+    Events are appended to memory and written by commit(). Commits are
+    serialized, so requests that arrive while a write is on its way to
+    disk share the next write and fsync (group commit). File I/O runs in
+    the default executor and never blocks the event loop.
+    """
+    def __init__(self, directory: str, snapshot_every=SNAPSHOT_EVERY):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.generation = 0
+        self.pending = []  # encoded events not written yet
+        self.appended = 0
+        self.durable = 0
+        self.error = None  # set once a write failed
+        self.since_snapshot = 0
+        self.snapshotting = False
+        self._file = None
+        self._lock = asyncio.Lock()
+
+    def _journal_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"{JOURNAL_PREFIX}{generation:08d}{JOURNAL_SUFFIX}")
+
+    def _generations(self) -> list:
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith(JOURNAL_PREFIX) and name.endswith(JOURNAL_SUFFIX):
+                try:
+                    generations.append(int(name[len(JOURNAL_PREFIX):-len(JOURNAL_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(generations)
+
+    def load(self) -> tuple:
+        """
+        Read the latest snapshot and the journal events after it, and open
+        the journal for appending. Returns (snapshot state or None, events).
+        A torn event at the end of the last journal (crash mid-write) is cut off.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        state = None
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT_FILE)) as f:
+                snapshot = json.load(f)
+            self.generation = snapshot['generation']
+            state = snapshot['state']
+        except FileNotFoundError:
+            pass
+
+        events = []
+        generations = [g for g in self._generations() if g >= self.generation]
+        for generation in generations:
+            path = self._journal_path(generation)
+            valid = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("incomplete event")
+                        events.append(json.loads(line))
+                    except ValueError:
+                        if generation != generations[-1]:
+                            raise
+                        logger.warning(f"dropping torn journal tail of {path} at byte {valid}")
+                        break
+                    valid += len(line)
+            if os.path.getsize(path) != valid:
+                os.truncate(path, valid)
+        if generations:
+            self.generation = generations[-1]
+        self.since_snapshot = len(events)
+        self._file = open(self._journal_path(self.generation), 'ab')
+        return state, events
+
+    def append(self, event: list):
+        self.pending.append(json.dumps(event, separators=(',', ':')) + '\n')
+        self.appended += 1
+        self.since_snapshot += 1
+
+    async def commit(self):
+        """
+        Wait until every event appended so far is on disk. Once a write or
+        fsync failed, nothing after it is known to be on disk, so that
+        commit and every later one raise the error.
+        """
+        target = self.appended
+        loop = asyncio.get_running_loop()
+        while self.durable < target:
+            async with self._lock:
+                if self.durable >= target:
+                    break
+                if self.error is not None:
+                    raise self.error
+                lines, self.pending = self.pending, []
+                try:
+                    await loop.run_in_executor(None, self._write, self._file, lines)
+                except OSError as e:
+                    logger.error(f"journal write failed: {str(e)}")
+                    self.error = e
+                    raise
+                self.durable += len(lines)
+
+    @staticmethod
+    def _write(file, lines: list):
+        file.write(''.join(lines).encode())
+        file.flush()
+        os.fsync(file.fileno())
+
+    def snapshot_due(self) -> bool:
+        return not self.snapshotting and self.since_snapshot >= self.snapshot_every
+
+    async def snapshot(self, capture):
+        """
+        Write a snapshot of capture() and drop the journals it covers.
+        capture() runs together with the switch to a new journal and must
+        not await, so the snapshot matches the journals before the new one
+        exactly; the encoding and writing happen off the event loop.
+        """
+        self.snapshotting = True
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._lock:
+                lines, self.pending = self.pending, []
+                state = capture()
+                old_file, old_generation = self._file, self.generation
+                self.generation += 1
+                self._file = open(self._journal_path(self.generation), 'ab')
+                self.since_snapshot = 0
+                # Events from before the switch belong to the old journal
+                try:
+                    await loop.run_in_executor(None, self._write, old_file, lines)
+                finally:
+                    self.durable += len(lines)
+                    old_file.close()
+            await loop.run_in_executor(None, self._write_snapshot, state, self.generation)
+            for generation in self._generations():
+                if generation <= old_generation:
+                    os.remove(self._journal_path(generation))
+        except OSError as e:
+            logger.error(f"failed to write tracker snapshot: {str(e)}")
+        finally:
+            self.snapshotting = False
+
+    def _write_snapshot(self, state: dict, generation: int):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'generation': generation, 'state': state}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        logger.info(f"tracker snapshot written (generation {generation})")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
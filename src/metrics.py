@@ -0,0 +1,136 @@
+"""
+Tracker metrics for p2p file sharing.
+Counters and latency histograms kept in plain Python numbers, exposed in
+the Prometheus text format over a small local HTTP listener.
+"""
+import asyncio
+from bisect import bisect_left
+from protocol import PeerServerOperation
+from logger import setup_logger
+
+logger = setup_logger()
+
+# Upper bounds in seconds, from 100us to 5s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def render(self, name: str, labels: str = '') -> list:
+        sep = ',' if labels else ''
+        lines, total = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {total}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum}')
+        lines.append(f'{name}_count{suffix} {total}')
+        return lines
+
+def _op_name(opcode) -> str:
+    try:
+        return PeerServerOperation(opcode).name
+    except ValueError:
+        return str(opcode)
+
+class TrackerMetrics:
+    """
+    Request counts and end-to-end latencies by operation (the limiter
+    wait and journal commit included), connection limiter wait,
+    bytes in and out and open sessions. Recording only touches a few
+    dicts and numbers, so it stays on at high request rates; the text
+    format is built when the endpoint is scraped.
+    """
+    def __init__(self):
+        self.requests = {}  # opcode -> count
+        self.latency = {}  # opcode -> Histogram
+        self.limiter_wait = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.connections_total = 0
+
+    def observe_request(self, opcode, seconds: float, bytes_in: int, bytes_out: int):
+        self.requests[opcode] = self.requests.get(opcode, 0) + 1
+        histogram = self.latency.get(opcode)
+        if histogram is None:
+            histogram = self.latency[opcode] = Histogram()
+        histogram.observe(seconds)
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def connection_opened(self):
+        self.connections += 1
+        self.connections_total += 1
+
+    def connection_closed(self):
+        self.connections -= 1
+
+    def render(self, gauges: dict) -> str:
+        """Prometheus text format; gauges are extra name -> (help, value) readings"""
+        lines = [
+            '# HELP tracker_requests_total Requests handled, by operation',
+            '# TYPE tracker_requests_total counter'
+        ]
+        for opcode, count in sorted(self.requests.items()):
+            lines.append(f'tracker_requests_total{{op="{_op_name(opcode)}"}} {count}')
+        lines += [
+            '# HELP tracker_request_duration_seconds End-to-end request time by operation: limiter wait, '
+            'handling, shard forwarding and journal commit',
+            '# TYPE tracker_request_duration_seconds histogram'
+        ]
+        for opcode, histogram in sorted(self.latency.items()):
+            lines += histogram.render('tracker_request_duration_seconds', f'op="{_op_name(opcode)}"')
+        lines += [
+            '# HELP tracker_limiter_wait_seconds Time requests waited for a connection limiter slot',
+            '# TYPE tracker_limiter_wait_seconds histogram'
+        ]
+        lines += self.limiter_wait.render('tracker_limiter_wait_seconds')
+        for name, kind, help_text, value in (
+                ('tracker_received_bytes_total', 'counter', 'Request bytes received', self.bytes_in),
+                ('tracker_sent_bytes_total', 'counter', 'Response bytes sent', self.bytes_out),
+                ('tracker_connections', 'gauge', 'Open client sessions', self.connections),
+                ('tracker_connections_total', 'counter', 'Client sessions accepted', self.connections_total)):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+        for name, (help_text, value) in gauges.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+async def serve_metrics(render, host: str, port: int):
+    """
+    Serve render() as text on GET /metrics. Meant for a local port that a
+    Prometheus server scrapes.
+    """
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except OSError as e:
+            logger.error(f"metrics request failed: {str(e)}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"metrics on http://{host}:{server.sockets[0].getsockname()[1]}/metrics")
+    return server
@@ -0,0 +1,289 @@
+"""
+Pool of long-lived peer connections for p2p file sharing.
+Each connection carries many pipelined requests; responses come back in order.
+Every request has a deadline, and a per-peer circuit breaker stops requests
+to a peer that keeps failing until a later probe succeeds.
+"""
+import asyncio
+import random
+import time
+from collections import deque, OrderedDict
+from protocol import MAX_PEER_CONNECTIONS, PEER_IDLE_TIMEOUT, CONNECT_TIMEOUT, REQUEST_TIMEOUT, \
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, MAX_BACKOFF, encode_message, read_message
+from logger import setup_logger
+
+logger = setup_logger()
+
+class PeerTimeoutError(ConnectionError):
+    """Raised when a peer does not connect or respond before the deadline"""
+
+class PeerUnavailableError(ConnectionError):
+    """Raised when a peer's circuit breaker is open"""
+
+def backoff_delay(base: float, attempt: int, cap: float = MAX_BACKOFF) -> float:
+    """
+    Exponential backoff with jitter: base * 2^(attempt - 1), capped, then
+    randomized between half and the full delay so retries do not line up
+    """
+    delay = min(cap, base * 2 ** max(attempt - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitBreaker:
+    """
+    Per-peer circuit breaker. CLOSED lets requests through; after
+    failure_threshold consecutive failures it goes OPEN and refuses them.
+    Once the reset timeout passes it goes HALF_OPEN and lets one probe
+    through: success closes it, failure opens it again with a longer timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = 0.0
+
+    def allow(self) -> bool:
+        """Check whether a request may go to the peer, starting a probe if one is due"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.clock() >= self.retry_at:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    @property
+    def available(self) -> bool:
+        """Whether allow() would let a request through, without starting a probe"""
+        return self.state == self.CLOSED or (self.state == self.OPEN and self.clock() >= self.retry_at)
+
+    def retry_in(self) -> float:
+        return max(0.0, self.retry_at - self.clock())
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+
+    def cancel_probe(self):
+        """A probe ended without an answer: let the next request probe instead"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trips += 1
+            self.state = self.OPEN
+            self.retry_at = self.clock() + backoff_delay(self.reset_timeout, self.trips)
+
+class PeerConnection:
+    """
+    Single connection to a peer. Requests are written back to back and
+    matched to responses in FIFO order by a background reader task.
+    """
+    def __init__(self, reader, writer, on_idle=None, request_timeout=REQUEST_TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.request_timeout = request_timeout
+        self.pending = deque()
+        self.closed = False
+        self.last_used = asyncio.get_running_loop().time()
+        self._on_idle = on_idle
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def open(cls, ip, port, on_idle=None, connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, int(port)), connect_timeout)
+        except asyncio.TimeoutError:
+            raise PeerTimeoutError(f"connect to {ip}:{port} timed out")
+        return cls(reader, writer, on_idle, request_timeout)
+
+    @property
+    def idle(self) -> bool:
+        return not self.pending
+
+    async def request(self, payload: dict) -> dict:
+        """Send a request on this connection and wait for its response"""
+        if self.closed:
+            raise ConnectionResetError("peer connection is closed")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(future)
+        self.last_used = loop.time()
+        self.writer.write(encode_message(payload))
+        try:
+            return await asyncio.wait_for(self._send_and_wait(future), self.request_timeout)
+        except asyncio.TimeoutError:
+            # The peer is stuck; fail everything queued behind this request too
+            self.close()
+            raise PeerTimeoutError("peer did not respond in time")
+
+    async def _send_and_wait(self, future):
+        await self.writer.drain()
+        return await future
+
+    def send(self, payload: dict):
+        """Send a message that gets no response (e.g. HAVE)"""
+        if not self.closed:
+            self.writer.write(encode_message(payload))
+
+    async def _read_responses(self):
+        try:
+            while True:
+                response = await read_message(self.reader)
+                if response is None:
+                    break
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(response)
+                self.last_used = asyncio.get_running_loop().time()
+                if self.idle and self._on_idle:
+                    self._on_idle()
+        except Exception as e:
+            logger.error(f"peer connection error: {str(e)}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionResetError("peer closed connection"))
+        self.writer.close()
+        if self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+        if self._on_idle:
+            self._on_idle()
+
+class PeerConnectionPool:
+    """
+    Keeps at most max_connections open peer connections, keyed by (ip, port).
+    Idle connections are closed after idle_timeout seconds, and the least
+    recently used idle connection is evicted when the pool is full.
+    """
+    def __init__(self, max_connections=MAX_PEER_CONNECTIONS, idle_timeout=PEER_IDLE_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}  # peer key -> CircuitBreaker
+        self.connections = OrderedDict()
+        self._opening = 0
+        self._locks = {}
+        self._changed = None
+        self._sweeper = None
+
+    def breaker(self, key) -> CircuitBreaker:
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def is_available(self, ip, port) -> bool:
+        """Whether requests to the peer are currently let through"""
+        return self.breaker((ip, int(port))).available
+
+    async def request(self, ip, port, payload: dict) -> dict:
+        """
+        Send a request to a peer and return its response. Raises
+        ConnectionError (PeerTimeoutError, PeerUnavailableError, ...) on failure.
+        """
+        breaker = self.breaker((ip, int(port)))
+        if not breaker.allow():
+            raise PeerUnavailableError(f"peer {ip}:{port} is unavailable for {breaker.retry_in():.1f}s")
+        try:
+            conn = await self.acquire(ip, port)
+            response = await conn.request(payload)
+        except OSError:
+            breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            breaker.cancel_probe()
+            raise
+        breaker.record_success()
+        return response
+
+    async def acquire(self, ip, port) -> PeerConnection:
+        """Return an open connection to the peer, opening one if needed"""
+        key = (ip, int(port))
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            conn = self.connections.get(key)
+            if conn and not conn.closed:
+                self.connections.move_to_end(key)
+                return conn
+            self.connections.pop(key, None)
+
+            await self._make_room()
+            self._opening += 1
+            try:
+                conn = await PeerConnection.open(ip, port, self._notify, self.connect_timeout, self.request_timeout)
+            finally:
+                self._opening -= 1
+            logger.info(f"opened peer connection to {ip}:{port}")
+            self.connections[key] = conn
+            self._start_sweeper()
+            return conn
+
+    def _notify(self):
+        if self._changed:
+            self._changed.set()
+            self._changed = None
+
+    async def _make_room(self):
+        """Wait until a new connection fits in the pool, evicting idle ones"""
+        while True:
+            self._drop_closed()
+            if len(self.connections) + self._opening < self.max_connections:
+                return
+            victim = next((key for key, conn in self.connections.items() if conn.idle), None)
+            if victim is not None:
+                logger.debug(f"evicting peer connection to {victim}")
+                self.connections.pop(victim).close()
+                continue
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            await self._changed.wait()
+
+    def _drop_closed(self):
+        for key in [key for key, conn in self.connections.items() if conn.closed]:
+            del self.connections[key]
+
+    def evict_idle(self):
+        """Close connections that have been idle for longer than idle_timeout"""
+        now = asyncio.get_running_loop().time()
+        for key, conn in list(self.connections.items()):
+            if conn.closed or (conn.idle and now - conn.last_used > self.idle_timeout):
+                logger.debug(f"closing idle peer connection to {key}")
+                self.connections.pop(key).close()
+
+    def _start_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def _sweep(self):
+        while self.connections:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.evict_idle()
+
+    def close_all(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+        if self._sweeper:
+            self._sweeper.cancel()
@@ -1,4 +1,8 @@
 from enum import IntEnum, auto, Enum
+import asyncio
+import json
+import socket
+import struct
 
 class PeerServerOperation(IntEnum):
     """Operations between peer and server"""
@@ -7,6 +11,8 @@ class PeerServerOperation(IntEnum):
     START_SEED = 120
     STOP_SEED = 130
     UPLOAD_FILE = 140
+    ANNOUNCE = 145
+    SCRAPE = 146
 
 class PeerOperation(IntEnum):
     """Operations between peers"""
@@ -16,12 +22,16 @@ class PeerOperation(IntEnum):
     STATUS_UNCHOKED = 180
     GET_PEERS = 190
     GET_CHUNK = 195
+    BITFIELD = 196
+    HAVE = 197
+    CANCEL = 198
 
 class ReturnCode(IntEnum):
     # Success codes (200-299)
     SUCCESS = 200
     FINISHED_DOWNLOAD = 201
     FINISHED_SEEDING = 202
+    NOT_MODIFIED = 203
     
     # Client errors (400-499)
     BAD_REQUEST = 400
@@ -31,6 +41,8 @@ class ReturnCode(IntEnum):
     ALREADY_SEEDING = 409
     NO_AVAILABLE_TORRENTS = 410
     TORRENT_DOES_NOT_EXIST = 411
+    CHOKED = 412
+    CANCELLED = 413
     FAIL = 450
     FAILED_TO_DOWNLOAD = 451
 
@@ -44,6 +56,9 @@ class PayloadField(str, Enum):
     TORRENT_ID = 'TORRENT_ID'
     FILE_NAME = 'FILE_NAME'
     NUM_OF_CHUNKS = 'NUM_OF_CHUNKS'
+    FILE_SIZE = 'FILE_SIZE'
+    CHUNK_HASHES = 'CHUNK_HASHES'
+    BITFIELD = 'BITFIELD'
     TORRENT_LIST = 'TORRENT_LIST'
     TORRENT_OBJECT = 'TORRENT_OBJECT'
     CHUNK_IDX = 'CHUNK_INDX'
@@ -51,8 +66,160 @@ class PayloadField(str, Enum):
     PEER_LIST = 'PEER_LIST'
     SEEDER_LIST = 'SEEDER_LIST'
     LEECHER_LIST = 'LEECHER_LIST'
+    NUM_SEEDERS = 'NUM_SEEDERS'
+    NUM_LEECHERS = 'NUM_LEECHERS'
+    VERSION = 'VERSION'
+    OFFSET = 'OFFSET'
+    LIMIT = 'LIMIT'
+    TOTAL = 'TOTAL'
+    SUMMARY = 'SUMMARY'
+    NUM_WANT = 'NUM_WANT'
+    COMPACT = 'COMPACT'
+    COMPACT_SEEDERS = 'COMPACT_SEEDERS'
+    COMPACT_LEECHERS = 'COMPACT_LEECHERS'
+    INTERVAL = 'INTERVAL'
+    SHARD_LIST = 'SHARD_LIST'
+    TORRENT_IDS = 'TORRENT_IDS'
+    SWARM_COUNTS = 'SWARM_COUNTS'
 
-READ_SIZE = 24576  # 24KB
 CHUNK_SIZE = 16384  # 16KB
-MAX_TRACKER_CONNECTIONS = 50
-MAX_PEER_CONNECTIONS = 10
\ No newline at end of file
+MAX_TRACKER_CONNECTIONS = 50  # requests the tracker handles at once
+LIST_PAGE_SIZE = 100  # torrents per GET_LIST page unless the client asks for another limit
+MAX_LIST_PAGE_SIZE = 1000
+DEFAULT_NUM_WANT = 50  # peers per GET_TORRENT unless the client asks for another number
+MAX_NUM_WANT = 200
+ANNOUNCE_INTERVAL = 60  # seconds between a peer's announces to the tracker
+PEER_TIMEOUT = 3 * ANNOUNCE_INTERVAL  # seconds without an announce before the tracker drops a peer
+EXPIRY_RESOLUTION = 1  # seconds per tracker expiry tick
+TRACKER_IDLE_TIMEOUT = ANNOUNCE_INTERVAL + 30  # seconds; a session outlives the gap between announces
+TRACKER_STATE_DIR = 'tracker_state'
+SNAPSHOT_EVERY = 10000  # journal events between tracker snapshots
+MAX_PEER_CONNECTIONS = 10
+PEER_IDLE_TIMEOUT = 30  # seconds
+CONNECT_TIMEOUT = 5  # seconds
+REQUEST_TIMEOUT = 30  # seconds to wait for a response
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive failures before a peer is cut off
+BREAKER_RESET_TIMEOUT = 10  # seconds before a cut-off peer is probed again
+MAX_BACKOFF = 60  # seconds, cap for peer probe backoff
+MAX_RETRY_BACKOFF = 2  # seconds, cap for the wait between chunk retry rounds
+RESUME_BATCH_SIZE = 64  # chunks written between saves of the resume file
+RECHECK_READ_SIZE = 4 * 1024 * 1024  # 4MB reads when rehashing a file
+RECHECK_RANGE_CHUNKS = 1024  # chunks hashed per recheck task (16MB)
+MAX_REQUESTS_PER_PEER = 4
+MAX_OUTSTANDING_REQUESTS = 32
+UPLOAD_SLOTS = 4
+RECHOKE_INTERVAL = 10  # seconds
+OPTIMISTIC_UNCHOKE_INTERVAL = 30  # seconds
+CHOKE_POLL_INTERVAL = 2  # seconds
+ENDGAME_THRESHOLD = 8  # chunks left when duplicate requests start
+STATS_INTERVAL = 1  # seconds between peer rate samples
+STATS_EWMA_ALPHA = 0.3  # weight of the newest sample in peer statistics
+SLOW_PEER_RATIO = 0.05  # peers below this fraction of the best rate are dropped
+MAX_FAILURE_RATE = 0.5  # peers failing more often than this are dropped
+RATE_LIMIT_BURST = 0.1  # seconds of traffic a rate limiter lets through at once after an idle spell
+RATE_LIMIT_QUANTUM = 0.01  # seconds of traffic a rate limiter lets run into debt before it sleeps
+
+# Wire framing (protocol version 2)
+# Every message is a fixed header followed by `length` body bytes. Control
+# messages carry a JSON body; chunk data travels as raw bytes.
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct('!BBHHII')  # version, flags, opcode, return code, chunk index, length
+FRAME_JSON = 0
+FRAME_RAW_CHUNK = 1
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64MB
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed frame"""
+
+def pack_compact_peer(ip: str, port) -> bytes:
+    """
+    6-byte compact peer address: IPv4 address and port in network order.
+    Raises OSError for addresses that are not IPv4.
+    """
+    return socket.inet_aton(ip) + struct.pack('!H', int(port))
+
+def unpack_compact_peers(data: bytes) -> list:
+    """Split packed compact peers into (ip, port) pairs"""
+    return [(socket.inet_ntoa(data[pos:pos + 4]), struct.unpack('!H', data[pos + 4:pos + 6])[0])
+            for pos in range(0, len(data) - len(data) % 6, 6)]
+
+def encode_frame(opcode: int, body: bytes = b'', return_code: int = 0, chunk_idx: int = 0, flags: int = FRAME_JSON) -> bytes:
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, flags, opcode, return_code, chunk_idx, len(body)) + body
+
+def encode_chunk_header(opcode: int, return_code: int, chunk_idx: int, length: int) -> bytes:
+    """Header of a raw chunk frame whose body is written separately (e.g. with sendfile)"""
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, FRAME_RAW_CHUNK, opcode, return_code, chunk_idx, length)
+
+def encode_message(payload: dict) -> bytes:
+    """
+    Frame a message payload. Chunk data given as bytes is sent raw after the
+    header, any other payload is sent as a JSON body.
+    """
+    opcode = payload.get(PayloadField.OPERATION_CODE, 0)
+    return_code = payload.get(PayloadField.RETURN_CODE, 0)
+    chunk_data = payload.get(PayloadField.CHUNK_DATA)
+    if isinstance(chunk_data, (bytes, bytearray, memoryview)):
+        return encode_frame(opcode, bytes(chunk_data), return_code,
+                            payload.get(PayloadField.CHUNK_IDX, 0), FRAME_RAW_CHUNK)
+    return encode_frame(opcode, json.dumps(payload).encode(), return_code)
+
+async def _read_header(reader):
+    """Read and check a frame header, or return None if the peer closed the connection between messages"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("connection closed inside frame header")
+
+    fields = FRAME_HEADER.unpack(header)
+    version, length = fields[0], fields[-1]
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"frame of {length} bytes exceeds limit")
+    return header, fields
+
+async def read_message(reader):
+    """
+    Read one framed message and return its payload, or None if the peer
+    closed the connection between messages
+    """
+    result = await _read_header(reader)
+    if result is None:
+        return None
+    _, (version, flags, opcode, return_code, chunk_idx, length) = result
+
+    body = await reader.readexactly(length)
+    if flags == FRAME_RAW_CHUNK:
+        return {
+            PayloadField.OPERATION_CODE: opcode,
+            PayloadField.RETURN_CODE: return_code,
+            PayloadField.CHUNK_IDX: chunk_idx,
+            PayloadField.CHUNK_DATA: body
+        }
+    return json.loads(body)
+
+async def read_frame(reader):
+    """
+    Read one framed message without decoding it (header and body), or
+    None if the peer closed the connection between messages
+    """
+    result = await _read_header(reader)
+    if result is None:
+        return None
+    header, fields = result
+    return header + await reader.readexactly(fields[-1])
+
+def decode_frame(frame: bytes) -> dict:
+    """Payload of a frame returned by read_frame"""
+    version, flags, opcode, return_code, chunk_idx, length = FRAME_HEADER.unpack_from(frame)
+    body = frame[FRAME_HEADER.size:]
+    if flags == FRAME_RAW_CHUNK:
+        return {
+            PayloadField.OPERATION_CODE: opcode,
+            PayloadField.RETURN_CODE: return_code,
+            PayloadField.CHUNK_IDX: chunk_idx,
+            PayloadField.CHUNK_DATA: body
+        }
+    return json.loads(body)
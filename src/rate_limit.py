@@ -0,0 +1,117 @@
+"""
+Rate limiting for p2p file sharing.
+Token buckets that shape chunk traffic to and from peers.
+"""
+import asyncio
+import time
+from protocol import CHUNK_SIZE, RATE_LIMIT_BURST, RATE_LIMIT_QUANTUM
+
+class TokenBucket:
+    """
+    A bucket refilled at `rate` bytes per second, holding at most `burst`
+    bytes. Tokens are refilled lazily from the clock when they are taken,
+    and a transfer may take more than the bucket holds: the bucket goes
+    into debt. Callers only wait once the debt passes a quantum of
+    RATE_LIMIT_QUANTUM seconds of traffic, and then for the whole debt, so
+    at high rates many chunks share one sleep instead of each chunk paying
+    for a timer. A slow sleep only delays the next transfer instead of
+    losing rate. A rate of None is unlimited.
+    """
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        self.clock = clock
+        self.stamp = clock()
+        self.rate = None
+        self.burst = 0
+        self.quantum = 0
+        self.tokens = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate. A bucket that was unlimited starts full; otherwise
+        the tokens saved up so far (or the debt) carry over.
+        """
+        self._refill()
+        was_unlimited = self.rate is None
+        self.rate = rate or None
+        if self.rate is None:
+            self.burst = self.tokens = self.quantum = 0
+            return
+        self.burst = burst or max(CHUNK_SIZE, self.rate * RATE_LIMIT_BURST)
+        self.quantum = self.rate * RATE_LIMIT_QUANTUM
+        self.tokens = self.burst if was_unlimited else min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, amount: int) -> float:
+        """
+        Take amount bytes, return the seconds to wait before sending more:
+        nothing until the debt passes the quantum, then the whole debt
+        """
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if -self.tokens > self.quantum else 0.0
+
+class RateLimiter:
+    """
+    Caps one direction of chunk traffic: in total, per peer and per
+    torrent. A transfer is charged to every bucket it goes through and
+    waits for the slowest. Rates are bytes per second, None for no cap,
+    and can be changed at any time with set_rates().
+    """
+    def __init__(self, rate=None, peer_rate=None, torrent_rate=None, clock=time.monotonic):
+        self.clock = clock
+        self.peer_rate = self.torrent_rate = None
+        self.total = TokenBucket(clock=clock)
+        self.peers = {}  # peer key -> TokenBucket
+        self.torrents = {}  # torrentId -> TokenBucket
+        self.set_rates(rate, peer_rate, torrent_rate)
+
+    @property
+    def rate(self):
+        return self.total.rate
+
+    @property
+    def rates(self) -> tuple:
+        return self.rate, self.peer_rate, self.torrent_rate
+
+    def set_rates(self, rate=None, peer_rate=None, torrent_rate=None):
+        self.total.set_rate(rate)
+        self.peer_rate, self.torrent_rate = peer_rate or None, torrent_rate or None
+        self.limited = any(rate is not None for rate in self.rates)  # checked per chunk, so kept ready
+        for bucket in self.peers.values():
+            bucket.set_rate(self.peer_rate)
+        for bucket in self.torrents.values():
+            bucket.set_rate(self.torrent_rate)
+
+    def _bucket(self, buckets: dict, key, rate) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, clock=self.clock)
+        return bucket
+
+    def delay(self, amount: int, peer=None, torrent=None) -> float:
+        """Charge a transfer of amount bytes, return the seconds it has to wait"""
+        delay = self.total.consume(amount)
+        if self.peer_rate is not None and peer is not None:
+            delay = max(delay, self._bucket(self.peers, peer, self.peer_rate).consume(amount))
+        if self.torrent_rate is not None and torrent is not None:
+            delay = max(delay, self._bucket(self.torrents, torrent, self.torrent_rate).consume(amount))
+        return delay
+
+    async def throttle(self, amount: int, peer=None, torrent=None):
+        """Wait until a transfer of amount bytes fits in every cap"""
+        if not self.limited:
+            return
+        delay = self.delay(amount, peer, torrent)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def forget_peer(self, peer):
+        self.peers.pop(peer, None)
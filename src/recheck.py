@@ -0,0 +1,120 @@
+"""
+Recheck engine for p2p file sharing.
+Hashes the chunks of a file on disk in parallel to find the chunks present and
+rebuild the chunk hash manifest, e.g. when a seeder restarts or a download resumes.
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+from protocol import CHUNK_SIZE, RECHECK_READ_SIZE, RECHECK_RANGE_CHUNKS
+from logger import setup_logger
+
+logger = setup_logger()
+
+def hash_chunk_range(path: str, first: int, last: int, read_size: int = RECHECK_READ_SIZE) -> list:
+    """
+    SHA-256 hex digest of chunks first..last-1. The range is read in large
+    chunk-aligned blocks; chunks past the end of the file are left out.
+    Module level so a process pool can run it.
+    """
+    read_size = max(CHUNK_SIZE, read_size - read_size % CHUNK_SIZE)
+    hashes = []
+    offset, end = first * CHUNK_SIZE, last * CHUNK_SIZE
+    with open(path, 'rb', buffering=0) as f:
+        while offset < end:
+            block = os.pread(f.fileno(), min(read_size, end - offset), offset)
+            if not block:
+                break
+            view = memoryview(block)
+            for pos in range(0, len(block), CHUNK_SIZE):
+                hashes.append(hashlib.sha256(view[pos:pos + CHUNK_SIZE]).hexdigest())
+            offset += len(block)
+    return hashes
+
+class RecheckResult:
+    """
+    Outcome of a recheck: the hash of every chunk that was hashed (None for
+    the others) and the chunks that are present and, if a manifest was
+    given, match it
+    """
+    def __init__(self, hashes: list, have: set):
+        self.hashes = hashes
+        self.have = have
+
+class Recheck:
+    """
+    Hash a file's chunks in parallel. The chunks to check are split into
+    ranges of at most range_chunks chunks and each range is hashed by one
+    worker. hashlib releases the GIL while hashing, so a thread pool keeps
+    every core busy; use_processes switches to a process pool instead.
+    progress(done, total) is called as ranges finish.
+    """
+    def __init__(self, path: str, num_chunks: int = None, expected_hashes=None, chunks=None,
+                 workers: int = None, use_processes=False, range_chunks=RECHECK_RANGE_CHUNKS, progress=None):
+        self.path = path
+        if num_chunks is None:
+            num_chunks = -(-os.path.getsize(path) // CHUNK_SIZE)
+        self.num_chunks = num_chunks
+        self.expected_hashes = list(expected_hashes or [])
+        self.chunks = sorted(idx for idx in (range(num_chunks) if chunks is None else chunks)
+                             if 0 <= idx < num_chunks)
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.range_chunks = range_chunks
+        self.progress = progress or self._log_progress
+        self._done = 0
+        self._logged = 0
+
+    def ranges(self) -> list:
+        """Split the chunks to check into contiguous (first, last) ranges"""
+        ranges = []
+        for idx in self.chunks:
+            if ranges and ranges[-1][1] == idx and idx - ranges[-1][0] < self.range_chunks:
+                ranges[-1][1] = idx + 1
+            else:
+                ranges.append([idx, idx + 1])
+        return [tuple(r) for r in ranges]
+
+    def _executor(self):
+        if self.use_processes:
+            return concurrent.futures.ProcessPoolExecutor(self.workers)
+        return concurrent.futures.ThreadPoolExecutor(self.workers)
+
+    async def run(self) -> RecheckResult:
+        """Recheck without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        hashes = [None] * self.num_chunks
+        executor = self._executor()
+
+        async def hash_range(first, last):
+            return first, await loop.run_in_executor(executor, hash_chunk_range, self.path, first, last)
+        try:
+            for task in asyncio.as_completed([hash_range(first, last) for first, last in self.ranges()]):
+                first, range_hashes = await task
+                self._collect(hashes, first, range_hashes)
+        finally:
+            # Never wait on the loop: when cancelled, drop the queued ranges
+            # and leave the ones being hashed to finish in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self._result(hashes)
+
+    def _collect(self, hashes: list, first: int, range_hashes: list):
+        hashes[first:first + len(range_hashes)] = range_hashes
+        self._done += len(range_hashes)
+        self.progress(self._done, len(self.chunks))
+
+    def _result(self, hashes: list) -> RecheckResult:
+        if self.expected_hashes:
+            have = {idx for idx in self.chunks
+                    if idx < len(self.expected_hashes) and hashes[idx] == self.expected_hashes[idx]}
+        else:
+            have = {idx for idx in self.chunks if hashes[idx] is not None}
+        return RecheckResult(hashes, have)
+
+    def _log_progress(self, done: int, total: int):
+        """Log every 10% of the way"""
+        percent = done * 100 // total if total else 100
+        if percent >= self._logged + 10 or done == total:
+            self._logged = percent
+            logger.info(f"rechecking {self.path}: {done}/{total} chunks ({percent}%)")
@@ -0,0 +1,530 @@
+"""
+Download scheduler for p2p file sharing.
+Keeps several chunk requests in flight per peer and across the swarm,
+choosing which chunk to request next with a rarest-first piece picker.
+Peers that choke us are polled with STATUS_INTERESTED until they unchoke.
+Once only a few chunks remain, idle peers duplicate the outstanding requests
+(endgame) and the losing requests are withdrawn with CANCEL.
+Per-peer throughput, latency and failure statistics decide how many requests
+each peer gets; peers whose throughput collapses are dropped.
+A failed chunk moves to another peer that has it right away; once every
+holder has failed it (one retry round), it is retried with a short jittered
+exponential backoff, for at most max_retries rounds.
+"""
+import asyncio
+import math
+import random
+from protocol import PeerOperation, ReturnCode, PayloadField, MAX_REQUESTS_PER_PEER, MAX_OUTSTANDING_REQUESTS, \
+    CHOKE_POLL_INTERVAL, ENDGAME_THRESHOLD, STATS_INTERVAL, STATS_EWMA_ALPHA, SLOW_PEER_RATIO, \
+    MAX_FAILURE_RATE, MAX_RETRY_BACKOFF
+from peer_pool import backoff_delay
+from logger import setup_logger
+
+logger = setup_logger()
+
+class PiecePicker:
+    """
+    Rarest-first piece selection. Tracks how many peers have each chunk and
+    hands out the wanted chunk with the lowest count, picking randomly
+    among ties. A peer registered without a chunk set has every chunk.
+    """
+    def __init__(self, chunks):
+        self.availability = {idx: 0 for idx in chunks}
+        self.peer_chunks = {}  # peer key -> set of chunk indexes, None if complete
+        self.buckets = {}  # availability -> list of wanted chunk indexes
+        self._slot = {}  # wanted chunk index -> position in its bucket
+
+    def add_peer(self, key, chunks=None):
+        if chunks is None:
+            self.peer_chunks[key] = None
+            for idx in self.availability:
+                self._change_availability(idx, 1)
+            return
+        self.peer_chunks[key] = set()
+        for idx in chunks:
+            self.peer_has(key, idx)
+
+    def remove_peer(self, key):
+        if key not in self.peer_chunks:
+            return
+        chunks = self.peer_chunks.pop(key)
+        for idx in (self.availability if chunks is None else chunks):
+            self._change_availability(idx, -1)
+
+    def peer_has(self, key, idx):
+        """Record that a peer has a chunk (from its bitfield or a HAVE message)"""
+        chunks = self.peer_chunks.get(key)
+        # Unknown or complete peer, untracked chunk, or already counted
+        if chunks is None or idx not in self.availability or idx in chunks:
+            return
+        chunks.add(idx)
+        self._change_availability(idx, 1)
+
+    def has_chunk(self, key, idx) -> bool:
+        if key not in self.peer_chunks:
+            return False
+        chunks = self.peer_chunks[key]
+        return chunks is None or idx in chunks
+
+    def is_complete(self, key) -> bool:
+        return key in self.peer_chunks and self.peer_chunks[key] is None
+
+    def want(self, idx):
+        """Make a chunk available for picking"""
+        if idx not in self._slot:
+            self._add_to_bucket(idx, self.availability[idx])
+
+    def unwant(self, idx):
+        """Stop handing out a chunk"""
+        if idx in self._slot:
+            self._remove_from_bucket(idx)
+
+    def pick(self, key, exclude=()):
+        """
+        Take the rarest wanted chunk the peer has, or None if there is none
+        """
+        chunks = self.peer_chunks.get(key, set())
+        for count in sorted(self.buckets):
+            if count == 0:
+                continue
+            bucket = self.buckets[count]
+            start = random.randrange(len(bucket))
+            for offset in range(len(bucket)):
+                idx = bucket[(start + offset) % len(bucket)]
+                if (chunks is None or idx in chunks) and idx not in exclude:
+                    self._remove_from_bucket(idx)
+                    return idx
+        return None
+
+    def _change_availability(self, idx, delta: int):
+        wanted = idx in self._slot
+        if wanted:
+            self._remove_from_bucket(idx)
+        self.availability[idx] += delta
+        if wanted:
+            self._add_to_bucket(idx, self.availability[idx])
+
+    def _add_to_bucket(self, idx, count: int):
+        bucket = self.buckets.setdefault(count, [])
+        self._slot[idx] = len(bucket)
+        bucket.append(idx)
+
+    def _remove_from_bucket(self, idx):
+        """O(1) removal: move the bucket's last entry into the freed slot"""
+        count = self.availability[idx]
+        bucket = self.buckets[count]
+        pos = self._slot.pop(idx)
+        last = bucket.pop()
+        if last != idx:
+            bucket[pos] = last
+            self._slot[last] = pos
+        if not bucket:
+            del self.buckets[count]
+
+class PeerStats:
+    """
+    Download statistics for one peer: EWMA throughput in bytes/sec, request
+    round-trip time and failure rate. Throughput is sampled over fixed
+    intervals while the peer has requests outstanding, so idle time is not
+    held against it and a stalled peer decays towards zero.
+    """
+    def __init__(self, alpha=STATS_EWMA_ALPHA):
+        self.alpha = alpha
+        self.rate = None  # bytes/sec, None until the first sample
+        self.rtt = None  # seconds
+        self.failure_rate = 0.0
+        self.requests = 0
+        self._window_bytes = 0
+        self._window_start = None
+
+    def _ewma(self, old, sample: float) -> float:
+        return sample if old is None else old + self.alpha * (sample - old)
+
+    def record_success(self, nbytes: int, rtt: float, now: float):
+        self.requests += 1
+        self.rtt = self._ewma(self.rtt, rtt)
+        self.failure_rate = self._ewma(self.failure_rate, 0.0)
+        self._window_bytes += nbytes
+        if self._window_start is None:
+            self._window_start = now - rtt
+
+    def record_failure(self):
+        self.requests += 1
+        self.failure_rate = self._ewma(self.failure_rate, 1.0)
+
+    def sample(self, now: float, busy: bool):
+        """Fold the bytes received since the last sample into the rate"""
+        if self._window_start is None:
+            if busy:
+                self._window_start = now
+            return
+        elapsed = now - self._window_start
+        if elapsed <= 0:
+            return
+        self.rate = self._ewma(self.rate, self._window_bytes / elapsed)
+        self._window_bytes = 0
+        self._window_start = now if busy else None
+
+class DownloadPeer:
+    """
+    A peer the scheduler downloads from
+    """
+    def __init__(self, peer_id, ip, port, complete=True):
+        self.peer_id = peer_id
+        self.ip = ip
+        self.port = port
+        self.key = (ip, int(port))
+        self.complete = complete
+        self.in_flight = 0
+        self.downloaded = 0
+        self.failed = set()
+        self.choked = False
+        self.unchoke_lock = asyncio.Lock()
+        self.stats = PeerStats()
+        self.limit = MAX_REQUESTS_PER_PEER  # requests this peer may have outstanding
+        self.dropped = False
+
+class DownloadScheduler:
+    """
+    Runs up to max_per_peer requests per peer and max_total requests overall.
+    Whenever a peer has a free request slot it takes the rarest chunk it has
+    from the piece picker, so fast peers end up doing most of the work.
+    Peers in `peers` are complete seeders; peers in `partial_peers` are asked
+    for their BITFIELD first and announce new chunks with HAVE.
+    Every stats_interval each peer's limit is rescaled to its share of the
+    best peer's throughput, between 1 and max_per_peer.
+    """
+    def __init__(self, client, peers: dict, partial_peers=None, max_per_peer=MAX_REQUESTS_PER_PEER,
+                 max_total=MAX_OUTSTANDING_REQUESTS, max_retries=3, retry_delay=1, stall_timeout=5,
+                 choke_poll_interval=CHOKE_POLL_INTERVAL, endgame_threshold=ENDGAME_THRESHOLD,
+                 stats_interval=STATS_INTERVAL, slow_peer_ratio=SLOW_PEER_RATIO, max_failure_rate=MAX_FAILURE_RATE):
+        self.client = client
+        self.peers = [DownloadPeer(peer_id, info[PayloadField.IP_ADDRESS], info[PayloadField.PORT])
+                      for peer_id, info in peers.items()]
+        self.peers += [DownloadPeer(peer_id, info[PayloadField.IP_ADDRESS], info[PayloadField.PORT], complete=False)
+                       for peer_id, info in (partial_peers or {}).items()]
+        self.max_per_peer = max_per_peer
+        for peer in self.peers:
+            peer.limit = max_per_peer
+        self.window = asyncio.Semaphore(max_total)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.stall_timeout = stall_timeout
+        self.choke_poll_interval = choke_poll_interval
+        self.endgame_threshold = endgame_threshold
+        self.stats_interval = stats_interval
+        self.slow_peer_ratio = slow_peer_ratio
+        self.max_failure_rate = max_failure_rate
+        self.requested = {}  # chunk index -> keys of peers with a request outstanding
+        self.rounds = {}  # chunk index -> retry rounds in which every holder failed it
+        self.remaining = set()
+        self.failed = set()
+        self.picker = PiecePicker(())
+        self._changed = asyncio.Event()
+        self._done = asyncio.Event()
+        self._loop = None
+        self._pending_retries = 0
+
+    async def run(self, chunks) -> set:
+        """
+        Download the given chunk indexes, return the ones that could not be fetched
+        """
+        self.remaining = set(chunks)
+        if not self.peers:
+            logger.error("no peers to download from")
+            self.failed = set(self.remaining)
+            return self.failed
+
+        self._loop = asyncio.get_running_loop()
+        self.picker = PiecePicker(self.remaining)
+        self.client.scheduler = self
+        self.client.state.interested = True
+        try:
+            await asyncio.gather(*[self._add_peer(peer) for peer in self.peers])
+            for chunk_idx in self.remaining:
+                self.picker.want(chunk_idx)
+
+            workers = [asyncio.create_task(self._worker(peer))
+                       for peer in self.peers for _ in range(self.max_per_peer)]
+            watchdog = asyncio.create_task(self._watch_stalls())
+            tracker = asyncio.create_task(self._track_rates())
+            await self._wait_for_workers(workers)
+            watchdog.cancel()
+            tracker.cancel()
+        finally:
+            self.client.state.interested = False
+            self.client.state.choked = False
+            for peer in self.peers:
+                self.client.send_uninterested(peer.key)
+                self.client.download_limiter.forget_peer(peer.key)
+            if self.client.scheduler is self:
+                self.client.scheduler = None
+        return self.failed
+
+    async def _wait_for_workers(self, workers):
+        """
+        Return once every chunk is downloaded or given up, re-raising worker
+        errors. Workers still waiting on cancelled endgame duplicates are
+        not waited for.
+        """
+        done = asyncio.create_task(self._done.wait())
+        pending = set(workers)
+        try:
+            while pending and not done.done():
+                finished, pending = await asyncio.wait(pending | {done}, return_when=asyncio.FIRST_COMPLETED)
+                pending.discard(done)
+                for task in finished - {done}:
+                    task.result()
+        finally:
+            done.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _add_peer(self, peer: DownloadPeer):
+        """Register a peer with the picker, fetching its bitfield if it is partial"""
+        if peer.complete:
+            self.picker.add_peer(peer.key)
+            return
+        chunks = await self.client.request_bitfield(peer.ip, peer.port)
+        if chunks is None:
+            logger.error(f"no bitfield from peer {peer.peer_id}")
+            chunks = set()
+        self.picker.add_peer(peer.key, chunks)
+
+    async def _watch_stalls(self):
+        """
+        Partial peers may not have the chunks we still need. When nothing is
+        in flight or waiting for a retry, refresh their bitfields; after
+        max_retries idle rounds give up on the chunks nobody can provide.
+        """
+        stalls = 0
+        while self.remaining:
+            await asyncio.sleep(self.stall_timeout)
+            # A choked peer will serve us again after its next rechoke
+            if self._pending_retries or any(peer.in_flight or peer.choked for peer in self.peers):
+                stalls = 0
+                continue
+            stalls += 1
+            if stalls >= self.max_retries:
+                logger.error(f"No peer can provide chunks: {self.remaining}")
+                self.failed |= self.remaining
+                self.remaining = set()
+                self._notify()
+                return
+            for peer in self.peers:
+                if not peer.complete:
+                    self.picker.remove_peer(peer.key)
+            await asyncio.gather(*[self._add_peer(peer) for peer in self.peers if not peer.complete])
+            self._notify()
+
+    async def _track_rates(self):
+        while self.remaining:
+            await asyncio.sleep(self.stats_interval)
+            now = self._loop.time()
+            for peer in self.peers:
+                peer.stats.sample(now, busy=peer.in_flight > 0)
+            self._rebalance()
+
+    def _rebalance(self):
+        """Give faster peers more outstanding requests, drop collapsed ones"""
+        active = [peer for peer in self.peers if not peer.dropped]
+        best = max((peer.stats.rate or 0 for peer in active), default=0)
+        for peer in active:
+            if best and peer.stats.rate is not None:
+                share = peer.stats.rate / best
+                peer.limit = max(1, min(self.max_per_peer, math.ceil(self.max_per_peer * share)))
+            if self._collapsed(peer, best) and self._covered_without(peer):
+                self._drop(peer)
+        self._notify()
+
+    def _collapsed(self, peer: DownloadPeer, best: float) -> bool:
+        stats = peer.stats
+        if stats.requests >= self.max_retries + 1 and stats.failure_rate > self.max_failure_rate:
+            return True
+        return bool(best) and stats.rate is not None and stats.rate < best * self.slow_peer_ratio
+
+    def _covered_without(self, peer: DownloadPeer) -> bool:
+        """Check every remaining chunk the peer has is also held by another active peer"""
+        others = [p.key for p in self.peers if p is not peer and not p.dropped]
+        return all(any(self.picker.has_chunk(key, idx) for key in others)
+                   for idx in self.remaining if self.picker.has_chunk(peer.key, idx))
+
+    def _drop(self, peer: DownloadPeer):
+        logger.info(f"Dropping peer {peer.peer_id}: rate {peer.stats.rate}, "
+                    f"rtt {peer.stats.rtt}, failure rate {peer.stats.failure_rate:.2f}")
+        peer.dropped = True
+        self.picker.remove_peer(peer.key)
+        self.client.download_limiter.forget_peer(peer.key)
+        # Hand chunks stuck on the dropped peer to the others
+        for idx, keys in self.requested.items():
+            if keys == {peer.key}:
+                self.picker.want(idx)
+
+    def peer_has(self, ip, port, chunk_idx: int):
+        """
+        Record a HAVE message from a peer. Called by the client's peer
+        server, which runs on the same loop as the scheduler.
+        """
+        self.picker.peer_has((ip, int(port)), chunk_idx)
+        self._notify()
+
+    def _notify(self):
+        """Wake up every worker waiting for new work"""
+        self._changed.set()
+        self._changed = asyncio.Event()
+        if not self.remaining:
+            self._done.set()
+
+    async def _worker(self, peer: DownloadPeer):
+        while self.remaining and not peer.dropped:
+            if peer.choked:
+                await self._wait_unchoke(peer)
+                continue
+            if not self.client.peer_pool.is_available(peer.ip, peer.port):
+                await self._wait_available(peer)
+                continue
+            changed = self._changed
+            async with self.window:
+                if peer.in_flight >= peer.limit:
+                    chunk_idx = None
+                else:
+                    chunk_idx = self.picker.pick(peer.key, exclude=peer.failed)
+                if chunk_idx is None and peer.in_flight < peer.limit:
+                    chunk_idx = self._pick_endgame(peer)
+                if chunk_idx is not None:
+                    result = await self._fetch(peer, chunk_idx)
+                    if chunk_idx not in self.remaining:
+                        continue  # another peer delivered it first, or it was given up
+                    if result == ReturnCode.SUCCESS:
+                        self._complete(peer, chunk_idx)
+                    elif result == ReturnCode.CHOKED:
+                        self._choked(peer, chunk_idx)
+                    else:
+                        self._retry(peer, chunk_idx)
+                    continue
+            await changed.wait()
+
+    @property
+    def in_endgame(self) -> bool:
+        return len(self.remaining) <= self.endgame_threshold
+
+    def _pick_endgame(self, peer: DownloadPeer):
+        """
+        Duplicate the outstanding request with the fewest copies that this
+        peer can serve, or None outside endgame
+        """
+        if not self.in_endgame:
+            return None
+        candidates = [idx for idx, keys in self.requested.items()
+                      if keys and peer.key not in keys and idx not in peer.failed
+                      and self.picker.has_chunk(peer.key, idx)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda idx: len(self.requested[idx]))
+
+    async def _fetch(self, peer: DownloadPeer, chunk_idx: int) -> ReturnCode:
+        request = self.client.create_peer_request(PeerOperation.GET_CHUNK, chunk_idx)
+        peer.in_flight += 1
+        self.requested.setdefault(chunk_idx, set()).add(peer.key)
+        if self.in_endgame:
+            self._notify()  # let idle peers duplicate the new request
+        started = self._loop.time()
+        try:
+            result = await self.client.connect_to_peer(peer.ip, peer.port, request)
+        except Exception as e:
+            logger.error(f"Error downloading chunk {chunk_idx}: {str(e)}")
+            result = ReturnCode.FAIL
+        finally:
+            peer.in_flight -= 1
+            self.requested[chunk_idx].discard(peer.key)
+            if not self.requested[chunk_idx]:
+                del self.requested[chunk_idx]
+
+        if result in (ReturnCode.CHOKED, ReturnCode.CANCELLED):
+            return result
+        if result == ReturnCode.SUCCESS and self.client.chunk_buffer.has_chunk(chunk_idx):
+            logger.debug(f"Successfully downloaded chunk {chunk_idx} from peer {peer.peer_id}")
+            now = self._loop.time()
+            peer.stats.record_success(self.client.chunk_buffer.chunk_length(chunk_idx), now - started, now)
+            return ReturnCode.SUCCESS
+        logger.error(f"Failed to download chunk {chunk_idx} from peer {peer.peer_id}")
+        peer.stats.record_failure()
+        return ReturnCode.FAIL
+
+    def _choked(self, peer: DownloadPeer, chunk_idx: int):
+        """A choke is not a failure: hand the chunk straight back to the picker"""
+        logger.debug(f"Choked by peer {peer.peer_id}")
+        peer.choked = True
+        self.client.state.choked = all(p.choked for p in self.peers)
+        if chunk_idx not in self.requested:
+            self.picker.want(chunk_idx)
+        self._notify()
+
+    async def _wait_unchoke(self, peer: DownloadPeer):
+        """Poll a choking peer with STATUS_INTERESTED; one worker per peer polls"""
+        async with peer.unchoke_lock:
+            while peer.choked and self.remaining and not peer.dropped:
+                try:
+                    await asyncio.wait_for(self._done.wait(), self.choke_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                if self.remaining:
+                    peer.choked = not await self.client.send_interested(peer.ip, peer.port)
+            self.client.state.choked = all(p.choked for p in self.peers)
+
+    async def _wait_available(self, peer: DownloadPeer):
+        """Sit out the peer's open circuit breaker; the next request after it is the probe"""
+        retry_in = self.client.peer_pool.breaker(peer.key).retry_in()
+        try:
+            await asyncio.wait_for(self._changed.wait(), retry_in or None)
+        except asyncio.TimeoutError:
+            pass
+
+    def _complete(self, peer: DownloadPeer, chunk_idx: int):
+        peer.downloaded += 1
+        self.remaining.discard(chunk_idx)
+        self.picker.unwant(chunk_idx)
+        for key in self.requested.get(chunk_idx, ()):
+            self.client.send_cancel(key, chunk_idx)
+        partial_peers = [p.key for p in self.peers if not p.dropped and not self.picker.is_complete(p.key)]
+        if partial_peers:
+            self.client.broadcast_have(chunk_idx, partial_peers)
+        self._notify()
+
+    def _retry(self, peer: DownloadPeer, chunk_idx: int):
+        """
+        Hand a failed chunk to another peer that has it. Once every holder
+        has failed it the round is over: give up after max_retries rounds,
+        otherwise retry it after a backoff starting at retry_delay
+        """
+        peer.failed.add(chunk_idx)
+        if chunk_idx in self.requested:
+            return  # a duplicate request is still outstanding elsewhere
+        holders = [p for p in self.peers if self.picker.has_chunk(p.key, chunk_idx)]
+        if any(chunk_idx not in p.failed for p in holders):
+            self.picker.want(chunk_idx)
+            self._notify()
+            return
+        self.rounds[chunk_idx] = self.rounds.get(chunk_idx, 0) + 1
+        if self.rounds[chunk_idx] >= self.max_retries:
+            logger.error(f"Giving up on chunk {chunk_idx} after {self.max_retries} rounds")
+            self.failed.add(chunk_idx)
+            self.remaining.discard(chunk_idx)
+            self._notify()
+            return
+        self._pending_retries += 1
+        delay = backoff_delay(self.retry_delay, self.rounds[chunk_idx], cap=MAX_RETRY_BACKOFF)
+        self._loop.call_later(delay, self._requeue, chunk_idx)
+
+    def _requeue(self, chunk_idx: int):
+        self._pending_retries -= 1
+        if chunk_idx not in self.remaining:
+            return
+        # Every peer holding the chunk already failed it once: let them all try again
+        holders = [p for p in self.peers if self.picker.has_chunk(p.key, chunk_idx)]
+        if all(chunk_idx in p.failed for p in holders):
+            for p in holders:
+                p.failed.discard(chunk_idx)
+        self.picker.want(chunk_idx)
+        self._notify()
@@ -0,0 +1,23 @@
+"""
+Shared test helpers
+"""
+import asyncio
+
+def async_test(f):
+    """Run an async test method on a fresh event loop"""
+    def wrapper(*args, **kwargs):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(f(*args, **kwargs))
+        finally:
+            loop.close()
+    return wrapper
+
+class FakeClock:
+    """A clock that only moves when a test sets `now`"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,82 @@
+"""
+Tests for UploadChoker class
+"""
+import unittest
+from choker import UploadChoker
+from tests.helpers import FakeClock
+
+class TestUploadChoker(unittest.TestCase):
+    def setUp(self):
+        """Set up a choker with two regular slots"""
+        self.clock = FakeClock()
+        self.choker = UploadChoker(upload_slots=2, rechoke_interval=10, optimistic_interval=30, clock=self.clock)
+
+    def test_free_slots_given_immediately(self):
+        """Test new peers are unchoked until the regular slots are full"""
+        self.assertTrue(self.choker.allow("a"))
+        self.assertTrue(self.choker.allow("b"))
+        self.assertFalse(self.choker.allow("c"))
+        self.assertTrue(self.choker.allow("a"))
+
+    def test_uninterested_peer_frees_slot(self):
+        """Test a peer that loses interest gives its slot to the next one"""
+        self.choker.allow("a")
+        self.choker.allow("b")
+        self.assertFalse(self.choker.set_interested("a", False))
+        self.assertTrue(self.choker.set_interested("c", True))
+
+    def test_rechoke_prefers_peers_that_upload_to_us(self):
+        """Test tit-for-tat: the best uploaders to us get the regular slots"""
+        for key in "abcd":
+            self.choker.allow(key)
+        self.choker.record_download("c", 5000)
+        self.choker.record_download("d", 9000)
+        self.clock.now = 10
+        self.choker.rechoke()
+
+        unchoked = {key for key, peer in self.choker.peers.items() if peer.unchoked}
+        self.assertTrue({"c", "d"} <= unchoked)
+        # One more peer holds the optimistic unchoke
+        self.assertEqual(len(unchoked), 3)
+        self.assertIn(self.choker.optimistic, {"a", "b"})
+
+    def test_seeding_ranks_by_upload_rate(self):
+        """Test a seeder keeps the peers it uploads to fastest"""
+        self.choker.seeding = lambda: True
+        for key in "abc":
+            self.choker.allow(key)
+        self.choker.record_upload("b", 8000)
+        self.choker.record_upload("c", 4000)
+        self.clock.now = 10
+        self.choker.rechoke()
+
+        self.assertTrue(self.choker.peers["b"].unchoked)
+        self.assertTrue(self.choker.peers["c"].unchoked)
+        self.assertEqual(self.choker.optimistic, "a")
+
+    def test_optimistic_unchoke_rotates(self):
+        """Test the optimistic slot moves to another choked peer after its interval"""
+        for key in "abcd":
+            self.choker.allow(key)
+        self.choker.record_download("a", 100)
+        self.choker.record_download("b", 100)
+        self.clock.now = 10
+        self.choker.rechoke()
+        first = self.choker.optimistic
+
+        self.clock.now = 40
+        self.choker.record_download("a", 100)
+        self.choker.record_download("b", 100)
+        self.choker.rechoke()
+        self.assertIn(self.choker.optimistic, {"c", "d"} - {first})
+
+    def test_disconnect_forgets_peer(self):
+        """Test a disconnected peer no longer holds a slot"""
+        self.choker.allow("a")
+        self.choker.allow("b")
+        self.choker.disconnect("a")
+        self.assertNotIn("a", self.choker.peers)
+        self.assertTrue(self.choker.allow("c"))
+
+if __name__ == '__main__':
+    unittest.main()
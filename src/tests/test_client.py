@@ -3,8 +3,19 @@ Tests for Client class
 """
 import unittest
 import asyncio
+import base64
+import hashlib
+import os
+import tempfile
+import socket
+import unittest.mock
 from client import Client, ClientHelper
-from protocol import PeerOperation, PeerServerOperation, ReturnCode, PayloadField
+from tracker import TrackerServer
+from upload_workers import upload_client
+from file_handler import OutputFile
+from file_chunk import Chunk, unpack_bitfield
+from protocol import PeerOperation, PeerServerOperation, ReturnCode, PayloadField, CHUNK_SIZE, \
+    LIST_PAGE_SIZE, encode_message, read_message, pack_compact_peer
 
 class TestClient(unittest.TestCase):
     def setUp(self):
@@ -34,6 +45,53 @@ class TestClient(unittest.TestCase):
         )
         self.assertEqual(request[PayloadField.OPERATION_CODE], PeerServerOperation.GET_TORRENT)
         self.assertEqual(request[PayloadField.TORRENT_ID], 1)
+        self.assertTrue(request[PayloadField.COMPACT])
+
+    def test_scrape(self):
+        """Test scrape requests carry the torrent ids and the counters are kept"""
+        request = self.client.create_server_request(PeerServerOperation.SCRAPE, torrent_id=[1, 2])
+        self.assertEqual(request[PayloadField.TORRENT_IDS], [1, 2])
+        result = asyncio.run(self.client.handle_server_response({
+            PayloadField.OPERATION_CODE: PeerServerOperation.SCRAPE,
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS,
+            PayloadField.SWARM_COUNTS: [[1, 3, 2, 5]]
+        }))
+        self.assertEqual(result, ReturnCode.SUCCESS)
+        self.assertEqual(self.client.swarm_counts, {1: (3, 2, 5)})
+
+    def test_compact_peer_list(self):
+        """Test compact peers are decoded and the client's own address is left out"""
+        packed = pack_compact_peer("10.0.0.2", 9001) + pack_compact_peer("127.0.0.1", 8000)
+        torrent = {
+            PayloadField.SEEDER_LIST: {"peer": {PayloadField.IP_ADDRESS: "::1", PayloadField.PORT: "9002"}},
+            PayloadField.COMPACT_SEEDERS: base64.b64encode(packed).decode()
+        }
+        peers = self.client._peer_list(torrent, PayloadField.SEEDER_LIST, PayloadField.COMPACT_SEEDERS)
+        self.assertEqual(peers, {
+            "peer": {PayloadField.IP_ADDRESS: "::1", PayloadField.PORT: "9002"},
+            "10.0.0.2:9001": {PayloadField.IP_ADDRESS: "10.0.0.2", PayloadField.PORT: "9001"}
+        })
+
+    def test_torrent_list_version_cached(self):
+        """Test GET_LIST sends the cached version and NOT_MODIFIED reuses the cached list"""
+        torrents = [{PayloadField.TORRENT_ID: 0, PayloadField.FILE_NAME: "a.bin", PayloadField.NUM_OF_CHUNKS: 1,
+                     PayloadField.SEEDER_LIST: {}, PayloadField.LEECHER_LIST: {}}]
+        self.assertNotIn(PayloadField.VERSION, self.client.create_server_request(PeerServerOperation.GET_LIST))
+        asyncio.run(self.client.handle_server_response({
+            PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST,
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS,
+            PayloadField.TORRENT_LIST: torrents,
+            PayloadField.VERSION: 7
+        }))
+        self.assertEqual(self.client.create_server_request(PeerServerOperation.GET_LIST)[PayloadField.VERSION], 7)
+
+        result = asyncio.run(self.client.handle_server_response({
+            PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST,
+            PayloadField.RETURN_CODE: ReturnCode.NOT_MODIFIED,
+            PayloadField.VERSION: 7
+        }))
+        self.assertEqual(result, ReturnCode.SUCCESS)
+        self.assertEqual(self.client.torrent_list, torrents)
 
     def test_handle_peer_request_get_peers(self):
         """Test handling peer request for getting peers"""
@@ -46,6 +104,412 @@ class TestClient(unittest.TestCase):
         self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
         self.assertIn(PayloadField.PEER_LIST, response)
 
+    def test_handle_peer_response_verifies_chunk_hash(self):
+        """Test chunks that do not match the manifest are rejected"""
+        self.client.chunk_buffer.set_buffer(2)
+        self.client.chunk_buffer.set_hashes([hashlib.sha256(b"good").hexdigest()] * 2)
+        response = {
+            PayloadField.OPERATION_CODE: PeerOperation.GET_CHUNK,
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS,
+            PayloadField.CHUNK_IDX: 0,
+            PayloadField.CHUNK_DATA: b"bad"
+        }
+        self.assertEqual(self.client.handle_peer_response(response), -1)
+        self.assertFalse(self.client.chunk_buffer.has_chunk(0))
+
+        response[PayloadField.CHUNK_DATA] = b"good"
+        self.assertEqual(self.client.handle_peer_response(response), ReturnCode.SUCCESS)
+        self.assertTrue(self.client.chunk_buffer.has_chunk(0))
+
+    def test_handle_peer_request_bitfield(self):
+        """Test BITFIELD reports exactly the chunks held"""
+        self.client.chunk_buffer.set_buffer(10)
+        for idx in (0, 3, 9):
+            self.client.chunk_buffer.add_data(Chunk(idx, b"x"))
+        request = self.client.create_peer_request(PeerOperation.BITFIELD)
+        response = self.client.handle_peer_request(request)
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+        bitfield = base64.b64decode(response[PayloadField.BITFIELD])
+        self.assertEqual(unpack_bitfield(bitfield, 10), {0, 3, 9})
+
+    def test_handle_peer_request_have(self):
+        """Test HAVE gets no response and reaches the active scheduler"""
+        received = []
+
+        class Scheduler:
+            def peer_has(self, ip, port, chunk_idx):
+                received.append((ip, port, chunk_idx))
+
+        self.client.scheduler = Scheduler()
+        request = Client("127.0.0.2", "8005").create_peer_request(PeerOperation.HAVE, 4)
+        self.assertIsNone(self.client.handle_peer_request(request))
+        self.assertEqual(received, [("127.0.0.2", "8005", 4)])
+
+    def test_choked_peer_refused_without_data(self):
+        """Test a GET_CHUNK from a choked peer is refused cheaply"""
+        self.client.chunk_buffer.set_buffer(1)
+        self.client.chunk_buffer.add_data(Chunk(0, b"data"))
+        self.client.choker.upload_slots = 1
+        first = Client("127.0.0.2", "8005").create_peer_request(PeerOperation.GET_CHUNK, 0)
+        second = Client("127.0.0.3", "8006").create_peer_request(PeerOperation.GET_CHUNK, 0)
+
+        self.assertEqual(self.client.handle_peer_request(first)[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+        response = self.client.handle_peer_request(second)
+        self.assertEqual(response[PayloadField.OPERATION_CODE], PeerOperation.STATUS_CHOKED)
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.CHOKED)
+        self.assertNotIn(PayloadField.CHUNK_DATA, response)
+        self.assertEqual(self.client.handle_peer_response(response), ReturnCode.CHOKED)
+
+    def test_interested_answers_with_choke_state(self):
+        """Test STATUS_INTERESTED is answered with the peer's choke state"""
+        self.client.choker.upload_slots = 1
+        first = Client("127.0.0.2", "8005").create_peer_request(PeerOperation.STATUS_INTERESTED)
+        second = Client("127.0.0.3", "8006").create_peer_request(PeerOperation.STATUS_INTERESTED)
+        self.assertEqual(self.client.handle_peer_request(first)[PayloadField.OPERATION_CODE],
+                         PeerOperation.STATUS_UNCHOKED)
+        self.assertEqual(self.client.handle_peer_request(second)[PayloadField.OPERATION_CODE],
+                         PeerOperation.STATUS_CHOKED)
+
+        uninterested = Client("127.0.0.2", "8005").create_peer_request(PeerOperation.STATUS_UNINTERESTED)
+        self.assertIsNone(self.client.handle_peer_request(uninterested))
+        self.assertEqual(self.client.handle_peer_request(second)[PayloadField.OPERATION_CODE],
+                         PeerOperation.STATUS_UNCHOKED)
+
+class TestZeroCopySeeding(unittest.TestCase):
+    def setUp(self):
+        """Write a file of two and a half chunks to seed"""
+        self.data = os.urandom(CHUNK_SIZE * 2 + CHUNK_SIZE // 2)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.seeder = Client("127.0.0.1", "8001")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_upload_does_not_load_file(self):
+        """Test uploading in zero-copy mode keeps chunk data on disk"""
+        num_chunks = asyncio.run(self.seeder.helper.upload_file(self.path))
+        self.assertEqual(num_chunks, 3)
+        self.assertTrue(self.seeder.chunk_buffer.is_file_backed)
+        self.assertEqual(self.seeder.chunk_buffer.get_buffer(), [0, 0, 0])
+        self.assertEqual(self.seeder.chunk_buffer.chunk_range(2), (CHUNK_SIZE * 2, CHUNK_SIZE // 2))
+        self.assertEqual(self.seeder.chunk_buffer.get_data(2), self.data[CHUNK_SIZE * 2:])
+        self.assertEqual(self.seeder.chunk_buffer.chunk_hashes[0],
+                         hashlib.sha256(self.data[:CHUNK_SIZE]).hexdigest())
+
+    def test_chunks_served_with_sendfile(self):
+        """Test a leecher receives the exact file bytes served from disk"""
+        asyncio.run(self.seeder.helper.upload_file(self.path))
+        leecher = Client("127.0.0.1", "8002")
+        leecher.chunk_buffer.set_buffer(3)
+
+        async def run():
+            server = await asyncio.start_server(self.seeder.receive_peer_request, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                results = await asyncio.gather(*[
+                    leecher.connect_to_peer("127.0.0.1", port, leecher.create_peer_request(PeerOperation.GET_CHUNK, idx))
+                    for idx in range(3)
+                ])
+                leecher.peer_pool.close_all()
+                await asyncio.sleep(0.05)
+            return results
+
+        results = asyncio.run(run())
+        self.assertEqual(results, [ReturnCode.SUCCESS] * 3)
+        received = b"".join(leecher.chunk_buffer.get_data(idx) for idx in range(3))
+        self.assertEqual(received, self.data)
+
+def free_port() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return str(s.getsockname()[1])
+
+class TestSeedingServer(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(CHUNK_SIZE * 3)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def fetch_all(self, port: str) -> list:
+        """Fetch every chunk over separate connections, as different leechers would"""
+        async def fetch(idx):
+            leecher = Client("127.0.0.1", str(9000 + idx))
+            leecher.chunk_buffer.set_buffer(3)
+            result = await leecher.connect_to_peer("127.0.0.1", port,
+                                                   leecher.create_peer_request(PeerOperation.GET_CHUNK, idx))
+            leecher.peer_pool.close_all()
+            return result, leecher.chunk_buffer.get_data(idx)
+        return [fetch(idx) for idx in range(3)]
+
+    def test_seeding_runs_on_the_callers_loop(self):
+        """Test the peer server and announcer are tasks of the running loop and stop on close"""
+        seeder = Client("127.0.0.1", free_port())
+        asyncio.run(seeder.helper.upload_file(self.path))
+        seeder.state.seeding = True
+
+        async def run():
+            await seeder.start_seeding()
+            server, announcer = seeder.seeding_server, seeder.announcer
+            await seeder.start_seeding()
+            self.assertIs(seeder.seeding_server, server)
+            self.assertIs(asyncio.get_running_loop(), announcer.get_loop())
+            results = await asyncio.gather(*self.fetch_all(seeder.port))
+            seeder.close()
+            await asyncio.sleep(0)
+            self.assertTrue(announcer.cancelled())
+            self.assertFalse(server.is_serving())
+            return results
+
+        results = asyncio.run(run())
+        self.assertEqual([r for r, _ in results], [ReturnCode.SUCCESS] * 3)
+        self.assertEqual(b"".join(data for _, data in results), self.data)
+
+    def test_upload_workers_serve_the_seed(self):
+        """Test a complete seed is served by worker processes sharing the port"""
+        seeder = Client("127.0.0.1", free_port(), upload_workers=2)
+        asyncio.run(seeder.helper.upload_file(self.path))
+        seeder.state.seeding = True
+
+        async def run():
+            await seeder.start_seeding()
+            try:
+                self.assertEqual(len(seeder.uploaders.processes), 2)
+                # Leave the workers the port alone, they must answer on their own
+                seeder.seeding_server.close()
+                for attempt in range(100):  # spawned workers take a moment to start listening
+                    results = await asyncio.gather(*self.fetch_all(seeder.port))
+                    if all(result == ReturnCode.SUCCESS for result, _ in results):
+                        break
+                    await asyncio.sleep(0.1)
+                return results
+            finally:
+                processes = seeder.uploaders.processes
+                seeder.close()
+                self.assertFalse(any(process.is_alive() for process in processes))
+
+        results = asyncio.run(run())
+        self.assertEqual([r for r, _ in results], [ReturnCode.SUCCESS] * 3)
+        self.assertEqual(b"".join(data for _, data in results), self.data)
+
+class TestRateLimits(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(CHUNK_SIZE * 4)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def transfer(self, seeder, leecher) -> float:
+        """Seconds the leecher takes to fetch all four chunks from the seeder"""
+        leecher.chunk_buffer.set_buffer(4)
+
+        async def run():
+            server = await asyncio.start_server(seeder.receive_peer_request, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                start = asyncio.get_running_loop().time()
+                results = await asyncio.gather(*[
+                    leecher.connect_to_peer("127.0.0.1", port, leecher.create_peer_request(PeerOperation.GET_CHUNK, idx))
+                    for idx in range(4)
+                ])
+                elapsed = asyncio.get_running_loop().time() - start
+                leecher.peer_pool.close_all()
+                await asyncio.sleep(0.05)
+            self.assertEqual(results, [ReturnCode.SUCCESS] * 4)
+            return elapsed
+        return asyncio.run(run())
+
+    def test_upload_limit(self):
+        """Test a seeder with an upload cap sends the chunks after the first at the capped rate"""
+        for zero_copy in (True, False):
+            seeder = Client("127.0.0.1", "8001", zero_copy=zero_copy)
+            asyncio.run(seeder.helper.upload_file(self.path))
+            seeder.set_rate_limits(upload=(CHUNK_SIZE * 10, None, None))
+            elapsed = self.transfer(seeder, Client("127.0.0.1", "8002"))
+            self.assertGreaterEqual(elapsed, 0.25)  # 3 chunks past the burst at 10 chunks/s
+
+    def test_download_limit_per_peer(self):
+        """Test a leecher with a per-peer download cap spaces out its requests"""
+        seeder = Client("127.0.0.1", "8001")
+        asyncio.run(seeder.helper.upload_file(self.path))
+        leecher = Client("127.0.0.1", "8002")
+        leecher.set_rate_limits(download=(None, CHUNK_SIZE * 10, None))
+        self.assertGreaterEqual(self.transfer(seeder, leecher), 0.25)
+
+    def test_upload_worker_per_torrent_limit(self):
+        """Test an upload worker charges its uploads to the torrent's cap"""
+        worker = upload_client("127.0.0.1", "8001", self.path, [], (None, None, CHUNK_SIZE * 10), torrent_id=3)
+        self.assertGreaterEqual(self.transfer(worker, Client("127.0.0.1", "8002")), 0.25)
+        self.assertIn(3, worker.upload_limiter.torrents)
+
+    def test_upload_caps_shared_with_workers(self):
+        """Test upload workers and the client split the total and per-torrent caps"""
+        client = Client("127.0.0.1", "8001")
+        client.set_rate_limits(upload=(3000, 100, 600))
+        self.assertEqual(client.upload_limiter.rates, (3000, 100, 600))
+        client.uploaders = unittest.mock.Mock(count=2)
+        client.set_rate_limits(upload=(3000, 100, 600))
+        self.assertEqual(client.upload_limiter.rates, (1000, 100, 200))
+        client.stop_upload_workers()
+        self.assertEqual(client.upload_limiter.rates, (3000, 100, 600))
+
+class TestPartialSeeding(unittest.TestCase):
+    def test_leecher_serves_chunks_it_has(self):
+        """Test a client still downloading serves written chunks and refuses the rest"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            leecher = Client("127.0.0.1", "8001")
+            output = OutputFile(os.path.join(tmpdir, "partial.bin"), 3, CHUNK_SIZE * 3)
+            output.open()
+            leecher.chunk_buffer.set_output(output)
+            other = Client("127.0.0.1", "8002")
+            other.chunk_buffer.set_buffer(3)
+
+            async def run():
+                leecher.chunk_buffer.add_data(Chunk(1, b"y" * CHUNK_SIZE))
+                await leecher.chunk_buffer.flush(1)
+                server = await asyncio.start_server(leecher.receive_peer_request, "127.0.0.1", 0)
+                port = server.sockets[0].getsockname()[1]
+                async with server:
+                    bitfield = await other.request_bitfield("127.0.0.1", port)
+                    results = [await other.connect_to_peer("127.0.0.1", port,
+                                                           other.create_peer_request(PeerOperation.GET_CHUNK, idx))
+                               for idx in (0, 1)]
+                    other.peer_pool.close_all()
+                    await asyncio.sleep(0.05)
+                return bitfield, results
+
+            bitfield, results = asyncio.run(run())
+            leecher.chunk_buffer.close_output()
+
+        self.assertEqual(bitfield, {1})
+        self.assertEqual(results, [-1, ReturnCode.SUCCESS])
+        self.assertEqual(other.chunk_buffer.get_data(1), b"y" * CHUNK_SIZE)
+
+class TestCancel(unittest.TestCase):
+    def test_cancelled_request_refused_without_data(self):
+        """Test a CANCEL that overtakes its queued GET_CHUNK stops the data being sent"""
+        seeder = Client("127.0.0.1", "8001")
+        seeder.chunk_buffer.set_buffer(3)
+        for idx in range(3):
+            seeder.chunk_buffer.add_data(Chunk(idx, b"z" * CHUNK_SIZE))
+        leecher = Client("127.0.0.1", "8002")
+
+        async def run():
+            server = await asyncio.start_server(seeder.receive_peer_request, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                messages = [leecher.create_peer_request(PeerOperation.GET_CHUNK, idx) for idx in range(3)]
+                messages.append(leecher.create_peer_request(PeerOperation.CANCEL, 2))
+                writer.write(b"".join(encode_message(message) for message in messages))
+                await writer.drain()
+                responses = [await read_message(reader) for _ in range(3)]
+                writer.close()
+            return responses
+
+        responses = asyncio.run(run())
+        self.assertEqual([r[PayloadField.RETURN_CODE] for r in responses],
+                         [ReturnCode.SUCCESS, ReturnCode.SUCCESS, ReturnCode.CANCELLED])
+        self.assertNotIn(PayloadField.CHUNK_DATA, responses[2])
+        self.assertEqual(leecher.handle_peer_response(responses[2]), ReturnCode.CANCELLED)
+
+class TestAnnounce(unittest.TestCase):
+    def test_announce_registers_again_after_expiry(self):
+        """Test a seeder the tracker forgot registers again on its next announce"""
+        async def run():
+            tracker = TrackerServer(announce_interval=7)
+            server = await asyncio.start_server(tracker.receive_request, "127.0.0.1", 0)
+            client = Client("127.0.0.1", "8000")
+            client.tracker_addr = ("127.0.0.1", server.sockets[0].getsockname()[1])
+            client.start_seeding = unittest.mock.AsyncMock()
+            async with server:
+                tracker.add_new_file({PayloadField.PEER_ID: client.id, PayloadField.IP_ADDRESS: "127.0.0.1",
+                                      PayloadField.PORT: "8000", PayloadField.FILE_NAME: "file.bin",
+                                      PayloadField.NUM_OF_CHUNKS: 1})
+                tracker.add_new_file({PayloadField.PEER_ID: "other", PayloadField.IP_ADDRESS: "127.0.0.1",
+                                      PayloadField.PORT: "8001", PayloadField.FILE_NAME: "file.bin",
+                                      PayloadField.NUM_OF_CHUNKS: 1})
+                client.state.seeding, client.torrent_id = True, 0
+                self.assertEqual(await client.announce(), ReturnCode.SUCCESS)
+                self.assertEqual(client.announce_interval, 7)
+
+                tracker.remove_peer(client.id)
+                self.assertEqual(await client.announce(), ReturnCode.SUCCESS)
+                self.assertIn(client.id, tracker.torrents[0].seeders)
+        asyncio.run(run())
+
+class TestTorrentList(unittest.TestCase):
+    def test_all_pages_fetched(self):
+        """Test GET_LIST follows the pages until every torrent is listed"""
+        async def run():
+            tracker = TrackerServer()
+            for idx in range(LIST_PAGE_SIZE * 2 + 5):
+                tracker.add_new_file({PayloadField.PEER_ID: f"peer{idx}", PayloadField.IP_ADDRESS: "127.0.0.1",
+                                      PayloadField.PORT: "8001", PayloadField.FILE_NAME: f"file{idx}.bin",
+                                      PayloadField.NUM_OF_CHUNKS: 1})
+            server = await asyncio.start_server(tracker.receive_request, "127.0.0.1", 0)
+            client = Client("127.0.0.1", "8000")
+            client.tracker_addr = ("127.0.0.1", server.sockets[0].getsockname()[1])
+            async with server:
+                with unittest.mock.patch('builtins.print'):
+                    result = await client.tracker_request(PeerServerOperation.GET_LIST)
+                client.tracker.close()
+            return client, result, tracker.version
+        client, result, version = asyncio.run(run())
+        self.assertEqual(result, ReturnCode.SUCCESS)
+        self.assertEqual([t[PayloadField.TORRENT_ID] for t in client.torrent_list], list(range(LIST_PAGE_SIZE * 2 + 5)))
+        self.assertEqual(client.torrent_list_version, version)
+
+class TestResume(unittest.TestCase):
+    def test_interrupted_download_fetches_only_missing_chunks(self):
+        """Test a restarted download re-verifies saved chunks and fetches the rest"""
+        data = [os.urandom(CHUNK_SIZE) for _ in range(4)]
+        hashes = [hashlib.sha256(chunk).hexdigest() for chunk in data]
+        client = Client("127.0.0.1", "8000")
+        client.seeder_list = {"peer": {PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8001"}}
+        requested = []
+        unavailable = {3}
+
+        async def connect_to_peer(ip, port, request):
+            idx = request[PayloadField.CHUNK_IDX]
+            requested.append(idx)
+            if idx in unavailable:
+                return ReturnCode.FAIL  # the first run ends without the last chunk
+            client.chunk_buffer.add_data(Chunk(idx, data[idx]))
+            await client.chunk_buffer.flush(idx)
+            return ReturnCode.SUCCESS
+        client.connect_to_peer = connect_to_peer
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            async def run():
+                first = await client.helper.download_file(4, "file.bin", CHUNK_SIZE * 4, hashes, output_dir=tmpdir)
+                # Corrupt a saved chunk behind the resume file's back
+                path = os.path.join(tmpdir, f"{client.id}_file.bin")
+                with open(path, "r+b") as f:
+                    f.seek(CHUNK_SIZE)
+                    f.write(b"garbage")
+                requested.clear()
+                unavailable.clear()
+                second = await client.helper.download_file(4, "file.bin", CHUNK_SIZE * 4, hashes, output_dir=tmpdir)
+                return first, second, path
+
+            with unittest.mock.patch("scheduler.backoff_delay", return_value=0):
+                first, second, path = asyncio.run(run())
+            self.assertFalse(first)
+            self.assertTrue(second)
+            self.assertEqual(sorted(set(requested)), [1, 3])
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"".join(data))
+            self.assertFalse(os.path.exists(path + ".resume"))
+
 class TestClientHelper(unittest.TestCase):
     def setUp(self):
         """Set up test fixtures"""
@@ -0,0 +1,82 @@
+"""
+Tests for the client command line handler
+"""
+import unittest
+import asyncio
+import os
+import sys
+import unittest.mock
+import client_handler
+from client_handler import Console, get_user_choice, parse_rates, SET_RATE_LIMITS
+from protocol import PeerServerOperation
+
+class TestConsole(unittest.TestCase):
+    def run_with_stdin(self, test):
+        """Run test(writer) with stdin reading from a pipe that writer feeds"""
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'r') as stdin, os.fdopen(write_fd, 'wb', buffering=0) as writer, \
+                unittest.mock.patch.object(sys, 'stdin', stdin):
+            asyncio.run(test(writer))
+
+    def test_input_does_not_block_the_loop(self):
+        """Test other tasks keep running while the console waits for a line"""
+        async def test(writer):
+            console = Console()
+            await console.open()
+            ticks = []
+
+            async def tick():
+                for i in range(3):
+                    ticks.append(i)
+                    await asyncio.sleep(0.01)
+                writer.write(b"2\n7\n")
+            ticker = asyncio.create_task(tick())
+            with unittest.mock.patch('builtins.print'):
+                self.assertEqual(await get_user_choice(console), [PeerServerOperation.GET_TORRENT, 7, None])
+            self.assertEqual(ticks, [0, 1, 2])
+            await ticker
+            console.close()
+        self.run_with_stdin(test)
+
+    def test_end_of_input(self):
+        """Test a closed stdin ends the menu instead of spinning"""
+        async def test(writer):
+            console = Console()
+            await console.open()
+            writer.close()
+            with unittest.mock.patch('builtins.print'), self.assertRaises(EOFError):
+                await get_user_choice(console)
+            console.close()
+        self.run_with_stdin(test)
+
+    def test_rate_limit_choice(self):
+        """Test the rate limit menu entry reads upload and download caps in KB/s"""
+        async def test(writer):
+            console = Console()
+            await console.open()
+            writer.write(b"4\n100,,50\n\n")
+            with unittest.mock.patch('builtins.print'):
+                operation = await get_user_choice(console)
+            self.assertEqual(operation, [SET_RATE_LIMITS, (102400, None, 51200), (None, None, None)])
+            console.close()
+        self.run_with_stdin(test)
+
+class TestRates(unittest.TestCase):
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates("1.5"), (1536, None, None))
+        self.assertEqual(parse_rates(" 0 , 8 ,"), (None, 8192, None))
+        for text in ("1,2,3,4", "-1", "fast"):
+            with self.assertRaises(ValueError):
+                parse_rates(text)
+
+class TestArguments(unittest.TestCase):
+    def test_upload_workers(self):
+        """Test the optional fifth argument sets the number of upload workers"""
+        argv = ["client_handler.py", "127.0.0.1", "9000", "127.0.0.1", "8888", "3"]
+        with unittest.mock.patch.object(sys, 'argv', argv):
+            self.assertEqual(client_handler.parse_arguments(), ("127.0.0.1", "9000", "127.0.0.1", "8888", 3))
+        with unittest.mock.patch.object(sys, 'argv', argv[:3]):
+            self.assertEqual(client_handler.parse_arguments(), ("127.0.0.1", "9000", None, None, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Tests for file_handler module
+"""
+import unittest
+import asyncio
+import os
+import json
+import tempfile
+from file_handler import OutputFile, ResumeFile
+from file_chunk import ChunkBuffer, Chunk
+from protocol import CHUNK_SIZE
+
+class TestOutputFile(unittest.TestCase):
+    def setUp(self):
+        """Set up a temporary output path"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "out", "file.bin")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_preallocates_file(self):
+        """Test the output file has its final size before any chunk arrives"""
+        output = OutputFile(self.path, 3, CHUNK_SIZE * 2 + 10)
+        output.open()
+        output.close()
+        self.assertEqual(os.path.getsize(self.path), CHUNK_SIZE * 2 + 10)
+
+    def test_chunks_written_at_offset(self):
+        """Test chunks arriving out of order land at their offsets"""
+        data = os.urandom(CHUNK_SIZE * 2 + 10)
+        chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+        output = OutputFile(self.path, 3, len(data))
+        output.open()
+
+        async def run():
+            for idx in (2, 0, 1):
+                await output.write_chunk(idx, chunks[idx])
+        asyncio.run(run())
+        output.close()
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_unknown_size_trimmed_on_last_chunk(self):
+        """Test a file of unknown size is trimmed once the last chunk is written"""
+        output = OutputFile(self.path, 2)
+        output.open()
+        self.assertEqual(os.path.getsize(self.path), CHUNK_SIZE * 2)
+        asyncio.run(output.write_chunk(1, b"tail"))
+        output.close()
+        self.assertEqual(os.path.getsize(self.path), CHUNK_SIZE + 4)
+
+    def test_buffer_releases_written_chunks(self):
+        """Test the chunk buffer only keeps chunks that are not yet on disk"""
+        buffer = ChunkBuffer()
+        output = OutputFile(self.path, 2, CHUNK_SIZE + 4)
+        output.open()
+        buffer.set_output(output)
+
+        buffer.add_data(Chunk(1, b"tail"))
+        self.assertFalse(buffer.has_chunk(1))
+        asyncio.run(buffer.flush(1))
+        self.assertTrue(buffer.has_chunk(1))
+        self.assertEqual(buffer.get_buffer(), [0, 0])
+        self.assertEqual(buffer.get_data(1), b"tail")
+        self.assertEqual(buffer.chunk_length(1), 4)
+        self.assertEqual(buffer.chunk_length(0), 0)
+        buffer.close_output()
+
+class TestResumeFile(unittest.TestCase):
+    def setUp(self):
+        """Set up an output file for a three chunk download"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "file.bin")
+        self.output = OutputFile(self.path, 3, CHUNK_SIZE * 3)
+        self.output.open()
+        self.hashes = ["a" * 64, "b" * 64, "c" * 64]
+
+    def tearDown(self):
+        self.output.close()
+        self.tmpdir.cleanup()
+
+    def test_progress_round_trip(self):
+        """Test saved progress is loaded back by the same torrent"""
+        resume = ResumeFile(self.output, "file.bin", self.hashes)
+        resume.have = {0, 2}
+        asyncio.run(resume.save())
+        self.assertEqual(ResumeFile(self.output, "file.bin", self.hashes).load(), {0, 2})
+        self.assertFalse(os.path.exists(resume.path + ".tmp"))
+
+    def test_other_torrent_ignored(self):
+        """Test progress saved for a different manifest is not reused"""
+        resume = ResumeFile(self.output, "file.bin", self.hashes)
+        resume.have = {0, 1}
+        asyncio.run(resume.save())
+        other = ResumeFile(self.output, "file.bin", ["d" * 64] * 3)
+        self.assertEqual(other.load(), set())
+
+    def test_corrupt_resume_file_ignored(self):
+        """Test an unreadable resume file means starting over"""
+        resume = ResumeFile(self.output, "file.bin", self.hashes)
+        with open(resume.path, "w") as f:
+            f.write("{not json")
+        self.assertEqual(resume.load(), set())
+
+    def test_saved_in_batches(self):
+        """Test the resume file is only rewritten once a batch of chunks is written"""
+        resume = ResumeFile(self.output, "file.bin", self.hashes, batch_size=2)
+
+        async def run():
+            await resume.record(0)
+            first = os.path.exists(resume.path)
+            await resume.record(1)
+            return first
+        self.assertFalse(asyncio.run(run()))
+        with open(resume.path) as f:
+            self.assertEqual(json.load(f)["num_chunks"], 3)
+        self.assertEqual(ResumeFile(self.output, "file.bin", self.hashes).load(), {0, 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+Tests for Journal class
+"""
+import unittest
+import asyncio
+import os
+import tempfile
+import unittest.mock
+from journal import Journal
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        """Set up an empty state directory"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def reopen(self) -> tuple:
+        journal = Journal(self.dir)
+        state, events = journal.load()
+        journal.close()
+        return state, events
+
+    def test_events_survive_reopen(self):
+        """Test committed events are replayed in order"""
+        async def run():
+            journal = Journal(self.dir)
+            journal.load()
+            journal.append(['torrent', 0, 'a.bin'])
+            journal.append(['seed', 0, 'peer'])
+            await journal.commit()
+            journal.close()
+        asyncio.run(run())
+        self.assertEqual(self.reopen(), (None, [['torrent', 0, 'a.bin'], ['seed', 0, 'peer']]))
+
+    def test_group_commit(self):
+        """Test events appended during a write share the next write"""
+        async def run():
+            journal = Journal(self.dir)
+            journal.load()
+            with unittest.mock.patch.object(Journal, '_write', wraps=Journal._write) as write:
+                journal.append(['a'])
+                first = asyncio.create_task(journal.commit())
+                await asyncio.sleep(0)
+                for event in (['b'], ['c'], ['d']):
+                    journal.append(event)
+                    await asyncio.sleep(0)
+                await asyncio.gather(first, *(journal.commit() for _ in range(3)))
+                self.assertEqual(write.call_count, 2)
+            journal.close()
+        asyncio.run(run())
+        self.assertEqual(self.reopen()[1], [['a'], ['b'], ['c'], ['d']])
+
+    def test_failed_fsync_fails_every_waiter(self):
+        """Test events are not reported durable when fsync fails, now or on later commits"""
+        async def run():
+            journal = Journal(self.dir)
+            journal.load()
+            with unittest.mock.patch('os.fsync', side_effect=OSError(5, "I/O error")):
+                journal.append(['a'])
+                first = asyncio.create_task(journal.commit())
+                await asyncio.sleep(0)
+                journal.append(['b'])
+                results = await asyncio.gather(first, journal.commit(), return_exceptions=True)
+            self.assertTrue(all(isinstance(result, OSError) for result in results))
+            self.assertEqual(journal.durable, 0)
+            journal.append(['c'])
+            with self.assertRaises(OSError):
+                await journal.commit()
+            journal.close()
+        asyncio.run(run())
+
+    def test_torn_tail_is_cut(self):
+        """Test a half-written last event is dropped and later appends stay readable"""
+        async def run():
+            journal = Journal(self.dir)
+            journal.load()
+            journal.append(['a'])
+            await journal.commit()
+            journal._file.write(b'["b",')
+            journal.close()
+
+            journal = Journal(self.dir)
+            self.assertEqual(journal.load(), (None, [['a']]))
+            journal.append(['c'])
+            await journal.commit()
+            journal.close()
+        asyncio.run(run())
+        self.assertEqual(self.reopen()[1], [['a'], ['c']])
+
+    def test_snapshot_replaces_old_journals(self):
+        """Test a snapshot covers the journals before it and recovery replays only the rest"""
+        async def run():
+            journal = Journal(self.dir)
+            journal.load()
+            journal.append(['a'])
+            await journal.commit()
+            journal.append(['b'])
+            await journal.snapshot(lambda: {'events': 2})
+            journal.append(['c'])
+            await journal.commit()
+            journal.close()
+        asyncio.run(run())
+        self.assertEqual(self.reopen(), ({'events': 2}, [['c']]))
+        self.assertEqual(sorted(os.listdir(self.dir)), ['journal.00000001.log', 'snapshot.json'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -63,5 +63,22 @@ class TestConnectionLimiter(unittest.TestCase):
         self.loop.run_until_complete(fail_connection())
         self.assertEqual(limiter.semaphore._value, 1)
 
+    def test_observe_wait(self):
+        waits = []
+        limiter = ConnectionLimiter(max_connections=1, observe_wait=waits.append)
+
+        @limiter.limit_connections
+        async def handle():
+            await asyncio.sleep(0.05)
+            return True
+
+        async def run_test():
+            return await asyncio.gather(handle(), handle())
+
+        self.assertEqual(self.loop.run_until_complete(run_test()), [True, True])
+        self.assertEqual(len(waits), 2)
+        self.assertLess(min(waits), 0.05)
+        self.assertGreaterEqual(max(waits), 0.04)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""
+Tests for tracker metrics
+"""
+import unittest
+import asyncio
+from metrics import Histogram, TrackerMetrics, serve_metrics
+from tracker import TrackerServer
+from tracker_session import TrackerSession
+from protocol import PeerServerOperation, ReturnCode, PayloadField
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        """Test each bucket counts the observations up to its bound"""
+        histogram = Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        lines = histogram.render('latency')
+        self.assertEqual(lines[:3], ['latency_bucket{le="0.1"} 2', 'latency_bucket{le="1"} 3',
+                                     'latency_bucket{le="+Inf"} 4'])
+        self.assertEqual(lines[3], 'latency_sum 3.65')
+        self.assertEqual(lines[4], 'latency_count 4')
+        self.assertEqual(histogram.count, 4)
+
+    def test_labels(self):
+        """Test labels are kept in front of the bucket bound"""
+        histogram = Histogram((1,))
+        histogram.observe(0.5)
+        lines = histogram.render('latency', 'op="GET_LIST"')
+        self.assertEqual(lines[0], 'latency_bucket{op="GET_LIST",le="1"} 1')
+        self.assertEqual(lines[-1], 'latency_count{op="GET_LIST"} 1')
+
+class TestTrackerMetrics(unittest.TestCase):
+    def test_render(self):
+        """Test requests are counted by operation name along with traffic and gauges"""
+        metrics = TrackerMetrics()
+        metrics.observe_request(PeerServerOperation.GET_LIST, 0.001, 20, 300)
+        metrics.observe_request(PeerServerOperation.GET_LIST, 0.002, 20, 300)
+        metrics.observe_request(999, 0.001, 10, 10)
+        metrics.connection_opened()
+        text = metrics.render({'tracker_torrents': ('Torrents registered', 7)})
+        self.assertIn('tracker_requests_total{op="GET_LIST"} 2', text)
+        self.assertIn('tracker_requests_total{op="999"} 1', text)
+        self.assertIn('tracker_request_duration_seconds_count{op="GET_LIST"} 2', text)
+        self.assertIn('tracker_received_bytes_total 50', text)
+        self.assertIn('tracker_sent_bytes_total 610', text)
+        self.assertIn('tracker_connections 1', text)
+        self.assertIn('# TYPE tracker_torrents gauge\ntracker_torrents 7', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_tracker_records_requests(self):
+        """Test a tracker session shows up in the tracker's metrics and on the endpoint"""
+        async def run():
+            tracker = TrackerServer()
+            server = await asyncio.start_server(tracker.receive_request, "127.0.0.1", 0)
+            metrics_server = await serve_metrics(tracker.render_metrics, "127.0.0.1", 0)
+            session = TrackerSession("127.0.0.1", server.sockets[0].getsockname()[1])
+            try:
+                async with server, metrics_server:
+                    response = await session.request({
+                        PayloadField.OPERATION_CODE: PeerServerOperation.UPLOAD_FILE, PayloadField.PEER_ID: "peer",
+                        PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000",
+                        PayloadField.FILE_NAME: "a.bin", PayloadField.NUM_OF_CHUNKS: 1})
+                    self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+                    await session.request({PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST})
+                    self.assertEqual(tracker.metrics.connections, 1)
+
+                    port = metrics_server.sockets[0].getsockname()[1]
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+                    reply = (await reader.read()).decode()
+                    writer.close()
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.write(b"GET / HTTP/1.0\r\n\r\n")
+                    missing = (await reader.read()).decode()
+                    writer.close()
+            finally:
+                session.close()
+            return reply, missing
+
+        reply, missing = asyncio.run(run())
+        self.assertTrue(reply.startswith("HTTP/1.0 200 OK"))
+        self.assertIn('tracker_requests_total{op="UPLOAD_FILE"} 1', reply)
+        self.assertIn('tracker_requests_total{op="GET_LIST"} 1', reply)
+        self.assertIn('tracker_torrents 1', reply)
+        self.assertIn('tracker_seeders 1', reply)
+        self.assertIn('tracker_limiter_wait_seconds_count 2', reply)
+        self.assertTrue(missing.startswith("HTTP/1.0 404"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+"""
+Tests for PeerConnectionPool class
+"""
+import unittest
+import asyncio
+from client import Client
+from peer_pool import PeerConnectionPool, CircuitBreaker, PeerTimeoutError, PeerUnavailableError, backoff_delay
+from protocol import PeerOperation, ReturnCode, PayloadField
+from file_chunk import Chunk
+from tests.helpers import FakeClock, async_test
+
+class TestPeerConnectionPool(unittest.TestCase):
+    def setUp(self):
+        """Set up a seeder holding a few chunks and a leecher"""
+        self.seeder = Client("127.0.0.1", "0")
+        self.seeder.chunk_buffer.set_buffer(8)
+        for idx in range(8):
+            self.seeder.chunk_buffer.add_data(Chunk(idx, f"chunk-{idx}".encode()))
+        self.leecher = Client("127.0.0.1", "8000")
+        self.leecher.chunk_buffer.set_buffer(8)
+        self.connections = 0
+
+    async def start_seeder(self):
+        async def handle(reader, writer):
+            self.connections += 1
+            await self.seeder.receive_peer_request(reader, writer)
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        return server, server.sockets[0].getsockname()[1]
+
+    async def close_pool(self, pool):
+        """Close pooled connections and let the seeder handlers see EOF"""
+        pool.close_all()
+        await asyncio.sleep(0.05)
+
+    @async_test
+    async def test_pipelined_requests_share_connection(self):
+        """Test many concurrent requests travel over one connection in order"""
+        server, port = await self.start_seeder()
+        async with server:
+            requests = [self.leecher.create_peer_request(PeerOperation.GET_CHUNK, idx) for idx in range(8)]
+            results = await asyncio.gather(*[
+                self.leecher.connect_to_peer("127.0.0.1", port, request) for request in requests
+            ])
+            await self.close_pool(self.leecher.peer_pool)
+
+        self.assertTrue(all(result == ReturnCode.SUCCESS for result in results))
+        self.assertEqual(self.connections, 1)
+        for idx in range(8):
+            self.assertEqual(self.leecher.chunk_buffer.get_data(idx), f"chunk-{idx}".encode())
+
+    @async_test
+    async def test_pool_respects_max_connections(self):
+        """Test the least recently used idle connection is evicted when full"""
+        first, first_port = await self.start_seeder()
+        second, second_port = await self.start_seeder()
+        pool = PeerConnectionPool(max_connections=1)
+        async with first, second:
+            conn = await pool.acquire("127.0.0.1", first_port)
+            await pool.acquire("127.0.0.1", second_port)
+            self.assertTrue(conn.closed)
+            self.assertEqual(len(pool.connections), 1)
+            await self.close_pool(pool)
+
+    @async_test
+    async def test_idle_connections_evicted(self):
+        """Test idle connections are closed after the idle timeout"""
+        server, port = await self.start_seeder()
+        pool = PeerConnectionPool(idle_timeout=0.05)
+        async with server:
+            request = self.leecher.create_peer_request(PeerOperation.GET_CHUNK, 0)
+            response = await pool.request("127.0.0.1", port, request)
+            self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+            await asyncio.sleep(0.15)
+            self.assertEqual(len(pool.connections), 0)
+            await self.close_pool(pool)
+
+    @async_test
+    async def test_peer_hangup_fails_pending_requests(self):
+        """Test requests waiting on a closed connection fail instead of hanging"""
+        async def hang_up(reader, writer):
+            await reader.read(1)
+            writer.close()
+        server = await asyncio.start_server(hang_up, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            request = self.leecher.create_peer_request(PeerOperation.GET_CHUNK, 0)
+            result = await self.leecher.connect_to_peer("127.0.0.1", port, request)
+            await self.close_pool(self.leecher.peer_pool)
+        self.assertEqual(result, ReturnCode.FAIL)
+
+    @async_test
+    async def test_request_deadline(self):
+        """Test a peer that never answers times out instead of hanging"""
+        async def silent(reader, writer):
+            await reader.read()
+        server = await asyncio.start_server(silent, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        pool = PeerConnectionPool(request_timeout=0.05)
+        async with server:
+            request = self.leecher.create_peer_request(PeerOperation.GET_CHUNK, 0)
+            with self.assertRaises(PeerTimeoutError):
+                await pool.request("127.0.0.1", port, request)
+            await self.close_pool(pool)
+
+    @async_test
+    async def test_refused_connection_fails_request(self):
+        """Test an unreachable peer fails the request instead of exiting the client"""
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+
+        request = self.leecher.create_peer_request(PeerOperation.GET_CHUNK, 0)
+        result = await self.leecher.connect_to_peer("127.0.0.1", port, request)
+        self.assertEqual(result, ReturnCode.FAIL)
+
+    @async_test
+    async def test_breaker_opens_after_repeated_failures(self):
+        """Test requests to a failing peer are refused without connecting once the breaker opens"""
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+
+        pool = PeerConnectionPool(failure_threshold=2, reset_timeout=60)
+        request = self.leecher.create_peer_request(PeerOperation.GET_CHUNK, 0)
+        for _ in range(2):
+            with self.assertRaises(ConnectionRefusedError):
+                await pool.request("127.0.0.1", port, request)
+        self.assertFalse(pool.is_available("127.0.0.1", port))
+        with self.assertRaises(PeerUnavailableError):
+            await pool.request("127.0.0.1", port, request)
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=self.clock)
+
+    def test_opens_after_threshold(self):
+        """Test the breaker opens after consecutive failures only"""
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_probe(self):
+        """Test one probe is let through after the reset timeout"""
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_backs_off(self):
+        """Test a failed probe reopens the breaker for longer"""
+        for _ in range(3):
+            self.breaker.record_failure()
+        first_wait = self.breaker.retry_in()
+        self.clock.now = 10
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertGreaterEqual(self.breaker.retry_in(), 10)
+        self.assertLessEqual(first_wait, 10)
+
+class TestBackoff(unittest.TestCase):
+    def test_backoff_grows_and_is_capped(self):
+        """Test delays double per attempt, stay jittered within bounds and respect the cap"""
+        for attempt in range(1, 6):
+            delay = backoff_delay(1, attempt, cap=8)
+            expected = min(8, 2 ** (attempt - 1))
+            self.assertGreaterEqual(delay, expected / 2)
+            self.assertLessEqual(delay, expected)
+
+if __name__ == '__main__':
+    unittest.main()
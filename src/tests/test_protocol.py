@@ -1,6 +1,17 @@
 """Tests for protocol enums and constants"""
 import unittest
-from protocol import PeerServerOperation, PeerOperation, ReturnCode, PayloadField
+import asyncio
+from protocol import PeerServerOperation, PeerOperation, ReturnCode, PayloadField, FRAME_HEADER, \
+    CHUNK_SIZE, ProtocolError, encode_frame, encode_message, read_message
+
+def read_frames(data: bytes, count=1):
+    """Feed raw bytes to a StreamReader and read `count` messages back"""
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return [await read_message(reader) for _ in range(count)]
+    return asyncio.run(run())
 
 class TestProtocol(unittest.TestCase):
     def test_peer_server_operations(self):
@@ -19,6 +30,8 @@ class TestProtocol(unittest.TestCase):
         self.assertEqual(PeerOperation.STATUS_UNCHOKED, 180)
         self.assertEqual(PeerOperation.GET_PEERS, 190)
         self.assertEqual(PeerOperation.GET_CHUNK, 195)
+        self.assertEqual(PeerOperation.BITFIELD, 196)
+        self.assertEqual(PeerOperation.HAVE, 197)
 
     def test_return_codes(self):
         """Test return codes"""
@@ -44,4 +57,56 @@ class TestProtocol(unittest.TestCase):
         self.assertEqual(PayloadField.IP_ADDRESS, 'IP_ADDRESS')
         self.assertEqual(PayloadField.PORT, 'PORT')
         self.assertEqual(PayloadField.TORRENT_ID, 'TORRENT_ID')
-        self.assertEqual(PayloadField.FILE_NAME, 'FILE_NAME')
\ No newline at end of file
+        self.assertEqual(PayloadField.FILE_NAME, 'FILE_NAME')
+
+class TestFraming(unittest.TestCase):
+    def test_json_message_round_trip(self):
+        """Test control messages survive framing as JSON"""
+        payload = {
+            PayloadField.OPERATION_CODE: PeerServerOperation.GET_TORRENT,
+            PayloadField.TORRENT_ID: 3,
+            PayloadField.PEER_ID: "abc"
+        }
+        message, = read_frames(encode_message(payload))
+        self.assertEqual(message[PayloadField.OPERATION_CODE], PeerServerOperation.GET_TORRENT)
+        self.assertEqual(message[PayloadField.TORRENT_ID], 3)
+
+    def test_chunk_data_sent_raw(self):
+        """Test chunk bytes are framed without base64 or JSON overhead"""
+        data = bytes(range(256)) * (CHUNK_SIZE // 256)
+        payload = {
+            PayloadField.OPERATION_CODE: PeerOperation.GET_CHUNK,
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS,
+            PayloadField.CHUNK_IDX: 7,
+            PayloadField.CHUNK_DATA: data
+        }
+        frame = encode_message(payload)
+        self.assertEqual(len(frame), FRAME_HEADER.size + CHUNK_SIZE)
+
+        message, = read_frames(frame)
+        self.assertEqual(message[PayloadField.CHUNK_IDX], 7)
+        self.assertEqual(message[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+        self.assertEqual(message[PayloadField.CHUNK_DATA], data)
+
+    def test_back_to_back_frames(self):
+        """Test several frames in one read are split correctly"""
+        frames = b"".join(encode_message({PayloadField.OPERATION_CODE: PeerOperation.GET_CHUNK,
+                                          PayloadField.CHUNK_IDX: idx}) for idx in range(3))
+        messages = read_frames(frames, count=4)
+        self.assertEqual([m[PayloadField.CHUNK_IDX] for m in messages[:3]], [0, 1, 2])
+        self.assertIsNone(messages[3])
+
+    def test_truncated_frame(self):
+        """Test a connection closed mid-frame is an error, not a message"""
+        frame = encode_frame(PeerOperation.GET_CHUNK, b"payload")
+        with self.assertRaises(asyncio.IncompleteReadError):
+            read_frames(frame[:-2])
+        with self.assertRaises(ProtocolError):
+            read_frames(frame[:3])
+
+    def test_bad_version(self):
+        """Test frames from another protocol version are rejected"""
+        frame = bytearray(encode_frame(PeerOperation.GET_CHUNK))
+        frame[0] = 1
+        with self.assertRaises(ProtocolError):
+            read_frames(bytes(frame))
@@ -0,0 +1,118 @@
+"""
+Tests for token bucket rate limiting
+"""
+import unittest
+import unittest.mock
+import asyncio
+from rate_limit import TokenBucket, RateLimiter
+from tests.helpers import FakeClock
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_unlimited(self):
+        """Test a bucket without a rate never makes anyone wait"""
+        bucket = TokenBucket(clock=self.clock)
+        self.assertEqual(bucket.consume(10 ** 12), 0.0)
+
+    def test_burst_then_rate(self):
+        """Test a full bucket lets its burst through, then paces at the rate"""
+        bucket = TokenBucket(1000, burst=500, clock=self.clock)
+        self.assertEqual(bucket.consume(500), 0.0)
+        self.assertAlmostEqual(bucket.consume(250), 0.25)
+        # The debt keeps growing for callers that do not wait
+        self.assertAlmostEqual(bucket.consume(250), 0.5)
+        self.clock.now = 0.5
+        self.assertEqual(bucket.consume(0), 0.0)
+
+    def test_idle_time_saves_at_most_a_burst(self):
+        """Test tokens stop piling up once the bucket is full"""
+        bucket = TokenBucket(1000, burst=500, clock=self.clock)
+        bucket.consume(500)
+        self.clock.now = 60
+        self.assertEqual(bucket.consume(500), 0.0)
+        self.assertAlmostEqual(bucket.consume(100), 0.1)
+
+    def test_chunk_larger_than_burst(self):
+        """Test a transfer bigger than the bucket waits for the difference only"""
+        bucket = TokenBucket(1000, burst=100, clock=self.clock)
+        self.assertAlmostEqual(bucket.consume(1100), 1.0)
+
+    def test_rate_change_keeps_debt(self):
+        """Test changing the rate at runtime settles the debt at the new rate"""
+        bucket = TokenBucket(1000, burst=100, clock=self.clock)
+        bucket.consume(1100)
+        bucket.set_rate(2000, burst=100)
+        self.assertAlmostEqual(bucket.consume(0), 0.5)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.consume(10 ** 9), 0.0)
+
+    def test_long_run_is_accurate(self):
+        """Test many small transfers average out to the rate"""
+        bucket = TokenBucket(10 ** 9 / 8, burst=16384, clock=self.clock)  # 1 Gbit/s
+        sent = 0
+        for _ in range(100000):
+            self.clock.now += bucket.consume(16384)
+            sent += 16384
+        self.assertAlmostEqual(sent / self.clock.now, 10 ** 9 / 8, delta=10 ** 9 / 8 * 0.001)
+
+    def test_saturated_chunks_share_sleeps(self):
+        """Test a saturated fast link sleeps once per quantum of debt, not once per chunk"""
+        bucket = TokenBucket(10 ** 9 / 8, burst=16384, clock=self.clock)  # 1 Gbit/s
+        chunks = 100000
+        wakeups = 0
+        for _ in range(chunks):
+            delay = bucket.consume(16384)
+            if delay:
+                wakeups += 1
+                self.clock.now += delay
+        self.assertLess(wakeups, chunks / 50)
+        self.assertAlmostEqual(chunks * 16384 / self.clock.now, 10 ** 9 / 8, delta=10 ** 9 / 8 * 0.01)
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_slowest_cap_wins(self):
+        """Test a transfer waits for the tightest of the total, peer and torrent caps"""
+        limiter = RateLimiter(rate=100000, peer_rate=10000, torrent_rate=50000, clock=self.clock)
+        self.assertEqual(limiter.delay(16384, "a", 1), 0)  # every bucket starts with one chunk
+        self.assertAlmostEqual(limiter.delay(1000, "a", 1), 0.1)  # peer a
+        self.assertAlmostEqual(limiter.delay(1000, "b", 1), 0.04)  # torrent 1
+        self.assertAlmostEqual(limiter.delay(1000, "c", 2), 0.03)  # total
+
+    def test_peers_have_their_own_buckets(self):
+        """Test one peer's traffic does not slow another peer down"""
+        limiter = RateLimiter(peer_rate=1000, clock=self.clock)
+        self.assertGreater(limiter.delay(20000, "a"), 0)
+        self.assertEqual(limiter.delay(1000, "b"), 0)
+        limiter.forget_peer("a")
+        self.assertNotIn("a", limiter.peers)
+
+    def test_set_rates_at_runtime(self):
+        """Test new caps reach the buckets that already exist"""
+        limiter = RateLimiter(peer_rate=1000, torrent_rate=1000, clock=self.clock)
+        limiter.delay(1, "a", 1)
+        limiter.set_rates(rate=500, peer_rate=None, torrent_rate=2000)
+        self.assertEqual(limiter.rates, (500, None, 2000))
+        self.assertIsNone(limiter.peers["a"].rate)
+        self.assertEqual(limiter.torrents[1].rate, 2000)
+        limiter.set_rates()
+        self.assertFalse(limiter.limited)
+
+    def test_throttle_sleeps_once(self):
+        """Test throttle waits out the debt with a single sleep"""
+        limiter = RateLimiter(rate=100000, clock=self.clock)
+
+        async def run():
+            with unittest.mock.patch('asyncio.sleep', new=unittest.mock.AsyncMock()) as sleep:
+                await limiter.throttle(16384)  # within the burst
+                await limiter.throttle(50000)
+            return sleep
+        sleep = asyncio.run(run())
+        sleep.assert_awaited_once()
+        self.assertAlmostEqual(sleep.await_args.args[0], 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for the recheck engine
+"""
+import unittest
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest.mock
+from recheck import Recheck, hash_chunk_range
+from protocol import CHUNK_SIZE
+
+class TestRecheck(unittest.TestCase):
+    def setUp(self):
+        """Write a file of ten and a half chunks"""
+        self.data = os.urandom(CHUNK_SIZE * 10 + CHUNK_SIZE // 2)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+        self.hashes = [hashlib.sha256(self.data[i:i + CHUNK_SIZE]).hexdigest()
+                       for i in range(0, len(self.data), CHUNK_SIZE)]
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_hash_chunk_range(self):
+        """Test a range read in large blocks hashes every chunk separately"""
+        self.assertEqual(hash_chunk_range(self.path, 2, 11, read_size=CHUNK_SIZE * 4), self.hashes[2:])
+
+    def test_manifest_matches_serial_hashing(self):
+        """Test the parallel recheck builds the same manifest as hashing chunk by chunk"""
+        result = asyncio.run(Recheck(self.path, workers=4, range_chunks=3).run())
+        self.assertEqual(result.hashes, self.hashes)
+        self.assertEqual(result.have, set(range(11)))
+
+    def test_ranges_split_runs(self):
+        """Test ranges follow contiguous runs of chunks and respect the range size"""
+        recheck = Recheck(self.path, chunks=[0, 1, 2, 3, 5, 6, 9], range_chunks=3)
+        self.assertEqual(recheck.ranges(), [(0, 3), (3, 4), (5, 7), (9, 10)])
+
+    def test_bad_chunks_left_out(self):
+        """Test chunks that do not match the manifest are not marked present"""
+        expected = list(self.hashes)
+        expected[4] = "0" * 64
+        result = asyncio.run(Recheck(self.path, expected_hashes=expected, range_chunks=2).run())
+        self.assertEqual(result.have, set(range(11)) - {4})
+
+    def test_only_requested_chunks_hashed(self):
+        """Test a subset recheck hashes just those chunks"""
+        result = asyncio.run(Recheck(self.path, expected_hashes=self.hashes, chunks={1, 7}).run())
+        self.assertEqual(result.have, {1, 7})
+        self.assertIsNone(result.hashes[0])
+
+    def test_truncated_file(self):
+        """Test chunks past the end of a short file are reported missing"""
+        recheck = Recheck(self.path, num_chunks=13, expected_hashes=self.hashes + ["a" * 64] * 2)
+        result = asyncio.run(recheck.run())
+        self.assertEqual(result.have, set(range(11)))
+
+    def test_progress_reported(self):
+        """Test progress goes up to the total number of chunks"""
+        progress = []
+        recheck = Recheck(self.path, range_chunks=2, progress=lambda done, total: progress.append((done, total)))
+        asyncio.run(recheck.run())
+        self.assertEqual(progress[-1], (11, 11))
+        self.assertEqual(len(progress), 6)
+
+    def test_process_pool(self):
+        """Test the process pool gives the same manifest"""
+        result = asyncio.run(Recheck(self.path, workers=2, use_processes=True, range_chunks=4).run())
+        self.assertEqual(result.hashes, self.hashes)
+
+    def test_cancel_does_not_wait_for_queued_ranges(self):
+        """Test cancelling a recheck returns at once and drops the ranges not started yet"""
+        started = []
+        release = threading.Event()
+
+        def slow_hash(path, first, last):
+            started.append(first)
+            release.wait(5)
+            return []
+
+        async def run():
+            task = asyncio.create_task(Recheck(self.path, workers=1, range_chunks=1).run())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with unittest.mock.patch('recheck.hash_chunk_range', slow_hash):
+            start = time.monotonic()
+            asyncio.run(run())
+            elapsed = time.monotonic() - start
+            release.set()
+        self.assertLess(elapsed, 1)
+        self.assertEqual(len(started), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,16 +6,7 @@ from unittest.mock import Mock, patch
 from client import Client
 from protocol import PeerOperation, ReturnCode, PayloadField
 from file_chunk import Chunk, ChunkBuffer
-
-def async_test(f):
-    def wrapper(*args, **kwargs):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            return loop.run_until_complete(f(*args, **kwargs))
-        finally:
-            loop.close()
-    return wrapper
+from tests.helpers import async_test
 
 class TestP2PPerformance(unittest.TestCase):
    def setUp(self):
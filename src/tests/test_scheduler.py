@@ -0,0 +1,419 @@
+"""
+Tests for DownloadScheduler class
+"""
+import unittest
+import asyncio
+from client import Client
+from scheduler import DownloadScheduler, PiecePicker, PeerStats
+from protocol import ReturnCode, PayloadField
+from file_chunk import Chunk
+from tests.helpers import async_test
+
+def make_peers(count):
+    return {
+        f"peer{i}": {PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: str(8001 + i)}
+        for i in range(count)
+    }
+
+class TestDownloadScheduler(unittest.TestCase):
+    def setUp(self):
+        """Set up test fixtures"""
+        self.client = Client("127.0.0.1", "8000")
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.total_in_flight = 0
+        self.max_total_in_flight = 0
+
+    def fake_peer(self, delays=None, fail_ports=()):
+        """Build a connect_to_peer replacement that tracks requests in flight per port"""
+        delays = delays or {}
+
+        async def connect_to_peer(ip, port, request):
+            self.in_flight[port] = self.in_flight.get(port, 0) + 1
+            self.max_in_flight[port] = max(self.max_in_flight.get(port, 0), self.in_flight[port])
+            self.total_in_flight += 1
+            self.max_total_in_flight = max(self.max_total_in_flight, self.total_in_flight)
+            await asyncio.sleep(delays.get(port, 0.01))
+            self.in_flight[port] -= 1
+            self.total_in_flight -= 1
+            if port in fail_ports:
+                return ReturnCode.FAIL
+            self.client.chunk_buffer.add_data(Chunk(request[PayloadField.CHUNK_IDX], b"x"))
+            return ReturnCode.SUCCESS
+        return connect_to_peer
+
+    @async_test
+    async def test_requests_pipelined_per_peer(self):
+        """Test several requests are outstanding on each peer"""
+        self.client.chunk_buffer.set_buffer(40)
+        self.client.connect_to_peer = self.fake_peer()
+        scheduler = DownloadScheduler(self.client, make_peers(2), max_per_peer=4)
+
+        failed = await scheduler.run(range(40))
+        self.assertEqual(failed, set())
+        self.assertTrue(self.client.chunk_buffer.has_all_chunks)
+        self.assertEqual(self.max_in_flight["8001"], 4)
+        self.assertEqual(self.max_in_flight["8002"], 4)
+
+    @async_test
+    async def test_total_window_limit(self):
+        """Test total outstanding requests never exceed max_total"""
+        self.client.chunk_buffer.set_buffer(40)
+        self.client.connect_to_peer = self.fake_peer()
+        scheduler = DownloadScheduler(self.client, make_peers(4), max_per_peer=4, max_total=6)
+
+        await scheduler.run(range(40))
+        self.assertEqual(self.max_total_in_flight, 6)
+        self.assertTrue(self.client.chunk_buffer.has_all_chunks)
+
+    @async_test
+    async def test_fast_peer_does_most_work(self):
+        """Test a fast peer takes the chunks a slow peer has no slot for"""
+        self.client.chunk_buffer.set_buffer(20)
+        self.client.connect_to_peer = self.fake_peer(delays={"8001": 0.5, "8002": 0.001})
+        scheduler = DownloadScheduler(self.client, make_peers(2), max_per_peer=1)
+
+        failed = await scheduler.run(range(20))
+        self.assertEqual(failed, set())
+        self.assertGreater(scheduler.peers[1].downloaded, scheduler.peers[0].downloaded)
+        self.assertTrue(self.client.chunk_buffer.has_all_chunks)
+
+    @async_test
+    async def test_stats_count_chunk_bytes(self):
+        """Test peer throughput is fed the size of each chunk received"""
+        self.client.chunk_buffer.set_buffer(10)
+        self.client.connect_to_peer = self.fake_peer()
+        scheduler = DownloadScheduler(self.client, make_peers(1), stats_interval=60)
+
+        await scheduler.run(range(10))
+        self.assertEqual(scheduler.peers[0].stats._window_bytes, 10)  # the fake peer sends one byte per chunk
+
+    @async_test
+    async def test_failed_chunks_move_to_other_peer(self):
+        """Test chunks failing on one peer are downloaded from another"""
+        self.client.chunk_buffer.set_buffer(10)
+        self.client.connect_to_peer = self.fake_peer(fail_ports=("8001",))
+        scheduler = DownloadScheduler(self.client, make_peers(2), retry_delay=0)
+
+        failed = await scheduler.run(range(10))
+        self.assertEqual(failed, set())
+        self.assertTrue(self.client.chunk_buffer.has_all_chunks)
+
+    @async_test
+    async def test_failed_chunks_move_without_backoff(self):
+        """Test a chunk another peer has is not held back by the retry backoff"""
+        self.client.chunk_buffer.set_buffer(10)
+        self.client.connect_to_peer = self.fake_peer(fail_ports=("8001",))
+        scheduler = DownloadScheduler(self.client, make_peers(2), retry_delay=30)
+
+        failed = await asyncio.wait_for(scheduler.run(range(10)), 5)
+        self.assertEqual(failed, set())
+
+    @async_test
+    async def test_peer_with_open_breaker_skipped(self):
+        """Test no requests go to a peer whose circuit breaker is open"""
+        self.client.chunk_buffer.set_buffer(10)
+        self.client.connect_to_peer = self.fake_peer()
+        breaker = self.client.peer_pool.breaker(("127.0.0.1", 8001))
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        scheduler = DownloadScheduler(self.client, make_peers(2))
+
+        failed = await scheduler.run(range(10))
+        self.assertEqual(failed, set())
+        self.assertNotIn("8001", self.max_in_flight)
+
+    @async_test
+    async def test_gives_up_after_max_retries(self):
+        """Test chunks are reported failed once every attempt failed"""
+        self.client.chunk_buffer.set_buffer(5)
+        self.client.connect_to_peer = self.fake_peer(fail_ports=("8001",))
+        scheduler = DownloadScheduler(self.client, make_peers(1), max_retries=2, retry_delay=0)
+
+        failed = await scheduler.run(range(5))
+        self.assertEqual(failed, set(range(5)))
+
+    @async_test
+    async def test_max_retries_counts_rounds(self):
+        """Test every holder gets each round of a failed chunk before it is given up"""
+        self.client.chunk_buffer.set_buffer(1)
+        requests = []
+        fail = self.fake_peer(fail_ports=("8001", "8002"))
+
+        async def connect_to_peer(ip, port, request):
+            requests.append(port)
+            return await fail(ip, port, request)
+        self.client.connect_to_peer = connect_to_peer
+        scheduler = DownloadScheduler(self.client, make_peers(2), max_retries=3, retry_delay=0.01)
+
+        failed = await scheduler.run([0])
+        self.assertEqual(failed, {0})
+        self.assertEqual(sorted(requests), ["8001"] * 3 + ["8002"] * 3)
+        self.assertEqual(scheduler.rounds, {0: 3})
+
+    @async_test
+    async def test_partial_peers_only_asked_for_chunks_they_have(self):
+        """Test chunks are requested only from peers whose bitfield has them"""
+        self.client.chunk_buffer.set_buffer(10)
+        requested = {}
+
+        async def request_bitfield(ip, port):
+            return set(range(5)) if port == "8001" else set(range(5, 10))
+
+        async def connect_to_peer(ip, port, request):
+            requested.setdefault(port, set()).add(request[PayloadField.CHUNK_IDX])
+            self.client.chunk_buffer.add_data(Chunk(request[PayloadField.CHUNK_IDX], b"x"))
+            return ReturnCode.SUCCESS
+
+        self.client.request_bitfield = request_bitfield
+        self.client.connect_to_peer = connect_to_peer
+        self.client.broadcast_have = lambda chunk_idx, peers: None
+        scheduler = DownloadScheduler(self.client, {}, partial_peers=make_peers(2))
+
+        failed = await scheduler.run(range(10))
+        self.assertEqual(failed, set())
+        self.assertEqual(requested["8001"], set(range(5)))
+        self.assertEqual(requested["8002"], set(range(5, 10)))
+
+    @async_test
+    async def test_unavailable_chunks_fail(self):
+        """Test chunks no peer has are reported failed instead of hanging"""
+        self.client.chunk_buffer.set_buffer(4)
+
+        async def request_bitfield(ip, port):
+            return {0, 1}
+
+        self.client.request_bitfield = request_bitfield
+        self.client.connect_to_peer = self.fake_peer()
+        self.client.broadcast_have = lambda chunk_idx, peers: None
+        scheduler = DownloadScheduler(self.client, {}, partial_peers=make_peers(1), stall_timeout=0.01)
+
+        failed = await scheduler.run(range(4))
+        self.assertEqual(failed, {2, 3})
+
+    @async_test
+    async def test_endgame_duplicates_slow_request(self):
+        """Test the last chunk stuck on a slow peer is fetched from another and cancelled"""
+        self.client.chunk_buffer.set_buffer(4)
+        cancelled = []
+        self.client.connect_to_peer = self.fake_peer(delays={"8001": 2, "8002": 0.01})
+        self.client.send_cancel = lambda key, chunk_idx: cancelled.append((key, chunk_idx))
+        scheduler = DownloadScheduler(self.client, make_peers(2), max_per_peer=1, endgame_threshold=4)
+
+        start = asyncio.get_running_loop().time()
+        failed = await scheduler.run(range(4))
+        self.assertEqual(failed, set())
+        self.assertTrue(self.client.chunk_buffer.has_all_chunks)
+        self.assertLess(asyncio.get_running_loop().time() - start, 1)
+        self.assertEqual([key for key, _ in cancelled], [("127.0.0.1", 8001)])
+
+    @async_test
+    async def test_no_duplicates_outside_endgame(self):
+        """Test chunks are requested once while many remain"""
+        self.client.chunk_buffer.set_buffer(20)
+        requests = []
+
+        async def connect_to_peer(ip, port, request):
+            requests.append(request[PayloadField.CHUNK_IDX])
+            await asyncio.sleep(0.01)
+            self.client.chunk_buffer.add_data(Chunk(request[PayloadField.CHUNK_IDX], b"x"))
+            return ReturnCode.SUCCESS
+
+        self.client.connect_to_peer = connect_to_peer
+        scheduler = DownloadScheduler(self.client, make_peers(3), endgame_threshold=0)
+
+        await scheduler.run(range(20))
+        self.assertEqual(sorted(requests), list(range(20)))
+
+    @async_test
+    async def test_faster_peer_gets_more_requests(self):
+        """Test per-peer limits follow measured throughput"""
+        self.client.chunk_buffer.set_buffer(200)
+        self.client.connect_to_peer = self.fake_peer(delays={"8001": 0.005, "8002": 0.05})
+        scheduler = DownloadScheduler(self.client, make_peers(2), max_per_peer=4, stats_interval=0.05,
+                                      endgame_threshold=0)
+
+        await scheduler.run(range(200))
+        fast, slow = scheduler.peers
+        self.assertGreater(fast.stats.rate, slow.stats.rate)
+        self.assertEqual(fast.limit, 4)
+        self.assertLess(slow.limit, 4)
+        self.assertGreater(fast.downloaded, slow.downloaded)
+
+    @async_test
+    async def test_stalled_peer_dropped(self):
+        """Test a peer that stops delivering is dropped and its chunks go elsewhere"""
+        self.client.chunk_buffer.set_buffer(400)
+        delays = {"8001": 0.01, "8002": 0.01}
+        self.client.connect_to_peer = self.fake_peer(delays=delays)
+        self.client.send_cancel = lambda key, chunk_idx: None
+        scheduler = DownloadScheduler(self.client, make_peers(2), stats_interval=0.05, endgame_threshold=0)
+
+        async def stall_first_peer():
+            await asyncio.sleep(0.1)
+            delays["8001"] = 60
+
+        asyncio.get_running_loop().create_task(stall_first_peer())
+        start = asyncio.get_running_loop().time()
+        failed = await scheduler.run(range(400))
+        self.assertEqual(failed, set())
+        self.assertTrue(scheduler.peers[0].dropped)
+        self.assertFalse(scheduler.peers[1].dropped)
+        self.assertLess(asyncio.get_running_loop().time() - start, 5)
+
+    @async_test
+    async def test_download_peer_buckets_forgotten(self):
+        """Test per-peer download rate buckets do not outlive the download"""
+        self.client.chunk_buffer.set_buffer(10)
+        self.client.download_limiter.set_rates(peer_rate=10 ** 9)
+        fetch = self.fake_peer()
+
+        async def connect_to_peer(ip, port, request):
+            await self.client.download_limiter.throttle(1, (ip, int(port)))
+            return await fetch(ip, port, request)
+        self.client.connect_to_peer = connect_to_peer
+        scheduler = DownloadScheduler(self.client, make_peers(2))
+
+        failed = await scheduler.run(range(10))
+        self.assertEqual(failed, set())
+        self.assertEqual(self.client.download_limiter.peers, {})
+
+    @async_test
+    async def test_only_source_not_dropped(self):
+        """Test a slow peer is kept when nobody else has its chunks"""
+        self.client.chunk_buffer.set_buffer(20)
+
+        async def request_bitfield(ip, port):
+            return set(range(10, 20)) if port == "8001" else set(range(10))
+
+        self.client.request_bitfield = request_bitfield
+        self.client.broadcast_have = lambda chunk_idx, peers: None
+        self.client.connect_to_peer = self.fake_peer(delays={"8001": 0.05, "8002": 0.001})
+        scheduler = DownloadScheduler(self.client, {}, partial_peers=make_peers(2), stats_interval=0.02,
+                                      slow_peer_ratio=0.9, endgame_threshold=0)
+
+        failed = await scheduler.run(range(20))
+        self.assertEqual(failed, set())
+        self.assertEqual(scheduler.peers[0].downloaded, 10)
+
+    @async_test
+    async def test_choked_peer_polled_until_unchoked(self):
+        """Test a choke does not count as a failure and the peer is asked again once unchoked"""
+        self.client.chunk_buffer.set_buffer(6)
+        choked = {"8001": True}
+        polls = []
+
+        async def connect_to_peer(ip, port, request):
+            await asyncio.sleep(0.01)
+            if choked.get(port):
+                return ReturnCode.CHOKED
+            self.client.chunk_buffer.add_data(Chunk(request[PayloadField.CHUNK_IDX], b"x"))
+            return ReturnCode.SUCCESS
+
+        async def send_interested(ip, port):
+            polls.append(port)
+            choked[port] = False
+            return True
+
+        self.client.connect_to_peer = connect_to_peer
+        self.client.send_interested = send_interested
+        self.client.send_uninterested = lambda key: None
+        scheduler = DownloadScheduler(self.client, make_peers(1), max_retries=1, choke_poll_interval=0.01)
+
+        failed = await scheduler.run(range(6))
+        self.assertEqual(failed, set())
+        self.assertEqual(polls, ["8001"])
+        self.assertEqual(scheduler.rounds, {})
+        self.assertFalse(self.client.state.interested)
+
+class TestPeerStats(unittest.TestCase):
+    def test_rate_is_ewma_of_samples(self):
+        """Test throughput samples are smoothed"""
+        stats = PeerStats(alpha=0.5)
+        stats.record_success(1000, 0.5, now=1.0)
+        stats.sample(now=1.5, busy=True)
+        self.assertEqual(stats.rate, 1000)
+        stats.record_success(3000, 0.5, now=2.0)
+        stats.sample(now=2.5, busy=True)
+        self.assertEqual(stats.rate, 1000 + 0.5 * (3000 - 1000))
+        self.assertEqual(stats.rtt, 0.5)
+
+    def test_stalled_peer_rate_decays(self):
+        """Test a busy peer that delivers nothing loses its rate"""
+        stats = PeerStats(alpha=0.5)
+        stats.record_success(1000, 1.0, now=1.0)
+        stats.sample(now=1.0, busy=True)
+        for now in (2.0, 3.0, 4.0):
+            stats.sample(now=now, busy=True)
+        self.assertLess(stats.rate, 200)
+
+    def test_idle_time_not_counted(self):
+        """Test time with nothing outstanding does not lower the rate"""
+        stats = PeerStats(alpha=0.5)
+        stats.record_success(1000, 1.0, now=1.0)
+        stats.sample(now=1.0, busy=False)
+        stats.sample(now=10.0, busy=False)
+        stats.record_success(1000, 1.0, now=11.0)
+        stats.sample(now=11.0, busy=False)
+        self.assertEqual(stats.rate, 1000)
+
+    def test_failure_rate(self):
+        """Test the failure rate rises with failures and falls with successes"""
+        stats = PeerStats(alpha=0.5)
+        stats.record_failure()
+        stats.record_failure()
+        self.assertEqual(stats.failure_rate, 0.75)
+        stats.record_success(1, 0.1, now=1.0)
+        self.assertEqual(stats.failure_rate, 0.375)
+
+class TestPiecePicker(unittest.TestCase):
+    def test_rarest_first(self):
+        """Test the chunk held by the fewest peers is picked first"""
+        picker = PiecePicker(range(3))
+        picker.add_peer("a", {0, 1, 2})
+        picker.add_peer("b", {0, 1})
+        picker.add_peer("c", {0})
+        for idx in range(3):
+            picker.want(idx)
+        self.assertEqual([picker.pick("a") for _ in range(3)], [2, 1, 0])
+        self.assertIsNone(picker.pick("a"))
+
+    def test_only_picks_chunks_peer_has(self):
+        """Test a peer is never handed a chunk it does not have"""
+        picker = PiecePicker(range(4))
+        picker.add_peer("seed")
+        picker.add_peer("partial", {3})
+        for idx in range(4):
+            picker.want(idx)
+        self.assertEqual(picker.pick("partial"), 3)
+        self.assertIsNone(picker.pick("partial"))
+        self.assertEqual(picker.pick("seed", exclude={0, 1}), 2)
+
+    def test_random_among_ties(self):
+        """Test equally rare chunks are not always picked in the same order"""
+        first_picks = set()
+        for _ in range(50):
+            picker = PiecePicker(range(20))
+            picker.add_peer("seed")
+            for idx in range(20):
+                picker.want(idx)
+            first_picks.add(picker.pick("seed"))
+        self.assertGreater(len(first_picks), 1)
+
+    def test_have_updates_availability(self):
+        """Test HAVE makes a chunk pickable from that peer and less rare"""
+        picker = PiecePicker(range(2))
+        picker.add_peer("a", {0, 1})
+        picker.add_peer("b", set())
+        picker.want(0)
+        picker.want(1)
+        picker.peer_has("b", 0)
+        self.assertEqual(picker.availability[0], 2)
+        self.assertEqual(picker.pick("a"), 1)
+        self.assertEqual(picker.pick("b"), 0)
+
+        picker.remove_peer("a")
+        self.assertEqual(picker.availability, {0: 1, 1: 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+Tests for TimerWheel class
+"""
+import unittest
+from timer_wheel import TimerWheel
+from tests.helpers import FakeClock
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        """Set up a wheel with one second ticks"""
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(1.0, self.clock)
+
+    def test_expires_after_deadline(self):
+        """Test keys expire once their deadline has passed, not before"""
+        self.wheel.schedule("a", 5)
+        self.wheel.schedule("b", 10)
+        self.assertEqual(self.wheel.expire(4.9), [])
+        self.assertEqual(self.wheel.expire(5), ["a"])
+        self.assertNotIn("a", self.wheel)
+        self.assertEqual(self.wheel.expire(20), ["b"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule_moves_deadline(self):
+        """Test scheduling a key again replaces its deadline"""
+        self.wheel.schedule("a", 5)
+        self.clock.now = 4
+        self.wheel.schedule("a", 5)
+        self.assertEqual(self.wheel.expire(8), [])
+        self.assertEqual(self.wheel.expire(9), ["a"])
+
+    def test_cancel(self):
+        """Test a cancelled key never expires"""
+        self.wheel.schedule("a", 1)
+        self.wheel.cancel("a")
+        self.wheel.cancel("missing")
+        self.assertEqual(self.wheel.expire(100), [])
+        self.assertEqual(self.wheel.buckets, {})
+
+    def test_long_idle_gap(self):
+        """Test expiring after a long gap only visits the scheduled buckets"""
+        self.wheel.schedule("a", 3)
+        self.wheel.schedule("b", 7)
+        self.assertEqual(sorted(self.wheel.expire(1e9)), ["a", "b"])
+        self.clock.now = 1e9
+        self.wheel.schedule("c", 1)
+        self.assertEqual(self.wheel.expire(1e9 + 1), ["c"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,6 +21,23 @@ class TestTorrent(unittest.TestCase):
         self.assertEqual(len(self.torrent.seeders), 0)
         self.assertEqual(len(self.torrent.leechers), 0)
 
+    def test_completed_counter(self):
+        """Test a leecher becoming a seeder counts as a completed download"""
+        self.torrent.add_seeder("seeder", self.ip, self.port)
+        self.torrent.add_leecher(self.peer_id, self.ip, self.port)
+        self.torrent.add_seeder(self.peer_id, self.ip, self.port)
+        self.torrent.remove_leecher(self.peer_id)
+        self.assertEqual(self.torrent.scrape(), [2, 0, 1])
+
+    def test_repeated_seed_not_counted(self):
+        """Test a seeder that registers again is not counted as another completed download"""
+        self.torrent.add_leecher(self.peer_id, self.ip, self.port)
+        self.torrent.add_seeder(self.peer_id, self.ip, self.port)
+        self.torrent.add_seeder(self.peer_id, self.ip, self.port)
+        self.torrent.add_leecher(self.peer_id, self.ip, self.port)
+        self.torrent.add_seeder(self.peer_id, self.ip, self.port)
+        self.assertEqual(self.torrent.completed, 1)
+
     def test_add_seeder(self):
         """Test adding a seeder"""
         self.torrent.add_seeder(self.peer_id, self.ip, self.port)
@@ -2,8 +2,13 @@
 Tests for TrackerServer class
 """
 import unittest
+import unittest.mock
+import asyncio
+import base64
+import json
+import tempfile
 from tracker import TrackerServer
-from protocol import PeerServerOperation, ReturnCode, PayloadField
+from protocol import PeerServerOperation, ReturnCode, PayloadField, FRAME_HEADER, unpack_compact_peers
 
 class TestTrackerServer(unittest.TestCase):
     def setUp(self):
@@ -74,4 +79,453 @@ class TestTrackerServer(unittest.TestCase):
             PayloadField.PEER_ID: self.peer_id
         }
         response = self.tracker._handle_stop_seed(stop_request)
-        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
\ No newline at end of file
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+
+    def test_get_torrent_returns_chunk_hashes(self):
+        """Test the chunk hash manifest from UPLOAD_FILE is returned by GET_TORRENT"""
+        hashes = [f"{idx:064x}" for idx in range(3)]
+        add_request = {
+            PayloadField.PEER_ID: self.peer_id,
+            PayloadField.IP_ADDRESS: self.ip,
+            PayloadField.PORT: self.port,
+            PayloadField.FILE_NAME: "test.txt",
+            PayloadField.NUM_OF_CHUNKS: 3,
+            PayloadField.CHUNK_HASHES: hashes
+        }
+        status, torrent_id = self.tracker.add_new_file(add_request)
+
+        get_request = {
+            PayloadField.TORRENT_ID: torrent_id,
+            PayloadField.PEER_ID: "leecher",
+            PayloadField.IP_ADDRESS: self.ip,
+            PayloadField.PORT: "8001"
+        }
+        response = self.tracker._handle_get_torrent(get_request)
+        self.assertEqual(response[PayloadField.TORRENT_OBJECT][PayloadField.CHUNK_HASHES], hashes)
+
+    def test_get_torrent_returns_other_leechers(self):
+        """Test leechers are returned as sources, without the requesting peer"""
+        add_request = {
+            PayloadField.PEER_ID: self.peer_id,
+            PayloadField.IP_ADDRESS: self.ip,
+            PayloadField.PORT: self.port,
+            PayloadField.FILE_NAME: "test.txt",
+            PayloadField.NUM_OF_CHUNKS: 10
+        }
+        status, torrent_id = self.tracker.add_new_file(add_request)
+
+        def get_torrent(peer_id, port):
+            return self.tracker._handle_get_torrent({
+                PayloadField.TORRENT_ID: torrent_id,
+                PayloadField.PEER_ID: peer_id,
+                PayloadField.IP_ADDRESS: self.ip,
+                PayloadField.PORT: port
+            })[PayloadField.TORRENT_OBJECT]
+
+        self.assertEqual(get_torrent("leecher1", "8001")[PayloadField.LEECHER_LIST], {})
+        torrent = get_torrent("leecher2", "8002")
+        self.assertEqual(list(torrent[PayloadField.LEECHER_LIST]), ["leecher1"])
+        self.assertIn(self.peer_id, torrent[PayloadField.SEEDER_LIST])
+
+class TestTrackerIndexes(unittest.TestCase):
+    def setUp(self):
+        """Set up an empty tracker"""
+        self.tracker = TrackerServer()
+
+    def upload(self, peer_id, file_name, hashes=None, port="8000"):
+        request = {
+            PayloadField.PEER_ID: peer_id,
+            PayloadField.IP_ADDRESS: "127.0.0.1",
+            PayloadField.PORT: port,
+            PayloadField.FILE_NAME: file_name,
+            PayloadField.NUM_OF_CHUNKS: 3
+        }
+        if hashes:
+            request[PayloadField.CHUNK_HASHES] = hashes
+        return self.tracker.add_new_file(request)
+
+    def test_filename_is_not_substring_matched(self):
+        """Test a file whose name contains another torrent's name gets its own torrent"""
+        _, first = self.upload("peer1", "my_test.txt")
+        status, second = self.upload("peer2", "test.txt")
+        self.assertEqual(status, ReturnCode.SUCCESS)
+        self.assertNotEqual(first, second)
+
+    def test_same_content_joins_torrent(self):
+        """Test uploading a known manifest adds the uploader as a seeder"""
+        hashes = ["a" * 64, "b" * 64, "c" * 64]
+        _, first = self.upload("peer1", "file.bin", hashes)
+        status, second = self.upload("peer2", "renamed.bin", hashes, port="8001")
+        self.assertEqual((status, second), (ReturnCode.SUCCESS, first))
+        self.assertEqual(set(self.tracker.torrents[first].seeders), {"peer1", "peer2"})
+        self.assertEqual(self.tracker.peer_torrents["peer2"], {first})
+
+    def test_same_name_different_content(self):
+        """Test files with the same name but different manifests are separate torrents"""
+        _, first = self.upload("peer1", "file.bin", ["a" * 64])
+        _, second = self.upload("peer2", "file.bin", ["b" * 64])
+        self.assertNotEqual(first, second)
+
+    def test_already_seeding(self):
+        """Test a peer seeding one torrent cannot upload another"""
+        self.upload("peer1", "one.bin")
+        status, torrent_id = self.upload("peer1", "two.bin")
+        self.assertEqual((status, torrent_id), (ReturnCode.ALREADY_SEEDING, -1))
+
+    def test_stop_seed_cleans_indexes_and_ids_not_reused(self):
+        """Test removing the last seeder drops the torrent from every index"""
+        _, first = self.upload("peer1", "one.bin")
+        _, second = self.upload("peer2", "two.bin")
+        self.tracker.stop_seeding({PayloadField.TORRENT_ID: first, PayloadField.PEER_ID: "peer1"})
+        self.assertNotIn(first, self.tracker.torrents)
+        self.assertNotIn("peer1", self.tracker.peer_torrents)
+        self.assertNotIn("name:one.bin", self.tracker.torrent_by_content)
+
+        _, third = self.upload("peer3", "three.bin")
+        self.assertNotIn(third, (first, second))
+        self.assertEqual(self.tracker.torrents[second].filename, "two.bin")
+
+    def test_remove_peer(self):
+        """Test a peer is removed from every torrent it seeds or leeches"""
+        _, first = self.upload("peer1", "one.bin")
+        _, second = self.upload("peer2", "two.bin")
+        self.tracker.get_torrent_data({PayloadField.TORRENT_ID: second, PayloadField.PEER_ID: "peer1",
+                                       PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000"})
+        self.assertEqual(self.tracker.peer_torrents["peer1"], {first, second})
+
+        self.tracker.remove_peer("peer1")
+        self.assertNotIn(first, self.tracker.torrents)
+        self.assertEqual(self.tracker.torrents[second].leechers, {})
+        self.assertNotIn("peer1", self.tracker.peer_torrents)
+
+class TestTrackerPeerSample(unittest.TestCase):
+    def setUp(self):
+        """Set up a torrent with 30 seeders and 30 leechers"""
+        self.tracker = TrackerServer()
+        _, self.torrent_id = self.tracker.add_new_file({
+            PayloadField.PEER_ID: "seeder0", PayloadField.IP_ADDRESS: "10.0.0.1", PayloadField.PORT: "9000",
+            PayloadField.FILE_NAME: "file.bin", PayloadField.NUM_OF_CHUNKS: 1
+        })
+        self.torrent = self.tracker.torrents[self.torrent_id]
+        for i in range(1, 30):
+            self.torrent.add_seeder(f"seeder{i}", f"10.0.0.{i + 1}", str(9000 + i))
+        for i in range(30):
+            self.torrent.add_leecher(f"leecher{i}", f"10.0.1.{i + 1}", str(9100 + i))
+
+    def get_torrent(self, peer_id, **fields):
+        request = {PayloadField.TORRENT_ID: self.torrent_id, PayloadField.PEER_ID: peer_id,
+                   PayloadField.IP_ADDRESS: "10.0.2.1", PayloadField.PORT: "9500"}
+        request.update(fields)
+        return self.tracker.get_torrent_data(request)
+
+    def test_num_want_bounds_sample(self):
+        """Test at most NUM_WANT peers come back, seeders first"""
+        data = self.get_torrent("new", **{PayloadField.NUM_WANT: 10})
+        self.assertEqual(len(data[PayloadField.SEEDER_LIST]), 10)
+        self.assertEqual(data[PayloadField.LEECHER_LIST], {})
+
+        data = self.get_torrent("new2", **{PayloadField.NUM_WANT: 40})
+        self.assertEqual(len(data[PayloadField.SEEDER_LIST]), 30)
+        self.assertEqual(len(data[PayloadField.LEECHER_LIST]), 10)
+
+    def test_requester_excluded(self):
+        """Test a peer never gets itself back"""
+        for _ in range(20):
+            data = self.get_torrent("seeder3", **{PayloadField.NUM_WANT: 29})
+            self.assertNotIn("seeder3", data[PayloadField.SEEDER_LIST])
+            self.assertEqual(len(data[PayloadField.SEEDER_LIST]), 29)
+
+    def test_compact_peers(self):
+        """Test compact responses pack IPv4 peers into 6 bytes each"""
+        self.torrent.remove_leecher("leecher0")
+        self.torrent.add_leecher("leecher0", "::1", "9100")
+        data = self.get_torrent("new", **{PayloadField.NUM_WANT: 60, PayloadField.COMPACT: True})
+        seeders = unpack_compact_peers(base64.b64decode(data[PayloadField.COMPACT_SEEDERS]))
+        self.assertEqual(data[PayloadField.SEEDER_LIST], {})
+        self.assertEqual(len(seeders), 30)
+        self.assertIn(("10.0.0.1", 9000), seeders)
+        # Peers that cannot be packed stay in the regular list
+        self.assertEqual(list(data[PayloadField.LEECHER_LIST]), ["leecher0"])
+        self.assertEqual(len(base64.b64decode(data[PayloadField.COMPACT_LEECHERS])), 29 * 6)
+
+    def test_sample_index_follows_removals(self):
+        """Test removed peers are never sampled"""
+        for i in range(0, 30, 2):
+            self.torrent.remove_seeder(f"seeder{i}")
+        data = self.get_torrent("new", **{PayloadField.NUM_WANT: 15})
+        self.assertEqual(set(data[PayloadField.SEEDER_LIST]), {f"seeder{i}" for i in range(1, 30, 2)})
+
+class TestTrackerLiveness(unittest.TestCase):
+    def setUp(self):
+        """Set up a tracker on a fake clock with one seeded torrent"""
+        self.now = 0.0
+        self.tracker = TrackerServer(announce_interval=10, peer_timeout=30, clock=lambda: self.now)
+        self.request(PeerServerOperation.UPLOAD_FILE, "seeder", **{
+            PayloadField.FILE_NAME: "file.bin", PayloadField.NUM_OF_CHUNKS: 1})
+
+    def request(self, opcode, peer_id, **fields):
+        request = {PayloadField.OPERATION_CODE: opcode, PayloadField.PEER_ID: peer_id,
+                   PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000", PayloadField.TORRENT_ID: 0}
+        request.update(fields)
+        return self.tracker.handle_request(request)
+
+    def test_responses_carry_interval(self):
+        """Test listed peers are told how often to announce"""
+        response = self.request(PeerServerOperation.GET_TORRENT, "leecher")
+        self.assertEqual(response[PayloadField.INTERVAL], 10)
+
+    def test_silent_peers_expire(self):
+        """Test a peer that stops announcing is dropped after the timeout"""
+        self.request(PeerServerOperation.GET_TORRENT, "leecher")
+        self.now = 20
+        self.assertEqual(self.request(PeerServerOperation.ANNOUNCE, "seeder")[PayloadField.RETURN_CODE],
+                         ReturnCode.SUCCESS)
+
+        self.assertEqual(self.tracker.expire_peers(30), ["leecher"])
+        self.assertEqual(self.tracker.torrents[0].leechers, {})
+        self.assertNotIn("leecher", self.tracker.peer_torrents)
+
+        # The seeder announced at 20 and lives until 50
+        self.assertEqual(self.tracker.expire_peers(49), [])
+        self.assertEqual(self.tracker.expire_peers(50), ["seeder"])
+        self.assertNotIn(0, self.tracker.torrents)
+
+    def test_cached_list_keeps_peers_alive(self):
+        """Test a cached GET_LIST page still refreshes the requester and carries INTERVAL"""
+        def get_list(peer_id):
+            request = {PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST, PayloadField.PEER_ID: peer_id}
+            return json.loads(self.tracker.encode_response(request)[FRAME_HEADER.size:])
+
+        self.assertNotIn(PayloadField.INTERVAL, get_list("stranger"))
+        self.assertEqual(get_list("seeder")[PayloadField.INTERVAL], 10)
+        self.now = 20
+        self.assertEqual(get_list("seeder")[PayloadField.INTERVAL], 10)
+        self.assertNotIn(PayloadField.INTERVAL, get_list("stranger"))
+        self.assertEqual(self.tracker.expire_peers(49), [])
+        self.assertEqual(self.tracker.expire_peers(50), ["seeder"])
+
+    def test_unknown_peer_announce(self):
+        """Test an expired peer is told to register again"""
+        self.tracker.expire_peers(100)
+        response = self.request(PeerServerOperation.ANNOUNCE, "seeder")
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.NOT_FOUND)
+        self.assertNotIn(PayloadField.INTERVAL, response)
+
+    def test_stop_seed_cancels_expiry(self):
+        """Test a peer that leaves is no longer tracked for expiry"""
+        self.request(PeerServerOperation.UPLOAD_FILE, "other", **{
+            PayloadField.FILE_NAME: "other.bin", PayloadField.NUM_OF_CHUNKS: 1})
+        self.request(PeerServerOperation.STOP_SEED, "other", **{PayloadField.TORRENT_ID: 1})
+        self.assertNotIn("other", self.tracker.expiry)
+
+class TestTrackerScrape(unittest.TestCase):
+    def setUp(self):
+        """Set up a torrent with a seeder, two leechers and one completed download"""
+        self.tracker = TrackerServer()
+        self.request(PeerServerOperation.UPLOAD_FILE, "seeder", **{
+            PayloadField.FILE_NAME: "file.bin", PayloadField.NUM_OF_CHUNKS: 1})
+        for peer_id in ("leecher1", "leecher2", "leecher3"):
+            self.request(PeerServerOperation.GET_TORRENT, peer_id, **{PayloadField.TORRENT_ID: 0})
+        self.request(PeerServerOperation.START_SEED, "leecher3", **{PayloadField.TORRENT_ID: 0})
+
+    def request(self, opcode, peer_id=None, **fields):
+        request = {PayloadField.OPERATION_CODE: opcode, PayloadField.IP_ADDRESS: "127.0.0.1",
+                   PayloadField.PORT: "8000"}
+        if peer_id:
+            request[PayloadField.PEER_ID] = peer_id
+        request.update(fields)
+        return self.tracker.handle_request(request)
+
+    def test_scrape_counts(self):
+        """Test scrape returns seeders, leechers and completed downloads and skips unknown ids"""
+        response = self.request(PeerServerOperation.SCRAPE, **{PayloadField.TORRENT_IDS: [0, 42]})
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+        self.assertEqual(response[PayloadField.SWARM_COUNTS], [[0, 2, 2, 1]])
+
+    def test_repeated_start_seed_counted_once(self):
+        """Test a completed leecher starting to seed again does not count twice"""
+        self.request(PeerServerOperation.START_SEED, "leecher3", **{PayloadField.TORRENT_ID: 0})
+        self.request(PeerServerOperation.GET_TORRENT, "leecher3", **{PayloadField.TORRENT_ID: 0})
+        self.request(PeerServerOperation.START_SEED, "leecher3", **{PayloadField.TORRENT_ID: 0})
+        response = self.request(PeerServerOperation.SCRAPE, **{PayloadField.TORRENT_IDS: [0]})
+        self.assertEqual(response[PayloadField.SWARM_COUNTS], [[0, 2, 2, 1]])
+
+    def test_scrape_has_no_side_effects(self):
+        """Test scraping does not join the swarm or change the list version"""
+        version = self.tracker.version
+        self.request(PeerServerOperation.SCRAPE, "dashboard", **{PayloadField.TORRENT_IDS: [0]})
+        self.assertEqual(self.tracker.version, version)
+        self.assertFalse(self.tracker.torrents[0].has_peer("dashboard"))
+        self.assertNotIn("dashboard", self.tracker.peer_torrents)
+
+    def test_scrape_all(self):
+        """Test a scrape without ids covers every torrent"""
+        self.request(PeerServerOperation.UPLOAD_FILE, "other", **{
+            PayloadField.FILE_NAME: "other.bin", PayloadField.NUM_OF_CHUNKS: 1})
+        response = self.request(PeerServerOperation.SCRAPE)
+        self.assertEqual(response[PayloadField.SWARM_COUNTS], [[0, 2, 2, 1], [1, 1, 0, 0]])
+
+class TestTrackerPersistence(unittest.TestCase):
+    def setUp(self):
+        """Set up an empty state directory"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def tracker(self) -> TrackerServer:
+        tracker = TrackerServer(state_dir=self.tmpdir.name)
+        tracker.restore()
+        return tracker
+
+    def request(self, tracker, opcode, peer_id, **fields):
+        request = {PayloadField.OPERATION_CODE: opcode, PayloadField.PEER_ID: peer_id,
+                   PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000"}
+        request.update(fields)
+        response = tracker.handle_request(request)
+
+        async def persist():
+            await tracker.persist()
+            if tracker._snapshot_task is not None:
+                await tracker._snapshot_task
+        asyncio.run(persist())
+        return response
+
+    def upload(self, tracker, peer_id, file_name):
+        return self.request(tracker, PeerServerOperation.UPLOAD_FILE, peer_id, **{
+            PayloadField.FILE_NAME: file_name, PayloadField.NUM_OF_CHUNKS: 2,
+            PayloadField.CHUNK_HASHES: [file_name * 2, file_name * 3]})[PayloadField.TORRENT_ID]
+
+    def populate(self, tracker):
+        self.upload(tracker, "peer1", "one.bin")
+        second = self.upload(tracker, "peer2", "two.bin")
+        self.upload(tracker, "peer3", "three.bin")
+        self.request(tracker, PeerServerOperation.GET_TORRENT, "peer4", **{PayloadField.TORRENT_ID: second})
+        self.request(tracker, PeerServerOperation.GET_TORRENT, "peer6", **{PayloadField.TORRENT_ID: second})
+        self.request(tracker, PeerServerOperation.START_SEED, "peer6", **{PayloadField.TORRENT_ID: second})
+        self.request(tracker, PeerServerOperation.STOP_SEED, "peer3", **{PayloadField.TORRENT_ID: 2})
+        tracker.journal.close()
+
+    def assertSameRegistry(self, restored, expected):
+        self.assertEqual(restored.next_torrent_id, expected.next_torrent_id)
+        self.assertEqual(restored.peer_torrents, expected.peer_torrents)
+        self.assertEqual(restored.torrent_by_content, expected.torrent_by_content)
+        self.assertEqual(sorted(restored.torrents), sorted(expected.torrents))
+        for torrent_id, torrent in expected.torrents.items():
+            self.assertEqual(restored.torrents[torrent_id].scrape(), torrent.scrape())
+            self.assertEqual(restored.torrents[torrent_id].seeders, torrent.seeders)
+            self.assertEqual(restored.torrents[torrent_id].leechers, torrent.leechers)
+            self.assertEqual(restored.torrents[torrent_id].chunk_hashes, torrent.chunk_hashes)
+
+    def test_only_changes_wait_for_the_journal(self):
+        """Test read-only requests are answered without waiting for a journal commit"""
+        tracker = self.tracker()
+        tracker.journal.commit = unittest.mock.AsyncMock()
+
+        async def respond(opcode, peer_id, **fields):
+            request = {PayloadField.OPERATION_CODE: opcode, PayloadField.PEER_ID: peer_id,
+                       PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000"}
+            request.update(fields)
+            await tracker.respond_locally(request)
+            return tracker.journal.commit.await_count
+
+        async def run():
+            self.assertEqual(await respond(PeerServerOperation.UPLOAD_FILE, "peer1", **{
+                PayloadField.FILE_NAME: "one.bin", PayloadField.NUM_OF_CHUNKS: 2}), 1)
+            self.assertEqual(await respond(PeerServerOperation.GET_LIST, "peer1"), 1)
+            self.assertEqual(await respond(PeerServerOperation.ANNOUNCE, "peer1"), 1)
+            self.assertEqual(await respond(PeerServerOperation.GET_TORRENT, "peer2",
+                                           **{PayloadField.TORRENT_ID: 0}), 2)
+        asyncio.run(run())
+        tracker.journal.close()
+
+    def test_restore_from_journal(self):
+        """Test a restarted tracker replays the journal, keeping ids unique"""
+        original = self.tracker()
+        self.populate(original)
+        restored = self.tracker()
+        self.assertSameRegistry(restored, original)
+        self.assertIn("peer4", restored.expiry)
+        self.assertEqual(self.upload(restored, "peer5", "five.bin"), 3)
+
+    def test_restore_from_snapshot_and_journal_tail(self):
+        """Test recovery loads the snapshot and replays only the events after it"""
+        original = self.tracker()
+        original.journal.snapshot_every = 7
+        self.upload(original, "peer1", "one.bin")
+        self.upload(original, "peer2", "two.bin")
+        self.upload(original, "peer3", "three.bin")
+        self.request(original, PeerServerOperation.GET_TORRENT, "peer4", **{PayloadField.TORRENT_ID: 1})
+        self.assertEqual(original.journal.generation, 1)
+        self.request(original, PeerServerOperation.STOP_SEED, "peer3", **{PayloadField.TORRENT_ID: 2})
+        original.journal.close()
+
+        restored = TrackerServer(state_dir=self.tmpdir.name)
+        state, events = restored.journal.load()
+        self.assertEqual(len(state['torrents']), 3)
+        self.assertEqual(events, [['stop', 2, 'peer3']])
+        restored.journal.close()
+        self.assertSameRegistry(self.tracker(), original)
+
+class TestTrackerList(unittest.TestCase):
+    def setUp(self):
+        """Set up a tracker with five torrents"""
+        self.tracker = TrackerServer()
+        for idx in range(5):
+            self.tracker.add_new_file({
+                PayloadField.PEER_ID: f"peer{idx}",
+                PayloadField.IP_ADDRESS: "127.0.0.1",
+                PayloadField.PORT: str(8000 + idx),
+                PayloadField.FILE_NAME: f"file{idx}.bin",
+                PayloadField.NUM_OF_CHUNKS: 3
+            })
+
+    def get_list(self, **fields):
+        request = {PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST}
+        request.update({PayloadField[name.upper()]: value for name, value in fields.items()})
+        return json.loads(self.tracker.encode_response(request)[FRAME_HEADER.size:])
+
+    def test_pagination(self):
+        """Test offset and limit select a page and the total is reported"""
+        response = self.get_list(offset=1, limit=2)
+        self.assertEqual([t[PayloadField.TORRENT_ID] for t in response[PayloadField.TORRENT_LIST]], [1, 2])
+        self.assertEqual(response[PayloadField.TOTAL], 5)
+        self.assertEqual(self.get_list(offset=10)[PayloadField.TORRENT_LIST], [])
+
+    def test_summary_has_counts_only(self):
+        """Test summary entries carry counts instead of peer lists"""
+        entry = self.get_list(summary=True)[PayloadField.TORRENT_LIST][0]
+        self.assertEqual(entry[PayloadField.NUM_SEEDERS], 1)
+        self.assertEqual(entry[PayloadField.NUM_LEECHERS], 0)
+        self.assertNotIn(PayloadField.SEEDER_LIST, entry)
+
+    def test_not_modified(self):
+        """Test a client holding the current version gets a tiny reply"""
+        version = self.get_list()[PayloadField.VERSION]
+        response = self.get_list(version=version)
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.NOT_MODIFIED)
+        self.assertNotIn(PayloadField.TORRENT_LIST, response)
+
+    def test_change_invalidates_cache(self):
+        """Test a change is visible in the next list and bumps the version"""
+        first = self.tracker.encode_response({PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST})
+        self.assertIs(self.tracker.encode_response({PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST}), first)
+        version = self.tracker.version
+
+        self.tracker.get_torrent_data({PayloadField.TORRENT_ID: 2, PayloadField.PEER_ID: "leecher",
+                                       PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "9000"})
+        response = self.get_list(version=version)
+        self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+        self.assertGreater(response[PayloadField.VERSION], version)
+        self.assertIn("leecher", response[PayloadField.TORRENT_LIST][2][PayloadField.LEECHER_LIST])
+
+    def test_repeated_get_torrent_is_not_a_change(self):
+        """Test a peer already in the swarm asking for the torrent again keeps the version"""
+        request = {PayloadField.TORRENT_ID: 2, PayloadField.PEER_ID: "leecher",
+                   PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "9000"}
+        self.tracker.get_torrent_data(request)
+        version = self.tracker.version
+        self.tracker.get_torrent_data(request)
+        self.tracker.get_torrent_data(dict(request, **{PayloadField.PEER_ID: "peer2"}))
+        self.assertEqual(self.tracker.version, version)
+        self.assertNotIn("peer2", self.tracker.torrents[2].leechers)
@@ -0,0 +1,57 @@
+"""
+Tests for TrackerSession class
+"""
+import unittest
+import asyncio
+from tracker import TrackerServer
+from tracker_session import TrackerSession
+from protocol import PeerServerOperation, ReturnCode, PayloadField
+
+class TestTrackerSession(unittest.TestCase):
+    def run_with_tracker(self, test, idle_timeout=60):
+        async def run():
+            tracker = TrackerServer(idle_timeout=idle_timeout)
+            connections = []
+
+            async def handle(reader, writer):
+                connections.append(writer)
+                await tracker.receive_request(reader, writer)
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            session = TrackerSession("127.0.0.1", server.sockets[0].getsockname()[1])
+            try:
+                async with server:
+                    await test(session, connections)
+            finally:
+                session.close()
+        asyncio.run(run())
+
+    @staticmethod
+    def upload(peer_id: str) -> dict:
+        return {PayloadField.OPERATION_CODE: PeerServerOperation.UPLOAD_FILE, PayloadField.PEER_ID: peer_id,
+                PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000",
+                PayloadField.FILE_NAME: f"{peer_id}.bin", PayloadField.NUM_OF_CHUNKS: 1}
+
+    def test_requests_share_one_connection(self):
+        """Test many requests travel over a single tracker connection"""
+        async def test(session, connections):
+            for i in range(5):
+                response = await session.request(self.upload(f"peer{i}"))
+                self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+            response = await session.request({PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST})
+            self.assertEqual(len(response[PayloadField.TORRENT_LIST]), 5)
+            self.assertEqual(len(connections), 1)
+        self.run_with_tracker(test)
+
+    def test_reconnects_after_idle_timeout(self):
+        """Test a session the tracker closed for idling is reopened transparently"""
+        async def test(session, connections):
+            await session.request(self.upload("peer1"))
+            await asyncio.sleep(0.3)
+            response = await session.request(self.upload("peer2"))
+            self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+            self.assertEqual(len(connections), 2)
+            self.assertTrue(connections[0].is_closing())
+        self.run_with_tracker(test, idle_timeout=0.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests for the sharded tracker
+"""
+import unittest
+import asyncio
+import json
+import tempfile
+from tracker import TrackerServer
+from tracker_shards import ShardRouter, shard_of
+from protocol import PeerServerOperation, ReturnCode, PayloadField, FRAME_HEADER
+
+class TestShardOf(unittest.TestCase):
+    def test_routes_by_torrent_id(self):
+        """Test torrent requests go to the shard of their id"""
+        request = {PayloadField.OPERATION_CODE: PeerServerOperation.GET_TORRENT, PayloadField.TORRENT_ID: 7}
+        self.assertEqual(shard_of(request, 4), 3)
+        self.assertIsNone(shard_of({PayloadField.OPERATION_CODE: PeerServerOperation.ANNOUNCE,
+                                    PayloadField.TORRENT_ID: None}, 4))
+
+    def test_same_content_same_shard(self):
+        """Test uploads of the same manifest under different names meet in one shard"""
+        hashes = ["a" * 64, "b" * 64]
+        shards = {shard_of({PayloadField.OPERATION_CODE: PeerServerOperation.UPLOAD_FILE,
+                            PayloadField.FILE_NAME: name, PayloadField.CHUNK_HASHES: hashes}, 8)
+                  for name in ("one.bin", "two.bin", "three.bin")}
+        self.assertEqual(len(shards), 1)
+
+    def test_shard_hands_out_its_own_ids(self):
+        """Test a shard's torrent ids all map back to it"""
+        tracker = TrackerServer(shard=2, num_shards=3)
+        ids = [tracker.add_new_file({PayloadField.PEER_ID: f"peer{i}", PayloadField.IP_ADDRESS: "127.0.0.1",
+                                     PayloadField.PORT: "8000", PayloadField.FILE_NAME: f"{i}.bin",
+                                     PayloadField.NUM_OF_CHUNKS: 1})[1] for i in range(3)]
+        self.assertEqual(ids, [2, 5, 8])
+
+class TestShardRouter(unittest.TestCase):
+    def test_forwarding_and_merged_list(self):
+        """Test requests reach the owning shard and GET_LIST merges every shard"""
+        async def run():
+            with tempfile.TemporaryDirectory() as socket_dir:
+                trackers = [TrackerServer(shard=shard, num_shards=3) for shard in range(3)]
+                servers = []
+                for tracker in trackers:
+                    tracker.router = ShardRouter(tracker, socket_dir)
+                    servers.append(await tracker.router.start())
+                entry = trackers[0]
+
+                async def call(opcode, peer_id, **fields):
+                    request = {PayloadField.OPERATION_CODE: opcode, PayloadField.PEER_ID: peer_id,
+                               PayloadField.IP_ADDRESS: "127.0.0.1", PayloadField.PORT: "8000"}
+                    request.update(fields)
+                    return json.loads((await entry.respond(request))[FRAME_HEADER.size:])
+
+                ids = []
+                for i in range(9):
+                    response = await call(PeerServerOperation.UPLOAD_FILE, f"peer{i}", **{
+                        PayloadField.FILE_NAME: f"{i}.bin", PayloadField.NUM_OF_CHUNKS: 1})
+                    self.assertEqual(response[PayloadField.RETURN_CODE], ReturnCode.SUCCESS)
+                    ids.append(response[PayloadField.TORRENT_ID])
+                for torrent_id in ids:
+                    self.assertIn(torrent_id, trackers[torrent_id % 3].torrents)
+
+                torrent_id = next(i for i in ids if i % 3 != 0)
+                response = await call(PeerServerOperation.GET_TORRENT, "leecher", **{PayloadField.TORRENT_ID: torrent_id})
+                self.assertEqual(response[PayloadField.TORRENT_OBJECT][PayloadField.TORRENT_ID], torrent_id)
+                self.assertIn("leecher", trackers[torrent_id % 3].torrents[torrent_id].leechers)
+
+                page = await call(PeerServerOperation.GET_LIST, "leecher", **{PayloadField.OFFSET: 2,
+                                                                              PayloadField.LIMIT: 4})
+                self.assertEqual(page[PayloadField.TOTAL], 9)
+                self.assertEqual([e[PayloadField.TORRENT_ID] for e in page[PayloadField.TORRENT_LIST]],
+                                 sorted(ids)[2:6])
+                scrape = await call(PeerServerOperation.SCRAPE, "dashboard", **{
+                    PayloadField.TORRENT_IDS: sorted(ids)[:4] + [1000]})
+                self.assertEqual(sorted(row[0] for row in scrape[PayloadField.SWARM_COUNTS]), sorted(ids)[:4])
+                scrape = await call(PeerServerOperation.SCRAPE, "dashboard")
+                self.assertEqual(len(scrape[PayloadField.SWARM_COUNTS]), 9)
+
+                unchanged = await call(PeerServerOperation.GET_LIST, "leecher", **{
+                    PayloadField.VERSION: page[PayloadField.VERSION]})
+                self.assertEqual(unchanged[PayloadField.RETURN_CODE], ReturnCode.NOT_MODIFIED)
+
+                for tracker in trackers:
+                    for _, writer in sum(tracker.router._idle.values(), []):
+                        writer.close()
+                for server in servers:
+                    server.close()
+                    await server.wait_closed()
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
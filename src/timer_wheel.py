@@ -0,0 +1,65 @@
+"""
+Timer wheel for p2p file sharing.
+Expires keys (e.g. tracker peers that stopped announcing) without scanning
+everything that is still alive.
+"""
+import math
+import time
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Deadlines are rounded up to ticks of `resolution`
+    seconds and every tick hashes to a bucket of keys, so scheduling,
+    rescheduling and cancelling a key are O(1), and expire() costs
+    O(expired keys + elapsed ticks) however many keys are scheduled.
+    """
+    def __init__(self, resolution=1.0, clock=time.monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        self.buckets = {}  # tick -> set of keys
+        self.deadlines = {}  # key -> tick
+        self.current = self._tick(clock())  # first tick not expired yet
+
+    def _tick(self, t: float) -> int:
+        return math.ceil(t / self.resolution)
+
+    def schedule(self, key, delay: float):
+        """(Re)schedule a key to expire `delay` seconds from now"""
+        self.cancel(key)
+        tick = max(self._tick(self.clock() + delay), self.current)
+        self.deadlines[key] = tick
+        self.buckets.setdefault(tick, set()).add(key)
+
+    def cancel(self, key):
+        tick = self.deadlines.pop(key, None)
+        if tick is not None:
+            bucket = self.buckets[tick]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[tick]
+
+    def expire(self, now=None) -> list:
+        """Remove and return the keys whose deadline has passed"""
+        now = self.clock() if now is None else now
+        last = math.floor(now / self.resolution)
+        if last < self.current:
+            return []
+        if last - self.current > len(self.buckets):
+            # Idle for longer than there are buckets: visit the buckets instead of every tick
+            ticks = sorted(tick for tick in self.buckets if tick <= last)
+        else:
+            ticks = range(self.current, last + 1)
+
+        expired = []
+        for tick in ticks:
+            for key in self.buckets.pop(tick, ()):
+                del self.deadlines[key]
+                expired.append(key)
+        self.current = last + 1
+        return expired
+
+    def __contains__(self, key) -> bool:
+        return key in self.deadlines
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
@@ -1,32 +1,100 @@
+import hashlib
+import random
 from protocol import PayloadField
 
+def content_key(file_name, chunk_hashes=None) -> str:
+    """
+    Identify a torrent's content: the digest of its chunk hash manifest, or
+    the exact file name for uploads without a manifest
+    """
+    if chunk_hashes:
+        return "sha256:" + hashlib.sha256("".join(chunk_hashes).encode()).hexdigest()
+    return "name:" + file_name
+
+class PeerSample:
+    """
+    Peer ids in an array with a position map, so adding, removing (swap
+    with the last entry and pop) and drawing a random sample are O(1) per peer
+    """
+    def __init__(self):
+        self.ids = []
+        self._pos = {}
+
+    def add(self, id):
+        if id not in self._pos:
+            self._pos[id] = len(self.ids)
+            self.ids.append(id)
+
+    def remove(self, id):
+        pos = self._pos.pop(id, None)
+        if pos is None:
+            return
+        last = self.ids.pop()
+        if last != id:
+            self.ids[pos] = last
+            self._pos[last] = pos
+
+    def sample(self, count: int, exclude=None) -> list:
+        """Up to `count` random peer ids, leaving out `exclude`"""
+        if count <= 0:
+            return []
+        if count + 1 >= len(self.ids):
+            ids = list(self.ids)
+            random.shuffle(ids)
+        else:
+            ids = random.sample(self.ids, count + 1)
+        return [id for id in ids if id != exclude][:count]
+
+    def __len__(self):
+        return len(self.ids)
+
 class Torrent:
-    def __init__(self, id, file_name, num_of_chunks):
+    def __init__(self, id, file_name, num_of_chunks, file_size=0, chunk_hashes=None):
         self.id = id
         self.filename = file_name
         self.num_of_chunks = num_of_chunks
+        self.file_size = file_size
+        self.chunk_hashes = chunk_hashes or []
+        self.content_key = content_key(file_name, self.chunk_hashes)
         self.seeders = dict()  
         self.leechers = dict()
+        self.completed = 0  # leechers that finished and became seeders
+        self._seeder_sample = PeerSample()
+        self._leecher_sample = PeerSample()
 
     def add_seeder(self, id, ip, port):
+        # A seeder announcing again (or also listed as a leecher) did not finish another download
+        if id in self.leechers and id not in self.seeders:
+            self.completed += 1
         seeder = dict()
         seeder[PayloadField.IP_ADDRESS] = ip
         seeder[PayloadField.PORT] = port
         self.seeders[id] = seeder
+        self._seeder_sample.add(id)
 
     def add_leecher(self, id, ip, port):
         leecher = dict()
         leecher[PayloadField.IP_ADDRESS] = ip
         leecher[PayloadField.PORT] = port
         self.leechers[id] = leecher
+        self._leecher_sample.add(id)
 
     def remove_seeder(self, id: str):
         if id in self.seeders:
             del self.seeders[id]
+            self._seeder_sample.remove(id)
 
     def remove_leecher(self, id: str):
         if id in self.leechers:
             del self.leechers[id]
+            self._leecher_sample.remove(id)
+
+    def has_peer(self, id: str) -> bool:
+        return id in self.seeders or id in self.leechers
+
+    def scrape(self) -> list:
+        """Swarm counters: [seeders, leechers, completed]"""
+        return [len(self.seeders), len(self.leechers), self.completed]
 
     def get_seeders(self) -> dict:
         return self.seeders
@@ -34,6 +102,16 @@ class Torrent:
     def get_leechers(self) -> dict:
         return self.leechers
     
+    def sample_peers(self, num_want: int, exclude=None) -> tuple[dict, dict]:
+        """
+        Random seeders and leechers, at most num_want in total and seeders
+        first, leaving out the peer `exclude`
+        """
+        seeder_ids = self._seeder_sample.sample(num_want, exclude)
+        leecher_ids = self._leecher_sample.sample(num_want - len(seeder_ids), exclude)
+        return ({id: self.seeders[id] for id in seeder_ids},
+                {id: self.leechers[id] for id in leecher_ids})
+
     def get_filename(self):
         return self.filename
     
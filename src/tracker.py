@@ -2,53 +2,141 @@
 Tracker server for p2p file sharing.
 Manages torrents and peer connections.
 """
-from torrent import Torrent
-from protocol import PeerServerOperation, ReturnCode, PayloadField, READ_SIZE, MAX_TRACKER_CONNECTIONS
+from torrent import Torrent, content_key
+from protocol import PeerServerOperation, ReturnCode, PayloadField, MAX_TRACKER_CONNECTIONS, LIST_PAGE_SIZE, \
+    MAX_LIST_PAGE_SIZE, DEFAULT_NUM_WANT, MAX_NUM_WANT, ANNOUNCE_INTERVAL, PEER_TIMEOUT, EXPIRY_RESOLUTION, \
+    TRACKER_IDLE_TIMEOUT, TRACKER_STATE_DIR, encode_message, read_frame, decode_frame, pack_compact_peer
 import asyncio
-import json
+import base64
+import gc
+import itertools
+import struct
 import sys
+import time
+from journal import Journal
+from metrics import TrackerMetrics, serve_metrics
 from logger import setup_logger
 from connection_limiter import ConnectionLimiter
+from timer_wheel import TimerWheel
 
 logger = setup_logger()
 
 class TrackerServer:
-    def __init__(self):
-        self.next_torrent_id = 0 
+    """
+    Torrent registry. Torrents are also indexed by content key and by peer
+    id, so uploads, seed updates and peer removal do not scan every torrent.
+    """
+    MAX_CACHED_PAGES = 64
+
+    def __init__(self, announce_interval=ANNOUNCE_INTERVAL, peer_timeout=PEER_TIMEOUT, clock=time.monotonic,
+                 state_dir=None, shard=0, num_shards=1, idle_timeout=TRACKER_IDLE_TIMEOUT):
+        self.shard = shard
+        self.num_shards = num_shards
+        self.router = None
+        self.next_torrent_id = shard  # ids go shard, shard + num_shards, ... so id % num_shards is the shard
         self.torrents = {} # {torrentId: Torrent}
-        self.limiter = ConnectionLimiter(MAX_TRACKER_CONNECTIONS)
-        self.receive_request = self.limiter.limit_connections(self.receive_request)
+        self.torrent_by_content = {}  # {content key: torrentId}
+        self.peer_torrents = {}  # {peerId: set of torrentIds}
+        self.version = 0
+        self._list_entries = {}  # {(torrentId, summary): GET_LIST entry}
+        self._list_pages = {}  # {(offset, limit, summary, listed): encoded response}
+        self.announce_interval = announce_interval
+        self.peer_timeout = peer_timeout
+        self.expiry = TimerWheel(EXPIRY_RESOLUTION, clock)  # peerId -> time it is dropped
+        self.journal = Journal(state_dir) if state_dir else None
+        self._replaying = False
+        self._snapshot_task = None
+        self._snapshot_rows = {}  # {torrentId: snapshot row}, rebuilt only when the torrent changes
+        self.idle_timeout = idle_timeout
+        self.metrics = TrackerMetrics()
+        self.limiter = ConnectionLimiter(MAX_TRACKER_CONNECTIONS, self.metrics.limiter_wait.observe)
+        self.respond = self.limiter.limit_connections(self.respond)
 
     def handle_request(self, request) -> dict:
         """Handle incoming client request and return response"""
         operation = request.get(PayloadField.OPERATION_CODE)
-        response = {PayloadField.OPERATION_CODE: operation}
         
         if operation == PeerServerOperation.GET_LIST:
-            return self._handle_get_list()
+            response = self._handle_get_list(request)
         elif operation == PeerServerOperation.GET_TORRENT:
-            return self._handle_get_torrent(request)
+            response = self._handle_get_torrent(request)
         elif operation == PeerServerOperation.START_SEED:
-            return self._handle_start_seed(request)
+            response = self._handle_start_seed(request)
         elif operation == PeerServerOperation.STOP_SEED:
-            return self._handle_stop_seed(request)
+            response = self._handle_stop_seed(request)
         elif operation == PeerServerOperation.UPLOAD_FILE:
-            return self._handle_upload_file(request)
+            response = self._handle_upload_file(request)
+        elif operation == PeerServerOperation.ANNOUNCE:
+            response = self._handle_announce(request)
+        elif operation == PeerServerOperation.SCRAPE:
+            response = self._handle_scrape(request)
         else:
             return {PayloadField.OPERATION_CODE: operation, PayloadField.RETURN_CODE: ReturnCode.FAIL}
 
-    def _handle_get_list(self) -> dict:
-        """Handle request for list of available torrents"""
-        torrent_list = self.get_torrent_list()
-        if torrent_list:
+        if self._keep_alive(request):
+            response[PayloadField.INTERVAL] = self.announce_interval
+        return response
+
+    def _keep_alive(self, request) -> bool:
+        """Push back the expiry of a listed requester; False if it is not listed"""
+        peer_id = request.get(PayloadField.PEER_ID)
+        if peer_id not in self.peer_torrents:
+            return False
+        self.expiry.schedule(peer_id, self.peer_timeout)
+        return True
+
+    def encode_response(self, request) -> bytes:
+        """
+        Handle a request and return the encoded response. GET_LIST pages
+        are encoded once per registry version.
+        """
+        if (request.get(PayloadField.OPERATION_CODE) == PeerServerOperation.GET_LIST
+                and request.get(PayloadField.VERSION) != self.version):
+            # Listed peers get INTERVAL, so they get their own copy of each page
+            listed = self._keep_alive(request)
+            key = self._list_page(request) + (listed,)
+            frame = self._list_pages.get(key)
+            if frame is None:
+                if len(self._list_pages) >= self.MAX_CACHED_PAGES:
+                    self._list_pages.clear()
+                response = self._handle_get_list(request)
+                if listed:
+                    response[PayloadField.INTERVAL] = self.announce_interval
+                frame = self._list_pages[key] = encode_message(response)
+            return frame
+        return encode_message(self.handle_request(request))
+
+    def _list_page(self, request) -> tuple:
+        """Normalized (offset, limit, summary) of a GET_LIST request"""
+        offset = max(0, int(request.get(PayloadField.OFFSET) or 0))
+        limit = int(request.get(PayloadField.LIMIT) or LIST_PAGE_SIZE)
+        return offset, min(max(limit, 1), MAX_LIST_PAGE_SIZE), bool(request.get(PayloadField.SUMMARY))
+
+    def _handle_get_list(self, request=None) -> dict:
+        """
+        Handle request for a page of the available torrents. Every change
+        bumps `version`; a client that already has it gets NOT_MODIFIED.
+        """
+        request = request or {}
+        if not self.torrents:
             return {
                 PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST,
-                PayloadField.TORRENT_LIST: torrent_list,
-                PayloadField.RETURN_CODE: ReturnCode.SUCCESS
+                PayloadField.RETURN_CODE: ReturnCode.NO_AVAILABLE_TORRENTS
             }
+        if request.get(PayloadField.VERSION) == self.version:
+            return {
+                PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST,
+                PayloadField.RETURN_CODE: ReturnCode.NOT_MODIFIED,
+                PayloadField.VERSION: self.version
+            }
+        offset, limit, summary = self._list_page(request)
         return {
             PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST,
-            PayloadField.RETURN_CODE: ReturnCode.NO_AVAILABLE_TORRENTS
+            PayloadField.TORRENT_LIST: self.get_torrent_list(offset, limit, summary),
+            PayloadField.VERSION: self.version,
+            PayloadField.TOTAL: len(self.torrents),
+            PayloadField.OFFSET: offset,
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS
         }
 
     def _handle_get_torrent(self, request) -> dict:
@@ -93,40 +181,157 @@ class TrackerServer:
             PayloadField.TORRENT_ID: torrent_id
         }
 
-    def get_torrent_list(self) -> list:
-        """Get list of all available torrents"""
-        return [{
-            PayloadField.TORRENT_ID: torrent.id,
-            PayloadField.FILE_NAME: torrent.filename,
-            PayloadField.NUM_OF_CHUNKS: torrent.num_of_chunks,
-            PayloadField.SEEDER_LIST: torrent.get_seeders(),
-            PayloadField.LEECHER_LIST: torrent.get_leechers()
-        } for torrent in self.torrents.values()]
+    def _handle_announce(self, request) -> dict:
+        """
+        Handle a peer's periodic announce. Being listed is all it needs,
+        handle_request refreshes its deadline; an unknown (e.g. expired)
+        peer gets NOT_FOUND and has to register again.
+        """
+        known = request.get(PayloadField.PEER_ID) in self.peer_torrents
+        return {
+            PayloadField.OPERATION_CODE: PeerServerOperation.ANNOUNCE,
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS if known else ReturnCode.NOT_FOUND
+        }
+
+    def _handle_scrape(self, request) -> dict:
+        """
+        Handle request for the swarm counters of the torrents in TORRENT_IDS
+        (every torrent if it is missing). Read only: the caller does not
+        join any swarm. Unknown ids are left out.
+        """
+        return {
+            PayloadField.OPERATION_CODE: PeerServerOperation.SCRAPE,
+            PayloadField.SWARM_COUNTS: self.scrape(request.get(PayloadField.TORRENT_IDS)),
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS
+        }
+
+    def scrape(self, torrent_ids=None) -> list:
+        """[torrent id, seeders, leechers, completed] rows"""
+        if torrent_ids is None:
+            torrent_ids = self.torrents
+        return [[torrent_id] + self.torrents[torrent_id].scrape()
+                for torrent_id in torrent_ids if torrent_id in self.torrents]
+
+    def expire_peers(self, now=None) -> list:
+        """Drop the peers that have not announced within peer_timeout"""
+        expired = self.expiry.expire(now)
+        for peer_id in expired:
+            logger.info(f"peer {peer_id} timed out")
+            self.remove_peer(peer_id)
+        return expired
+
+    async def run_expiry(self):
+        """Expire stale peers once per timer wheel tick"""
+        while True:
+            await asyncio.sleep(self.expiry.resolution)
+            if self.expire_peers():
+                try:
+                    await self.persist()
+                except OSError:
+                    pass  # the journal logged it; keep expiring peers
+
+    def get_torrent_list(self, offset=0, limit=None, summary=False) -> list:
+        """
+        Get a page of the available torrents, in torrent id order. Summary
+        entries carry seeder and leecher counts instead of peer lists.
+        """
+        torrent_ids = itertools.islice(self.torrents, offset, None if limit is None else offset + limit)
+        return [self._list_entry(torrent_id, summary) for torrent_id in torrent_ids]
+
+    def _list_entry(self, torrent_id, summary: bool) -> dict:
+        entry = self._list_entries.get((torrent_id, summary))
+        if entry is None:
+            torrent = self.torrents[torrent_id]
+            entry = {
+                PayloadField.TORRENT_ID: torrent.id,
+                PayloadField.FILE_NAME: torrent.filename,
+                PayloadField.NUM_OF_CHUNKS: torrent.num_of_chunks
+            }
+            if summary:
+                entry[PayloadField.NUM_SEEDERS] = len(torrent.seeders)
+                entry[PayloadField.NUM_LEECHERS] = len(torrent.leechers)
+            else:
+                entry[PayloadField.SEEDER_LIST] = dict(torrent.get_seeders())
+                entry[PayloadField.LEECHER_LIST] = dict(torrent.get_leechers())
+            self._list_entries[(torrent_id, summary)] = entry
+        return entry
+
+    def _changed(self, torrent_id):
+        """Record a change to a torrent: new version, stale list entries dropped"""
+        self.version += 1
+        self._list_entries.pop((torrent_id, False), None)
+        self._list_entries.pop((torrent_id, True), None)
+        self._snapshot_rows.pop(torrent_id, None)
+        self._list_pages.clear()
 
     def get_torrent_data(self, request: dict) -> dict:
-        """Get detailed data for specific torrent"""
+        """
+        Get detailed data for specific torrent. Leechers upload the chunks
+        they already have, so they are returned as sources too (minus the requester).
+        At most NUM_WANT peers are returned, sampled at random; with COMPACT
+        IPv4 peers come as packed 6-byte addresses.
+        """
         torrent = self.torrents[request[PayloadField.TORRENT_ID]]
-        torrent.add_leecher(request[PayloadField.PEER_ID], request[PayloadField.IP_ADDRESS], request[PayloadField.PORT])
+        peer_id = request[PayloadField.PEER_ID]
+        num_want = min(int(request.get(PayloadField.NUM_WANT) or DEFAULT_NUM_WANT), MAX_NUM_WANT)
+        seeders, leechers = torrent.sample_peers(num_want, exclude=peer_id)
+        # Asking again (e.g. to refresh the peer list) is not a change to journal
+        if not torrent.has_peer(peer_id):
+            self._add_leecher(torrent.id, peer_id, request[PayloadField.IP_ADDRESS], request[PayloadField.PORT])
         
-        return {
+        data = {
             PayloadField.TORRENT_ID: torrent.id,
             PayloadField.FILE_NAME: torrent.filename,
             PayloadField.NUM_OF_CHUNKS: torrent.num_of_chunks,
-            PayloadField.SEEDER_LIST: torrent.get_seeders(),
-            PayloadField.LEECHER_LIST: torrent.get_leechers()
+            PayloadField.FILE_SIZE: torrent.file_size,
+            PayloadField.CHUNK_HASHES: torrent.chunk_hashes,
+            PayloadField.SEEDER_LIST: seeders,
+            PayloadField.LEECHER_LIST: leechers
         }
+        if request.get(PayloadField.COMPACT):
+            data[PayloadField.SEEDER_LIST], data[PayloadField.COMPACT_SEEDERS] = self._compact(seeders)
+            data[PayloadField.LEECHER_LIST], data[PayloadField.COMPACT_LEECHERS] = self._compact(leechers)
+        return data
+
+    @staticmethod
+    def _compact(peers: dict) -> tuple[dict, str]:
+        """
+        Pack IPv4 peers into base64 compact form; other peers stay in the
+        returned dict
+        """
+        packed, others = [], {}
+        for peer_id, info in peers.items():
+            try:
+                packed.append(pack_compact_peer(info[PayloadField.IP_ADDRESS], info[PayloadField.PORT]))
+            except (OSError, ValueError, struct.error):
+                others[peer_id] = info
+        return others, base64.b64encode(b"".join(packed)).decode()
 
     def update_peer_status(self, request: dict) -> int:
         """Update peer status to seeder"""
         if request[PayloadField.TORRENT_ID] not in self.torrents:
             return ReturnCode.FAIL
         
-        torrent = self.torrents[request[PayloadField.TORRENT_ID]]
-        logger.debug(f"Adding new seeder to torrent: {torrent}")
-        torrent.add_seeder(request[PayloadField.PEER_ID], request[PayloadField.IP_ADDRESS], request[PayloadField.PORT])
-        torrent.remove_leecher(request[PayloadField.PEER_ID])
+        torrent_id = request[PayloadField.TORRENT_ID]
+        logger.debug(f"Adding new seeder to torrent: {torrent_id}")
+        self._add_seeder(torrent_id, request[PayloadField.PEER_ID], request[PayloadField.IP_ADDRESS],
+                         request[PayloadField.PORT])
         return ReturnCode.SUCCESS
 
+    def _add_seeder(self, torrent_id, peer_id: str, ip, port):
+        torrent = self.torrents[torrent_id]
+        torrent.add_seeder(peer_id, ip, port)
+        torrent.remove_leecher(peer_id)
+        self._index_peer(peer_id, torrent_id)
+        self._changed(torrent_id)
+        self._log('seed', torrent_id, peer_id, ip, port)
+
+    def _add_leecher(self, torrent_id, peer_id: str, ip, port):
+        self.torrents[torrent_id].add_leecher(peer_id, ip, port)
+        self._index_peer(peer_id, torrent_id)
+        self._changed(torrent_id)
+        self._log('leech', torrent_id, peer_id, ip, port)
+
     def stop_seeding(self, request: dict) -> int:
         """Remove peer from seeders list"""
         if request[PayloadField.TORRENT_ID] not in self.torrents:
@@ -137,60 +342,252 @@ class TrackerServer:
             return ReturnCode.FAIL
 
         logger.info(f"removing seeder: {peer_id}")
-        self.torrents[request[PayloadField.TORRENT_ID]].remove_seeder(peer_id)
+        self._log('stop', request[PayloadField.TORRENT_ID], peer_id)
+        torrent = self.torrents[request[PayloadField.TORRENT_ID]]
+        torrent.remove_seeder(peer_id)
+        if not torrent.has_peer(peer_id):
+            self._unindex_peer(peer_id, torrent.id)
+        self._changed(torrent.id)
         self.check_seeders(request[PayloadField.TORRENT_ID])
         return ReturnCode.SUCCESS
 
+    def remove_peer(self, peer_id: str):
+        """Remove a peer from every torrent it is part of"""
+        self.expiry.cancel(peer_id)
+        if peer_id in self.peer_torrents:
+            self._log('drop', peer_id)
+        for torrent_id in self.peer_torrents.pop(peer_id, set()):
+            torrent = self.torrents[torrent_id]
+            torrent.remove_seeder(peer_id)
+            torrent.remove_leecher(peer_id)
+            self._changed(torrent_id)
+            self.check_seeders(torrent_id)
+
     def check_seeders(self, torrent_id):
         """Remove torrent if it has no seeders"""
         if len(self.torrents[torrent_id].seeders) == 0:
-            self.torrents.pop(torrent_id)
-            self.next_torrent_id -= 1
+            self.remove_torrent(torrent_id)
             logger.info(f"removed torrent {torrent_id} (no seeders)")
 
+    def remove_torrent(self, torrent_id):
+        """Drop a torrent and its index entries. Torrent ids are never reused."""
+        torrent = self.torrents.pop(torrent_id)
+        if self.torrent_by_content.get(torrent.content_key) == torrent_id:
+            del self.torrent_by_content[torrent.content_key]
+        for peer_id in list(torrent.seeders) + list(torrent.leechers):
+            self._unindex_peer(peer_id, torrent_id)
+        self._changed(torrent_id)
+
+    def _index_peer(self, peer_id: str, torrent_id):
+        self.peer_torrents.setdefault(peer_id, set()).add(torrent_id)
+
+    def _unindex_peer(self, peer_id: str, torrent_id):
+        torrents = self.peer_torrents.get(peer_id)
+        if torrents is not None:
+            torrents.discard(torrent_id)
+            if not torrents:
+                del self.peer_torrents[peer_id]
+                self.expiry.cancel(peer_id)
+
+    def is_seeding(self, peer_id: str, exclude=None) -> bool:
+        """Check whether a peer seeds any torrent other than `exclude`"""
+        return any(torrent_id != exclude and peer_id in self.torrents[torrent_id].seeders
+                   for torrent_id in self.peer_torrents.get(peer_id, ()))
+
     def add_new_file(self, request: dict) -> tuple[int, int]:
-        """Add new file as torrent"""
-        # Check if peer is already seeding
-        for torrent in self.torrents.values():
-            if request[PayloadField.FILE_NAME] in torrent.get_filename():
-                return self.update_peer_status(request)
-            if request[PayloadField.PEER_ID] in torrent.get_seeders():
-                return ReturnCode.ALREADY_SEEDING, -1
-
-        new_torrent = Torrent(
-            self.next_torrent_id,
-            request[PayloadField.FILE_NAME],
-            request[PayloadField.NUM_OF_CHUNKS]
-        )
-        new_torrent.add_seeder(request[PayloadField.PEER_ID], request[PayloadField.IP_ADDRESS], request[PayloadField.PORT])
-        
-        # Add to torrents list
-        self.torrents[self.next_torrent_id] = new_torrent
-        self.next_torrent_id += 1
-        
-        return ReturnCode.SUCCESS, new_torrent.id
+        """
+        Add new file as torrent. Uploading content the tracker already has
+        (same manifest, or same file name without one) joins that torrent
+        as a seeder instead.
+        """
+        peer_id = request[PayloadField.PEER_ID]
+        key = content_key(request[PayloadField.FILE_NAME], request.get(PayloadField.CHUNK_HASHES))
+        existing_id = self.torrent_by_content.get(key)
+
+        # A peer seeds one file at a time
+        if self.is_seeding(peer_id, exclude=existing_id):
+            return ReturnCode.ALREADY_SEEDING, -1
+
+        if existing_id is not None:
+            status = self.update_peer_status(dict(request, **{PayloadField.TORRENT_ID: existing_id}))
+            return status, existing_id
+
+        torrent_id = self.next_torrent_id
+        self._create_torrent(torrent_id, request[PayloadField.FILE_NAME], request[PayloadField.NUM_OF_CHUNKS],
+                             request.get(PayloadField.FILE_SIZE, 0), request.get(PayloadField.CHUNK_HASHES))
+        self._add_seeder(torrent_id, peer_id, request[PayloadField.IP_ADDRESS], request[PayloadField.PORT])
+        return ReturnCode.SUCCESS, torrent_id
+
+    def _create_torrent(self, torrent_id, file_name, num_of_chunks, file_size=0, chunk_hashes=None) -> Torrent:
+        torrent = Torrent(torrent_id, file_name, num_of_chunks, file_size, chunk_hashes)
+        self.torrents[torrent_id] = torrent
+        self.torrent_by_content[torrent.content_key] = torrent_id
+        self.next_torrent_id = max(self.next_torrent_id, torrent_id + self.num_shards)
+        self._changed(torrent_id)
+        self._log('torrent', torrent_id, file_name, num_of_chunks, file_size, chunk_hashes)
+        return torrent
+
+    def _log(self, *event):
+        """Journal a registry change (not while replaying the journal)"""
+        if self.journal is not None and not self._replaying:
+            self.journal.append(list(event))
+
+    def _apply(self, event: list):
+        """Replay one journaled change"""
+        op, args = event[0], event[1:]
+        if op == 'torrent':
+            self._create_torrent(*args)
+        elif op == 'seed':
+            self._add_seeder(*args)
+        elif op == 'leech':
+            self._add_leecher(*args)
+        elif op == 'stop':
+            self.stop_seeding({PayloadField.TORRENT_ID: args[0], PayloadField.PEER_ID: args[1]})
+        elif op == 'drop':
+            self.remove_peer(args[0])
+        else:
+            logger.warning(f"skipping unknown journal event {op}")
+
+    def restore(self):
+        """
+        Rebuild the registry from the latest snapshot and the journal after
+        it. Restored peers get a fresh peer_timeout to announce again.
+        """
+        if self.journal is None:
+            return
+        start = time.monotonic()
+        # Loading allocates millions of long-lived objects; cyclic GC passes would only slow it down
+        gc.disable()
+        self._replaying = True
+        try:
+            state, events = self.journal.load()
+            if state is not None:
+                self._load_snapshot(state)
+            for event in events:
+                self._apply(event)
+        finally:
+            self._replaying = False
+            gc.enable()
+        for peer_id in self.peer_torrents:
+            self.expiry.schedule(peer_id, self.peer_timeout)
+        logger.info(f"restored {len(self.torrents)} torrents from {self.journal.directory} "
+                    f"({len(events)} journal events) in {time.monotonic() - start:.2f}s")
+
+    def _snapshot_state(self) -> dict:
+        """
+        Copy of the registry for a snapshot. It runs on the event loop, so
+        rows of unchanged torrents are reused from the last snapshot.
+        """
+        return {
+            'next_torrent_id': self.next_torrent_id,
+            'version': self.version,
+            'torrents': [self._snapshot_row(torrent_id) for torrent_id in self.torrents]
+        }
+
+    def _snapshot_row(self, torrent_id) -> list:
+        row = self._snapshot_rows.get(torrent_id)
+        if row is None:
+            t = self.torrents[torrent_id]
+            row = self._snapshot_rows[torrent_id] = [
+                t.id, t.filename, t.num_of_chunks, t.file_size, t.chunk_hashes,
+                [[peer_id, info[PayloadField.IP_ADDRESS], info[PayloadField.PORT]] for peer_id, info in t.seeders.items()],
+                [[peer_id, info[PayloadField.IP_ADDRESS], info[PayloadField.PORT]] for peer_id, info in t.leechers.items()],
+                t.completed
+            ]
+        return row
+
+    def _load_snapshot(self, state: dict):
+        for row in state['torrents']:
+            torrent_id, file_name, num_of_chunks, file_size, chunk_hashes, seeders, leechers, *rest = row
+            torrent = Torrent(torrent_id, file_name, num_of_chunks, file_size, chunk_hashes)
+            for peer_id, ip, port in seeders:
+                torrent.add_seeder(peer_id, ip, port)
+                self._index_peer(peer_id, torrent_id)
+            for peer_id, ip, port in leechers:
+                torrent.add_leecher(peer_id, ip, port)
+                self._index_peer(peer_id, torrent_id)
+            torrent.completed = rest[0] if rest else 0
+            self.torrents[torrent_id] = torrent
+            self.torrent_by_content[torrent.content_key] = torrent_id
+            self._snapshot_rows[torrent_id] = row
+        self.next_torrent_id = state['next_torrent_id']
+        self.version = state['version']
+
+    async def persist(self):
+        """Wait for journaled changes to reach disk and start a snapshot when one is due"""
+        if self.journal is None:
+            return
+        await self.journal.commit()
+        if self.journal.snapshot_due():
+            self._snapshot_task = asyncio.create_task(self.journal.snapshot(self._snapshot_state))
+
+    async def respond(self, request) -> bytes:
+        """Encoded response to a request, forwarded to its shard when there is a router"""
+        if self.router is not None:
+            return await self.router.dispatch(request)
+        return await self.respond_locally(request)
+
+    async def respond_locally(self, request) -> bytes:
+        """Encoded response to a request this tracker owns"""
+        appended = self.journal.appended if self.journal is not None else 0
+        response = self.encode_response(request)
+        # Acknowledge a change only once it is journaled; requests that
+        # changed nothing do not wait for other requests' writes
+        if self.journal is not None and self.journal.appended != appended:
+            await self.persist()
+        return response
 
     async def receive_request(self, reader, writer):
-        """Handle incoming connection and request"""
+        """
+        Serve a client session until it hangs up or stays idle for
+        idle_timeout. The connection limiter bounds the requests being
+        handled, not the open sessions.
+        """
+        addr = writer.get_extra_info('peername')
+        metrics = self.metrics
+        metrics.connection_opened()
         try:
-            data = await reader.read(READ_SIZE)
-            request = json.loads(data.decode())
-            addr = writer.get_extra_info('peername')
+            while True:
+                try:
+                    frame = await asyncio.wait_for(read_frame(reader), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    logger.debug(f"closing idle session {addr}")
+                    break
+                if frame is None:
+                    break
 
-            logger.debug(f"received request from {addr}: {request}")
-            
-            response = self.handle_request(request)
-            payload = json.dumps(response)
-            logger.debug(f"sending response: {payload}")
-            writer.write(payload.encode())
-            await writer.drain()
+                # End to end: the limiter wait and the journal commit are part of the latency
+                start = time.perf_counter()
+                request = decode_frame(frame)
+                opcode = request.get(PayloadField.OPERATION_CODE)
+                logger.debug(f"received request {opcode} from {addr}")
+
+                response = await self.respond(request)
+                metrics.observe_request(opcode, time.perf_counter() - start, len(frame), len(response))
+                logger.debug(f"sending {len(response)} byte response")
+                writer.write(response)
+                await writer.drain()
 
         except Exception as e:
             logger.error(f"{str(e)}")
             logger.info(f"peer disconnected: {writer.get_extra_info('peername')}")
         finally:
+            metrics.connection_closed()
             writer.close()
 
+    def render_metrics(self) -> str:
+        """Prometheus text for this tracker, with registry sizes read now"""
+        seeders = leechers = 0
+        for torrent in self.torrents.values():
+            seeders += len(torrent.seeders)
+            leechers += len(torrent.leechers)
+        return self.metrics.render({
+            'tracker_torrents': ('Torrents registered', len(self.torrents)),
+            'tracker_peers': ('Peers seeding or leeching any torrent', len(self.peer_torrents)),
+            'tracker_seeders': ('Seeders summed over torrents', seeders),
+            'tracker_leechers': ('Leechers summed over torrents', leechers)
+        })
+
 def validate_port(port: str) -> bool:
     """Validate port number"""
     try:
@@ -199,44 +596,72 @@ def validate_port(port: str) -> bool:
     except ValueError:
         return False
 
-def parse_arguments() -> str:
-    """Parse command line arguments"""
-    args = len(sys.argv) - 1
+def parse_arguments() -> tuple:
+    """Parse command line arguments, return (port or None, number of workers, metrics port or None)"""
+    args = sys.argv[1:]
 
-    if args == 0:
-        return None
-    
-    if args == 1:
-        port = sys.argv[1]
-        if validate_port(port):
-            return port
-        logger.error("invalid port number (must be 0-65535)")
-        return None
-
-    print("Usage: tracker.py [server port]")
-    print("Using default port")
-    return None
-
-async def main():
+    if len(args) > 3:
+        print("Usage: tracker.py [server port] [workers] [metrics port]")
+        print("Using default port")
+        return None, 1, None
+
+    port = None
+    if args:
+        if validate_port(args[0]):
+            port = args[0]
+        else:
+            logger.error("invalid port number (must be 0-65535)")
+
+    workers = 1
+    if len(args) >= 2:
+        if args[1].isdigit() and int(args[1]) > 0:
+            workers = int(args[1])
+        else:
+            logger.error("invalid number of workers, using one")
+
+    metrics_port = None
+    if len(args) == 3:
+        if validate_port(args[2]):
+            metrics_port = int(args[2])
+        else:
+            logger.error("invalid metrics port, metrics disabled")
+    return port, workers, metrics_port
+
+def tracker_ip() -> str:
+    return asyncio.streams.socket.gethostbyname(asyncio.streams.socket.gethostname())
+
+async def main(port=None, metrics_port=None):
     """Main entry point"""
     try:
-        ip = asyncio.streams.socket.gethostbyname(asyncio.streams.socket.gethostname())
-        port = parse_arguments() or 8888
+        ip = tracker_ip()
+        port = port or 8888
             
-        tracker = TrackerServer()
+        tracker = TrackerServer(state_dir=TRACKER_STATE_DIR)
+        tracker.restore()
         server = await asyncio.start_server(tracker.receive_request, ip, port)
+        expiry_task = asyncio.create_task(tracker.run_expiry())
+        if metrics_port is not None:
+            await serve_metrics(tracker.render_metrics, '127.0.0.1', metrics_port)
         addr = server.sockets[0].getsockname()
         print(f'[info] tracker serving on {addr}')
 
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry_task.cancel()
     
     except Exception as e:
         logger.error(f"server error: {str(e)}")
         sys.exit(1)
 
 if __name__ == "__main__":
+    port, workers, metrics_port = parse_arguments()
     try:
-        asyncio.run(main())
+        if workers > 1:
+            from tracker_shards import serve_workers
+            serve_workers(tracker_ip(), port or 8888, workers, metrics_port=metrics_port)
+        else:
+            asyncio.run(main(port, metrics_port))
     except KeyboardInterrupt:
         print("\n[info] tracker shutdown by user")
\ No newline at end of file
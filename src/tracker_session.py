@@ -0,0 +1,60 @@
+"""
+Tracker session for p2p file sharing.
+Keeps one connection to the tracker open for any number of requests.
+"""
+import asyncio
+from protocol import ProtocolError, CONNECT_TIMEOUT, REQUEST_TIMEOUT, encode_message, read_message
+from logger import setup_logger
+
+logger = setup_logger()
+
+class TrackerSession:
+    """
+    A persistent connection to the tracker. Requests are sent one at a time
+    and each waits for its response. The connection is opened on first use;
+    if the tracker closed it in the meantime (e.g. after its idle timeout),
+    it is reopened once and the request sent again.
+    """
+    def __init__(self, ip, port, connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT):
+        self.ip = ip
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.reader = None
+        self.writer = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, int(self.port)), self.connect_timeout)
+        logger.debug(f"tracker session opened to {self.ip}:{self.port}")
+
+    async def request(self, payload: dict) -> dict:
+        """Send a request and return the tracker's response"""
+        async with self._lock:
+            while True:
+                reused = self.is_open and not self.reader.at_eof()
+                if not reused:
+                    self.close()
+                    await self.open()
+                try:
+                    self.writer.write(encode_message(payload))
+                    await self.writer.drain()
+                    response = await asyncio.wait_for(read_message(self.reader), self.request_timeout)
+                    if response is None:
+                        raise ConnectionResetError("tracker closed the session")
+                    return response
+                except (OSError, asyncio.IncompleteReadError, ProtocolError, asyncio.TimeoutError) as e:
+                    self.close()
+                    if not reused or isinstance(e, asyncio.TimeoutError):
+                        raise
+                    logger.debug(f"tracker session went stale ({str(e)}), reconnecting")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
@@ -0,0 +1,243 @@
+"""
+Multi-core tracker for p2p file sharing.
+Runs one tracker process per worker on the same port (SO_REUSEPORT), with
+the torrent registry sharded between them by torrent id.
+"""
+import asyncio
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zlib
+from protocol import PeerServerOperation, ReturnCode, PayloadField, ProtocolError, FRAME_HEADER, \
+    TRACKER_STATE_DIR, encode_message, read_message, read_frame
+from torrent import content_key
+from tracker import TrackerServer
+from metrics import serve_metrics
+from logger import setup_logger
+
+logger = setup_logger()
+
+SHARD_CONNECT_RETRIES = 50  # sibling workers may still be starting up
+SHARD_CONNECT_DELAY = 0.1  # seconds between attempts
+
+def shard_of(request: dict, num_shards: int):
+    """
+    Shard that owns a request: uploads by content, so that the same
+    content always meets in one shard, everything else by torrent id.
+    None for requests any shard can answer.
+    """
+    if request.get(PayloadField.OPERATION_CODE) == PeerServerOperation.UPLOAD_FILE:
+        key = content_key(request.get(PayloadField.FILE_NAME, ""), request.get(PayloadField.CHUNK_HASHES))
+        return zlib.crc32(key.encode()) % num_shards
+    torrent_id = request.get(PayloadField.TORRENT_ID)
+    if isinstance(torrent_id, int) and not isinstance(torrent_id, bool):
+        return torrent_id % num_shards
+    return None
+
+class ShardRouter:
+    """
+    Routes requests between the shards of a tracker. Every shard listens on
+    a Unix socket in socket_dir; a request owned by another shard is
+    forwarded over a pooled connection and the encoded response is relayed
+    as is. GET_LIST goes to every shard and the pages are merged in torrent
+    id order. The merged list version is the sum of the shard versions,
+    which grows whenever any shard changes.
+
+    A peer's one-file-at-a-time seeding rule is only checked within the
+    shard that receives the upload.
+    """
+    def __init__(self, tracker: TrackerServer, socket_dir: str):
+        self.tracker = tracker
+        self.socket_dir = socket_dir
+        self._idle = {}  # shard -> idle (reader, writer) connections
+
+    def path(self, shard: int) -> str:
+        return os.path.join(self.socket_dir, f"shard-{shard}.sock")
+
+    async def start(self):
+        """Listen for requests forwarded by the other shards"""
+        return await asyncio.start_unix_server(self.serve_shard, path=self.path(self.tracker.shard))
+
+    async def dispatch(self, request) -> bytes:
+        if request.get(PayloadField.OPERATION_CODE) == PeerServerOperation.GET_LIST:
+            return await self.get_list(request)
+        if request.get(PayloadField.OPERATION_CODE) == PeerServerOperation.SCRAPE:
+            return await self.scrape(request)
+        shard = shard_of(request, self.tracker.num_shards)
+        if shard is None or shard == self.tracker.shard:
+            return await self.tracker.respond_locally(request)
+        return await self.forward(shard, request)
+
+    async def forward(self, shard: int, request) -> bytes:
+        """Send a request to another shard and return its encoded response"""
+        reader, writer = await self._connection(shard)
+        try:
+            writer.write(encode_message(request))
+            await writer.drain()
+            frame = await read_frame(reader)
+            if frame is None:
+                raise ConnectionResetError(f"shard {shard} closed the connection")
+        except BaseException:
+            writer.close()
+            raise
+        self._idle.setdefault(shard, []).append((reader, writer))
+        return frame
+
+    async def _connection(self, shard: int):
+        idle = self._idle.get(shard)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        for attempt in range(SHARD_CONNECT_RETRIES):
+            try:
+                return await asyncio.open_unix_connection(self.path(shard))
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == SHARD_CONNECT_RETRIES - 1:
+                    raise
+                await asyncio.sleep(SHARD_CONNECT_DELAY)
+
+    async def serve_shard(self, reader, writer):
+        """Answer forwarded requests until the forwarding shard hangs up"""
+        try:
+            while True:
+                request = await read_message(reader)
+                if request is None:
+                    break
+                if request.get(PayloadField.SHARD_LIST):
+                    response = encode_message(self._local_list(request))
+                else:
+                    response = await self.tracker.respond_locally(request)
+                writer.write(response)
+                await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, ProtocolError) as e:
+            logger.error(f"shard connection failed: {str(e)}")
+        finally:
+            writer.close()
+
+    def _local_list(self, request) -> dict:
+        """This shard's first LIMIT list entries, its version and its number of torrents"""
+        return {
+            PayloadField.TORRENT_LIST: self.tracker.get_torrent_list(0, request[PayloadField.LIMIT],
+                                                                     request[PayloadField.SUMMARY]),
+            PayloadField.VERSION: self.tracker.version,
+            PayloadField.TOTAL: len(self.tracker.torrents)
+        }
+
+    async def _shard_list(self, shard: int, request) -> dict:
+        if shard == self.tracker.shard:
+            return self._local_list(request)
+        frame = await self.forward(shard, request)
+        return json.loads(frame[FRAME_HEADER.size:])
+
+    async def scrape(self, request) -> bytes:
+        """Split a SCRAPE by shard and concatenate the counters"""
+        torrent_ids = request.get(PayloadField.TORRENT_IDS)
+        num_shards = self.tracker.num_shards
+        if torrent_ids is None:
+            by_shard = {shard: None for shard in range(num_shards)}
+        else:
+            by_shard = {}
+            for torrent_id in torrent_ids:
+                if isinstance(torrent_id, int):
+                    by_shard.setdefault(torrent_id % num_shards, []).append(torrent_id)
+
+        async def shard_scrape(shard, ids):
+            if shard == self.tracker.shard:
+                return self.tracker.scrape(ids)
+            part = {PayloadField.OPERATION_CODE: PeerServerOperation.SCRAPE}
+            if ids is not None:
+                part[PayloadField.TORRENT_IDS] = ids
+            frame = await self.forward(shard, part)
+            return json.loads(frame[FRAME_HEADER.size:])[PayloadField.SWARM_COUNTS]
+        parts = await asyncio.gather(*(shard_scrape(shard, ids) for shard, ids in by_shard.items()))
+        return encode_message({
+            PayloadField.OPERATION_CODE: PeerServerOperation.SCRAPE,
+            PayloadField.SWARM_COUNTS: [row for part in parts for row in part],
+            PayloadField.RETURN_CODE: ReturnCode.SUCCESS
+        })
+
+    async def get_list(self, request) -> bytes:
+        """Merge a GET_LIST page from every shard"""
+        offset, limit, summary = self.tracker._list_page(request)
+        part = {
+            PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST,
+            PayloadField.LIMIT: offset + limit,
+            PayloadField.SUMMARY: summary,
+            PayloadField.SHARD_LIST: True
+        }
+        parts = await asyncio.gather(*(self._shard_list(shard, part) for shard in range(self.tracker.num_shards)))
+        version = sum(p[PayloadField.VERSION] for p in parts)
+        total = sum(p[PayloadField.TOTAL] for p in parts)
+
+        response = {PayloadField.OPERATION_CODE: PeerServerOperation.GET_LIST}
+        if total == 0:
+            response[PayloadField.RETURN_CODE] = ReturnCode.NO_AVAILABLE_TORRENTS
+        elif request.get(PayloadField.VERSION) == version:
+            response[PayloadField.RETURN_CODE] = ReturnCode.NOT_MODIFIED
+            response[PayloadField.VERSION] = version
+        else:
+            # Every shard lists its torrents in id order
+            entries = heapq.merge(*(p[PayloadField.TORRENT_LIST] for p in parts),
+                                  key=lambda entry: entry[PayloadField.TORRENT_ID])
+            response.update({
+                PayloadField.TORRENT_LIST: list(entries)[offset:offset + limit],
+                PayloadField.VERSION: version,
+                PayloadField.TOTAL: total,
+                PayloadField.OFFSET: offset,
+                PayloadField.RETURN_CODE: ReturnCode.SUCCESS
+            })
+        return encode_message(response)
+
+async def serve_worker(shard: int, num_shards: int, ip: str, port: int, socket_dir: str, state_dir=TRACKER_STATE_DIR,
+                       metrics_port=None):
+    """
+    Run one shard: restore its state, then serve the shared port and the
+    shard socket. Worker k serves its metrics on metrics_port + k.
+    """
+    # The shard layout depends on the number of workers, so each layout keeps its own state
+    tracker = TrackerServer(state_dir=os.path.join(state_dir, f"shard-{shard}-of-{num_shards}"),
+                            shard=shard, num_shards=num_shards)
+    tracker.restore()
+    tracker.router = ShardRouter(tracker, socket_dir)
+    shard_server = await tracker.router.start()
+    server = await asyncio.start_server(tracker.receive_request, ip, port, reuse_port=True)
+    expiry_task = asyncio.create_task(tracker.run_expiry())
+    if metrics_port is not None:
+        await serve_metrics(tracker.render_metrics, '127.0.0.1', metrics_port + shard)
+    logger.info(f"tracker worker {shard} serving on {server.sockets[0].getsockname()}")
+
+    try:
+        async with shard_server, server:
+            await server.serve_forever()
+    finally:
+        expiry_task.cancel()
+
+def run_worker(*args):
+    """Process entry point of a tracker worker"""
+    try:
+        asyncio.run(serve_worker(*args))
+    except KeyboardInterrupt:
+        pass
+
+def serve_workers(ip: str, port, workers: int, state_dir=TRACKER_STATE_DIR, metrics_port=None):
+    """Run `workers` tracker processes on one port, one shard each"""
+    socket_dir = tempfile.mkdtemp(prefix='tracker-shards-')
+    processes = [multiprocessing.Process(target=run_worker,
+                                         args=(shard, workers, ip, int(port), socket_dir, state_dir, metrics_port),
+                                         daemon=True)
+                 for shard in range(workers)]
+    for process in processes:
+        process.start()
+    print(f'[info] tracker serving on {(ip, int(port))} with {workers} workers')
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -0,0 +1,70 @@
+"""
+Multi-process uploads for p2p file sharing.
+Serves a hot seed from several processes that share the client's port
+(SO_REUSEPORT), so uploads use more than one core.
+"""
+import asyncio
+import multiprocessing
+import os
+from client import Client
+from logger import setup_logger
+
+logger = setup_logger()
+
+def upload_client(ip: str, port, path: str, hashes: list, upload_rates=(), torrent_id=None) -> Client:
+    """A client seeding a finished file, charging its uploads to the torrent's caps"""
+    client = Client(ip, port)
+    client.chunk_buffer.set_file(path, os.path.getsize(path))
+    client.chunk_buffer.set_hashes(hashes)
+    client.upload_limiter.set_rates(*upload_rates)
+    client.torrent_id = torrent_id
+    client.state.seeding = True
+    return client
+
+async def serve_uploads(ip: str, port, path: str, hashes: list, upload_rates=(), torrent_id=None):
+    """Serve every chunk of a finished file to the peers the kernel hands this process"""
+    client = upload_client(ip, port, path, hashes, upload_rates, torrent_id)
+    server = await asyncio.start_server(client.receive_peer_request, ip, int(port), reuse_port=True)
+    logger.info(f"upload worker {os.getpid()} serving {path} on {server.sockets[0].getsockname()}")
+    async with server:
+        await server.serve_forever()
+
+def run_uploader(*args):
+    """Process entry point of an upload worker"""
+    try:
+        asyncio.run(serve_uploads(*args))
+    except KeyboardInterrupt:
+        pass
+
+class UploadWorkers:
+    """
+    Extra upload processes for a complete file-backed seed. The kernel
+    spreads incoming peer connections over the client's own server and
+    the workers. A seed only ever reads its file, so workers share nothing
+    with the client but the file on disk; each keeps its own choker.
+    Workers get their upload caps when they start (see
+    Client.set_rate_limits) and do not follow later changes.
+    """
+    def __init__(self, count: int):
+        self.count = count
+        self.processes = []
+
+    def start(self, ip: str, port, chunk_buffer, upload_rates=(), torrent_id=None):
+        # Spawned, not forked: a forked worker would hold on to the client's
+        # own listening socket and keep it in the port's group after it closes
+        context = multiprocessing.get_context('spawn')
+        self.processes = [context.Process(target=run_uploader,
+                                          args=(ip, port, chunk_buffer.path, chunk_buffer.chunk_hashes, upload_rates,
+                                                torrent_id),
+                                          daemon=True)
+                          for _ in range(self.count)]
+        for process in self.processes:
+            process.start()
+        logger.info(f"started {self.count} upload workers for {chunk_buffer.path}")
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []